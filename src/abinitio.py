@@ -10,10 +10,11 @@ from builtins import zip
 from builtins import range
 import os
 import shutil
+import tempfile
 from forcebalance.nifty import col, eqcgmx, flat, floatornan, fqcgmx, invert_svd, kb, printcool, bohr2ang, warn_press_key, warn_once, pvec1d, commadash, uncommadash, isint
 import numpy as np
 from forcebalance.target import Target
-from forcebalance.molecule import Molecule, format_xyz_coord
+from forcebalance.molecule import Molecule, format_xyz_coord, load_qdata
 from re import match, sub
 import subprocess
 from subprocess import PIPE
@@ -58,6 +59,42 @@ def norm2(arr, a=0, n=None, step=3):
         answer.append(np.dot(d,d))
     return np.array(answer)
 
+def esp_inverse_distances(espxyz, xyz):
+    """
+    Inverse distances between ESP grid points and particles.
+
+    @param[in] espxyz (Nesp, 3) array of ESP grid point coordinates in Angstrom
+    @param[in] xyz (Nparticles, 3) array of particle coordinates in Angstrom
+    @return (Nesp, Nparticles) array of inverse distances in bohr^-1
+
+    """
+    dxyz = espxyz[:, np.newaxis, :] - xyz[np.newaxis, :, :]
+    return bohr2ang / np.sqrt(np.einsum('ijk,ijk->ij', dxyz, dxyz))
+
+def resp_normal_equations(P, invdists, espvals):
+    """
+    Weighted normal equations of the least-squares fit of the ESP to the charges.
+
+    @param[in] P (Nsnapshots) array of snapshot weights
+    @param[in] invdists (Nsnapshots, Nesp, Nparticles) array of inverse distances
+    @param[in] espvals (Nsnapshots, Nesp) array of reference ESP values
+    @return Z Sum of the weights
+    @return A (Nparticles, Nparticles) array, Sum_i P_i V_i^T V_i
+    @return b (Nparticles) array, Sum_i P_i V_i^T ESP_i
+    @return c Sum_i P_i ESP_i.ESP_i
+    @return D Weighted sum of the variances of the ESP values times Nesp
+
+    """
+    nesp = espvals.shape[1]
+    A = np.zeros((invdists.shape[2], invdists.shape[2]))
+    for Pi, Vi in zip(P, invdists):
+        Vi = np.asarray(Vi, dtype=float)
+        A += Pi * np.dot(Vi.T, Vi)
+    b = np.einsum('i,ijk,ij->k', P, invdists, espvals)
+    c = np.einsum('i,ij,ij', P, espvals, espvals)
+    D = c / nesp - np.dot(P, (np.sum(espvals, axis=1) / nesp)**2)
+    return np.sum(P), A, b, c, D
+
 class AbInitio(Target):
 
     """ Subclass of Target for fitting force fields to ab initio data.
@@ -126,6 +163,16 @@ class AbInitio(Target):
         ## Whether to do energy and force calculations for the whole trajectory, or to do
         ## one calculation per snapshot.
         self.set_option(tgt_opts,'all_at_once','all_at_once')
+        if self.fd_processes > 1 and not self.all_at_once:
+            warn_press_key("fd_processes is only used when all_at_once is enabled")
+        ## Number of snapshots in each block when adding up the objective function.
+        self.set_option(tgt_opts,'snapshot_chunk','snapshot_chunk')
+        ## Largest size (MB) of the finite-difference derivatives to keep in memory.
+        self.set_option(tgt_opts,'max_dm_memory','max_dm_memory')
+        ## Whether to store the ESP inverse distance matrix in single precision.
+        self.set_option(tgt_opts,'invdist_float32','invdist_float32')
+        ## Whether to keep a binary copy of qdata.txt that is memory-mapped on later runs.
+        self.set_option(tgt_opts,'qdata_cache','qdata_cache')
         ## OpenMM-only option - whether to run the energies and forces internally.
         self.set_option(tgt_opts,'run_internal','run_internal')
         ## Whether we have virtual sites (set at the global option level)
@@ -215,6 +262,12 @@ class AbInitio(Target):
         self.buildx = True
         ## Save the mvals from the last time we updated the vsites.
         self.save_vmvals = {}
+        ## Positions and inverse distance matrix from the last time it was built,
+        ## used to update only the columns of particles that moved.
+        self.invdist_xyzs = None
+        self.invdist_base = None
+        ## Normal equations of the ESP fit for the current inverse distance matrix.
+        self.resp_normal = None
         self.set_option(None, 'shots', val=self.ns)
         self.M_orig = None
 
@@ -230,22 +283,31 @@ class AbInitio(Target):
             pvals = self.FF.make(mvals)
             self.mol.xyzs = self.engine.generate_positions()
         # prepare the distance matrix for esp computations
+        invdists = np.array([])
         if len(self.espxyz) > 0:
-            invdists = []
-            logger.info("\rPreparing the distance matrix... it will have %i * %i * %i = %i elements" % (self.ns, self.nesp, self.nparticles, self.ns * self.nesp * self.nparticles))
-            sn = 0
-            for espset, xyz in zip(self.espxyz, self.mol.xyzs):
-                logger.info("\rGenerating ESP distances for snapshot %i%s\r" % (sn, " "*50))
-                esparr = np.array(espset).reshape(-1,3)
-                # Create a matrix with Nesp rows and Natoms columns.
-                DistMat = np.array([[np.linalg.norm(i - j) for j in xyz] for i in esparr])
-                invdists.append(1. / (DistMat / bohr2ang))
-                sn += 1
+            xyzs = np.array(self.mol.xyzs)[:len(self.espxyz)]
+            if self.invdist_xyzs is not None and self.invdist_xyzs.shape == xyzs.shape:
+                # Only recompute the columns of particles that have moved (i.e. virtual sites).
+                moved = np.where(np.any(xyzs != self.invdist_xyzs, axis=(0, 2)))[0]
+                invdists = self.invdist_base
+                if len(moved) > 0:
+                    logger.info("\rUpdating the distance matrix for %i moved particles%s" % (len(moved), " "*30))
+                    invdists = invdists.copy()
+            else:
+                moved = np.arange(xyzs.shape[1])
+                invdists = np.empty((xyzs.shape[0], self.nesp, xyzs.shape[1]), dtype=np.float32 if self.invdist_float32 else float)
+                logger.info("\rPreparing the distance matrix... it will have %i * %i * %i = %i elements" % (invdists.shape + (invdists.size,)))
+            if len(moved) > 0:
+                for sn, (espset, xyz) in enumerate(zip(self.espxyz, xyzs)):
+                    invdists[sn][:, moved] = esp_inverse_distances(np.reshape(espset, (-1, 3)), xyz[moved])
+            # The saved matrix is never modified in place, as callers may hold on to it.
+            self.invdist_xyzs = xyzs
+            self.invdist_base = invdists
         for i in self.pgrad:
             if 'VSITE' in self.FF.plist[i]:
                 self.save_vmvals[i] = mvals[i]
         self.buildx = False
-        return np.array(invdists)
+        return invdists
 
     def compute_netforce_torque(self, xyz, force, QM=False):
         # Convert an array of (3 * n_atoms) atomistic forces
@@ -363,28 +425,15 @@ class AbInitio(Target):
         with horrible weights, InfoContent is closer to one.
 
         """
-        # Parse the qdata.txt file
-        for line in open(os.path.join(self.root,self.qfnm)):
-            sline = line.split()
-            if len(sline) == 0: continue
-            elif sline[0] == 'ENERGY':
-                self.eqm.append(float(sline[1]))
-            elif sline[0] in ['FORCES', 'GRADIENT']:
-                self.fqm.append([float(i) for i in sline[1:]])
-            elif sline[0] == 'ESPXYZ':
-                self.espxyz.append([float(i) for i in sline[1:]])
-            elif sline[0] == 'ESPVAL':
-                self.espval.append([float(i) for i in sline[1:]])
-
-        # Ensure that all lists are of length self.ns
-        self.eqm = self.eqm[:self.ns]
-        self.fqm = self.fqm[:self.ns]
-        self.espxyz = self.espxyz[:self.ns]
-        self.espval = self.espval[:self.ns]
-
-        # Turn everything into arrays, convert to kJ/mol, and subtract the mean energy from the energy arrays
-        self.eqm = np.array(self.eqm)
-        self.eqm *= eqcgmx
+        # Parse the qdata.txt file, or memory-map its binary cache
+        qdata = load_qdata(os.path.join(self.root,self.qfnm), cache=self.qdata_cache)
+
+        # Ensure that all arrays are of length self.ns, convert to kJ/mol, and subtract the mean energy from the energy arrays
+        # (the unit conversions make copies, leaving the cached arrays untouched)
+        self.eqm = qdata['qm_energies'][:self.ns] * eqcgmx if 'qm_energies' in qdata else np.array([])
+        self.fqm = qdata['qm_grads'][:self.ns] if 'qm_grads' in qdata else []
+        self.espxyz = qdata['qm_espxyzs'][:self.ns] if 'qm_espxyzs' in qdata else []
+        self.espval = qdata['qm_espvals'][:self.ns] if 'qm_espvals' in qdata else []
         if self.energy_mode == 'qm_minimum':
             self.eqm  -= np.min(self.eqm)
             self.smin  = np.argmin(self.eqm)
@@ -397,8 +446,7 @@ class AbInitio(Target):
             raise RuntimeError('Not sure what to do with energy_mode %s' % self.energy_mode)
 
         if len(self.fqm) > 0:
-            self.fqm = np.array(self.fqm)
-            self.fqm *= fqcgmx
+            self.fqm = np.array(self.fqm) * fqcgmx
             self.qmatoms = list(range(int(self.fqm.shape[1]/3)))
         else:
             logger.info("QM forces are not present, only fitting energies.\n")
@@ -569,6 +617,53 @@ class AbInitio(Target):
         else:
             return self.energy_one()
 
+    def fd_energy_force(self, mvals, M0):
+        """
+        Finite-difference derivatives of the energies and forces with
+        respect to the parameters in self.pgrad, generated one parameter
+        at a time so that the caller need not store all of them.
+
+        @param[in] mvals Mathematical parameter values
+        @param[in] M0 Energies and forces at mvals (from energy_force_transform)
+        @return Generator of (p, dM_p) where dM_p has the shape of M0
+        """
+        if self.fd_processes > 1:
+            for p, dM_p in self.fd_energy_force_parallel(mvals, M0):
+                yield p, dM_p
+            return
+        def callM(mvals_):
+            logger.debug("\r")
+            pvals = self.FF.make(mvals_, write=not self.engine.ff_in_memory)
+            return self.energy_force_transform()
+        for p in self.pgrad:
+            yield p, f12d3p(fdwrap(callM, mvals, p), h = self.h, f0 = M0)[0]
+
+    def fd_energy_force_parallel(self, mvals, M0):
+        """
+        Finite-difference derivatives of the energies and forces with
+        respect to the parameters in self.pgrad, where the displaced
+        parameter sets are evaluated as one batch by a pool of
+        fd_processes local processes (see engine.batch_map).
+
+        The workers only return the displaced energies and forces;
+        the stencils are applied here in the same order as the serial code.
+
+        @param[in] mvals Mathematical parameter values
+        @param[in] M0 Energies and forces at mvals (from energy_force_transform)
+        @return Generator of (p, dM_p) as in fd_energy_force
+        """
+        def callM(mvals_):
+            self.FF.make(mvals_, write=not self.engine.ff_in_memory)
+            return self.energy_force_transform()
+        # The results arrive in order, so each parameter is finished
+        # as soon as both of its displacements are in.
+        Displaced = {}
+        for (p, dx), M in self.fd_batch(callM, mvals):
+            Displaced[dx] = M
+            if len(Displaced) == 2:
+                yield p, f12d3p(lambda dx: Displaced[dx], h = self.h, f0 = M0)[0]
+                Displaced = {}
+
     def get_energy_force(self, mvals, AGrad=False, AHess=False):
         """
         LPW 7-13-2016
@@ -658,20 +753,20 @@ class AbInitio(Target):
             AGrad = False
             AHess = False
         # Sum of all the weights
-        Z       = 0.0
+        Z       = np.sum(self.boltz_wts)
         # All vectors with NCP1 elements are ordered as
         # [E F_1x F_1y F_1z F_2x ... NF_1x NF_1y ... TQ_1x TQ_1y ... ]
-        # Vector of QM-quantities
-        Q = np.zeros(NCP1)
+        # QM-quantities for all snapshots
+        Q_all = np.zeros((NS,NCP1))
+        Q_all[:,0] = self.eqm
+        if self.force:
+            Q_all[:,1:] = self.fref
         # Mean quantities over the trajectory
         M0    = np.zeros(NCP1)
         Q0    = np.zeros(NCP1)
         X0    = np.zeros(NCP1)
         # The mean squared QM-quantities
         QQ0    = np.zeros(NCP1)
-        # Derivatives of the MM-quantity
-        M_p     = np.zeros((NP,NCP1))
-        M_pp    = np.zeros((NP,NCP1))
         # Means of gradients
         M0_p  = np.zeros((NP,NCP1))
         M0_pp = np.zeros((NP,NCP1))
@@ -690,9 +785,19 @@ class AbInitio(Target):
         # This saves time because we don't need to execute the external program
         # once per snapshot, but requires memory.
         M_all = np.zeros((NS,NCP1))
-        if AGrad and self.all_at_once:
-            dM_all = np.zeros((NS,NP,NCP1))
-            ddM_all = np.zeros((NS,NP,NCP1))
+        # The derivatives for all snapshots are only stored for the Hessian;
+        # note the layout (NP,NS,NCP1) so each parameter is written contiguously.
+        dM_all = None
+        if AHess and self.all_at_once:
+            dM_size = NS*NP*NCP1*np.dtype(float).itemsize
+            if dM_size > self.max_dm_memory*1024**2:
+                # The file has no name, so it is removed when it is closed,
+                # including when an exception is raised before the end.
+                dM_file = tempfile.TemporaryFile(prefix='dM_all.', suffix='.dat', dir=os.getcwd())
+                logger.info("Storing %.1f MB of finite-difference derivatives in a temporary file in %s\n" % (dM_size/1024**2, os.getcwd()))
+                dM_all = np.memmap(dM_file, dtype=float, mode='w+', shape=(NP,NS,NCP1))
+            else:
+                dM_all = np.zeros((NP,NS,NCP1))
         #==============================================================#
         #             STEP 2: Loop through the snapshots.              #
         #==============================================================#
@@ -701,101 +806,80 @@ class AbInitio(Target):
             M_all = self.energy_force_transform()
             if self.energy_mode == 'qm_minimum':
                 M_all[:, 0] -= M_all[self.smin, 0]
-            if AGrad or AHess:
-                def callM(mvals_):
-                    logger.debug("\r")
-                    pvals = self.FF.make(mvals_)
-                    return self.energy_force_transform()
-                for p in self.pgrad:
-                    dM_all[:,p,:], ddM_all[:,p,:] = f12d3p(fdwrap(callM, mvals, p), h = self.h, f0 = M_all)
-                    if self.energy_mode == 'qm_minimum':
-                        dM_all[:, p, 0] -= dM_all[self.smin, p, 0]
-                        ddM_all[:, p, 0] -= ddM_all[self.smin, p, 0]
-        if self.force and not in_fd():
-            self.maxfatom = -1
-            self.maxfshot = -1
-            self.maxdf = 0.0
-        for i in range(NS):
-            if i % 100 == 0:
-                logger.debug("\rIncrementing quantities for snapshot %i\r" % i)
-            # Build Boltzmann weights and increment partition function.
-            P   = self.boltz_wts[i]
-            Z  += P
-            # Load reference (QM) data
-            Q[0] = self.eqm[i]
-            if self.force:
-                Q[1:] = self.fref[i,:].copy()
-            QQ     = Q*Q
-            # Call the simulation software to get the MM quantities
-            # (or load from M_all array)
-            if self.all_at_once:
-                M = M_all[i]
+        def increment(rows, dM=None, pidx=None):
+            # Add the sums over a block of snapshots to the objective function terms.
+            # If pidx is given, dM holds the derivatives for only these parameters
+            # and only the gradient terms are added.
+            X = M_all[rows] - Q_all[rows]
+            # For asymmetric fit, MM energies lower than QM are given a boost factor
+            boost = np.where(X[:,0] < 0.0, self.energy_asymmetry, 1.0)
+            SPX_, SPX_p_, M0_p_, SPX_pq_ = energy_force_sums(self.boltz_wts[rows], boost, X, dM, AHess and pidx is None)
+            if pidx is not None:
+                SPX_p[pidx] += SPX_p_
+                M0_p[pidx,0] += M0_p_
+                return
+            SPX[:] += SPX_
+            if dM is not None:
+                SPX_p[:] += SPX_p_
+                M0_p[:,0] += M0_p_
+            if SPX_pq_ is not None:
+                SPX_pq[:] += SPX_pq_
+        if self.all_at_once:
+            # Blocks of snapshots bound the size of the temporary arrays.
+            if self.snapshot_chunk > 0:
+                nblk = self.snapshot_chunk
             else:
+                nblk = max(1, ACCUMULATE_CHUNK // (NP*NCP1))
+            blocks = [slice(i, i+nblk) for i in range(0, NS, nblk)]
+            if AGrad:
+                for p, dM_p in self.fd_energy_force(mvals, M_all):
+                    if self.energy_mode == 'qm_minimum':
+                        dM_p[:, 0] -= dM_p[self.smin, 0]
+                    if AHess:
+                        dM_all[p] = dM_p
+                    else:
+                        # The gradient needs one parameter at a time, so it is added up right away.
+                        for rows in blocks:
+                            increment(rows, dM_p[rows,np.newaxis,:], [p])
+            for rows in blocks:
+                logger.debug("\rIncrementing quantities for snapshot %i\r" % rows.start)
+                increment(rows, np.array(dM_all[:,rows,:]).transpose(1,0,2) if AHess else None)
+            if isinstance(dM_all, np.memmap):
+                del dM_all
+                dM_file.close()
+        else:
+            for i in range(NS):
                 if i % 100 == 0:
                     logger.debug("Shot %i\r" % i)
-                M = self.energy_force_transform_one(i)
-                M_all[i,:] = M.copy()
-            # MM - QM difference
-            X     = M-Q
-            # For asymmetric fit, MM energies lower than QM are given a boost factor
-            boost = self.energy_asymmetry if X[0] < 0.0 else 1.0
-            # Save information about forces
-            if self.force:
-                # Norm-squared of force differences for each atom
-                dfrc2 = norm2(M-Q, 1, nat)
-                if not in_fd() and np.max(dfrc2) > self.maxdf:
-                    self.maxdf = np.sqrt(np.max(dfrc2))
-                    self.maxfatom = np.argmax(dfrc2)
-                    self.maxfshot = i
-            # Increment the average quantities
-            # The [0] indicates that we are fitting the RMS force and not the RMSD
-            # (without the covariance, subtracting a mean force doesn't make sense.)
-            # The rest of the array is empty.
-            M0[0] += P*M[0]
-            Q0[0] += P*Q[0]
-            X0[0] += P*X[0]
-            # We store all elements of the mean-squared QM quantities.
-            QQ0 += P*QQ
-            # Increment the objective function.
-            Xi     = X**2
-            Xi[0] *= boost
-            # SPX contains the sum over snapshots
-            SPX += P * Xi
-            #==============================================================#
-            #      STEP 2a: Increment gradients and mean quantities.       #
-            #==============================================================#
-            for p in self.pgrad:
-                if not AGrad: continue
-                if self.all_at_once:
-                    M_p[p] = dM_all[i, p]
-                    M_pp[p] = ddM_all[i, p]
-                else:
+                # Call the simulation software to get the MM quantities
+                M_all[i,:] = self.energy_force_transform_one(i)
+                dM = np.zeros((1,NP,NCP1))
+                if AGrad:
                     def callM(mvals_):
                         if i % 100 == 0:
                             logger.debug("\r")
                         pvals = self.FF.make(mvals_)
                         return self.energy_force_transform_one(i)
-                    M_p[p],M_pp[p] = f12d3p(fdwrap(callM, mvals, p), h = self.h, f0 = M)
-                if all(M_p[p] == 0): continue
-                M0_p[p][0]  += P * M_p[p][0]
-                Xi_p        = 2 * X * M_p[p]
-                Xi_p[0]    *= boost
-                SPX_p[p] += P * Xi_p
-                if not AHess: continue
-                if self.all_at_once:
-                    M_pp[p] = ddM_all[i, p]
-                # This formula is more correct, but perhapsively convergence is slower.
-                #Xi_pq       = 2 * (M_p[p] * M_p[p] + X * M_pp[p])
-                # Gauss-Newton formula for approximate Hessian
-                Xi_pq       = 2 * (M_p[p] * M_p[p])
-                Xi_pq[0]   *= boost
-                SPX_pq[p,p] += P * Xi_pq
-                for q in range(p):
-                    if all(M_p[q] == 0): continue
-                    if q not in self.pgrad: continue
-                    Xi_pq          = 2 * M_p[p] * M_p[q]
-                    Xi_pq[0]      *= boost
-                    SPX_pq[p,q] += P * Xi_pq
+                    for p in self.pgrad:
+                        dM[0,p] = f12d3p(fdwrap(callM, mvals, p), h = self.h, f0 = M_all[i])[0]
+                    # Undo the last parameter displacement before the next snapshot.
+                    pvals = self.FF.make(mvals)
+                increment(slice(i, i+1), dM if AGrad else None)
+        # Increment the average quantities
+        # The [0] indicates that we are fitting the RMS force and not the RMSD
+        # (without the covariance, subtracting a mean force doesn't make sense.)
+        # The rest of the array is empty.
+        M0[0] = np.dot(self.boltz_wts, M_all[:,0])
+        Q0[0] = np.dot(self.boltz_wts, Q_all[:,0])
+        X0[0] = M0[0] - Q0[0]
+        # We store all elements of the mean-squared QM quantities.
+        QQ0 = np.dot(self.boltz_wts, Q_all**2)
+        # Save information about forces
+        if self.force and not in_fd():
+            # Norm-squared of force differences for each atom
+            dfrc2 = np.sum(((M_all - Q_all)[:,1:3*nat+1].reshape(NS, nat, 3))**2, axis=2)
+            self.maxfshot, self.maxfatom = np.unravel_index(np.argmax(dfrc2), dfrc2.shape)
+            self.maxdf = np.sqrt(dfrc2[self.maxfshot, self.maxfatom])
 
         #==============================================================#
         #         STEP 2b: Write energies and forces to disk.          #
@@ -989,7 +1073,8 @@ class AbInitio(Target):
         return Answer
 
     def get_resp(self, mvals, AGrad=False, AHess=False):
-        """ Electrostatic potential fitting.  Implements the RESP objective function.  (In Python so obviously not optimized.) """
+        """ Electrostatic potential fitting.  Implements the RESP objective function.  Unless there are virtual site
+        parameters, this uses the normal equations of the ESP fit, which is linear in the charges. """
         if (self.w_resp == 0.0):
             AGrad = False
             AHess = False
@@ -1027,9 +1112,7 @@ class AbInitio(Target):
             #     dqPdqM.append(f12d3p(fdwrap(new_charges,mvals,i), h = self.h)[0])
             # dqPdqM = np.matrix(dqPdqM).T
             dqPdqM = np.array([(f12d3p(fdwrap(new_charges,mvals,i), h = self.h, f0 = charge0)[0] if i in self.pgrad else np.zeros_like(charge0)) for i in range(NP)]).T
-        xyzs = np.array(self.mol.xyzs)
         espqvals = np.array(self.espval)
-        espxyz   = np.array(self.espxyz)
 
         ddVdqPdVS = {}
         # Second derivative of the inverse distance matrix with respect to the virtual site position
@@ -1038,31 +1121,45 @@ class AbInitio(Target):
             for p in self.pgrad:
                 if 'VSITE' in self.FF.plist[p]:
                     ddVdqPdVS[p], dddVdqPdVS2[p] = f12d3p(fdwrap(self.build_invdist,mvals,p), h = self.h, f0 = self.invdists)
-        X = 0
-        Q = 0
-        D = 0
         G = np.zeros(NP)
         H = np.zeros((NP, NP))
-        for i in range(self.ns):
-            P   = self.boltz_wts[i]
-            Z  += P
-            dVdqP   = np.array(self.invdists[i])
-            espqval = espqvals[i]
-            espmval = np.dot(dVdqP, col(new_charges(mvals)))
-            desp    = flat(espmval) - espqval
-            X      += P * np.dot(desp, desp) / self.nesp
-            Q      += P * np.dot(espqval, espqval) / self.nesp
-            D      += P * (np.dot(espqval, espqval) / self.nesp - (np.sum(espqval) / self.nesp)**2)
+        if len(ddVdqPdVS) == 0:
+            # The ESP is linear in the charges, so without virtual site derivatives the objective
+            # function only needs the normal equations, which are built once for each set of geometries.
+            if self.resp_normal is None or self.resp_normal[0] is not self.invdists or not np.array_equal(self.resp_normal[1], self.boltz_wts):
+                self.resp_normal = (self.invdists, np.array(self.boltz_wts)) + resp_normal_equations(self.boltz_wts, self.invdists, espqvals)
+            Z, A, b, c, D = self.resp_normal[2:]
+            Aq = np.dot(A, charge0)
+            X = (np.dot(charge0, Aq) - 2 * np.dot(b, charge0) + c) / self.nesp
+            Q = c / self.nesp
             if AGrad:
-                dVdqM   = np.dot(dVdqP, dqPdqM).T
-                for p, vsd in ddVdqPdVS.items():
-                    dVdqM[p,:] += flat(np.dot(vsd[i], col(new_charges(mvals))))
-                G      += flat(P * 2 * np.dot(dVdqM, col(desp))) / self.nesp
+                G = 2 * np.dot(dqPdqM.T, Aq - b) / self.nesp
                 if AHess:
-                    d2VdqM2 = np.zeros(dVdqM.shape)
-                    for p, vsd in dddVdqPdVS2.items():
-                        d2VdqM2[p,:] += flat(np.dot(vsd[i], col(new_charges(mvals))))
-                    H      += np.array(P * 2 * (np.dot(dVdqM, dVdqM.T) + np.dot(d2VdqM2, col(desp)))) / self.nesp
+                    H = 2 * np.dot(dqPdqM.T, np.dot(A, dqPdqM)) / self.nesp
+        else:
+            X = 0
+            Q = 0
+            D = 0
+            for i in range(self.ns):
+                P   = self.boltz_wts[i]
+                Z  += P
+                dVdqP   = np.array(self.invdists[i])
+                espqval = espqvals[i]
+                espmval = np.dot(dVdqP, col(charge0))
+                desp    = flat(espmval) - espqval
+                X      += P * np.dot(desp, desp) / self.nesp
+                Q      += P * np.dot(espqval, espqval) / self.nesp
+                D      += P * (np.dot(espqval, espqval) / self.nesp - (np.sum(espqval) / self.nesp)**2)
+                if AGrad:
+                    dVdqM   = np.dot(dVdqP, dqPdqM).T
+                    for p, vsd in ddVdqPdVS.items():
+                        dVdqM[p,:] += flat(np.dot(vsd[i], col(charge0)))
+                    G      += flat(P * 2 * np.dot(dVdqM, col(desp))) / self.nesp
+                    if AHess:
+                        d2VdqM2 = np.zeros(dVdqM.shape)
+                        for p, vsd in dddVdqPdVS2.items():
+                            d2VdqM2[p,:] += flat(np.dot(vsd[i], col(charge0)))
+                        H      += np.array(P * 2 * (np.dot(dVdqM, dVdqM.T) + np.dot(d2VdqM2, col(desp)))) / self.nesp
         # Redundant but we keep it anyway
         D /= Z
         X /= Z
@@ -1127,6 +1224,55 @@ class AbInitio(Target):
             self.objective = Answer['X']
         return Answer
 
+## Approximate number of array elements in the temporary arrays
+## used for adding up the objective function over blocks of snapshots.
+ACCUMULATE_CHUNK = 2**22
+
+def energy_force_sums(P, boost, X, dM=None, hess=False):
+    """
+    Weighted sums over a block of snapshots that make up the energy and
+    force objective function and its Gauss-Newton derivatives (see
+    AbInitio.get_energy_force), using whole-array operations.
+
+    Parameters
+    ----------
+    P : np.ndarray
+        Boltzmann weights of the snapshots, shape (ns,)
+    boost : np.ndarray
+        Factor multiplying the energy term of each snapshot, shape (ns,)
+    X : np.ndarray
+        Differences between MM and QM quantities, shape (ns, ncp1)
+    dM : np.ndarray, optional
+        Parameter derivatives of the MM quantities, shape (ns, np, ncp1)
+    hess : bool, default=False
+        Also compute the sums for the approximate Hessian
+
+    Returns
+    -------
+    SPX : np.ndarray
+        Sum of the weighted squared differences, shape (ncp1,)
+    SPX_p : np.ndarray or None
+        Its derivatives, shape (np, ncp1)
+    M0_p : np.ndarray or None
+        Weighted sum of the energy derivatives, shape (np,)
+    SPX_pq : np.ndarray or None
+        Gauss-Newton second derivatives, shape (np, np, ncp1)
+    """
+    # Weights of each element; the energy column is boosted.
+    PB = np.repeat(P[:,np.newaxis], X.shape[1], axis=1)
+    PB[:,0] *= boost
+    SPX = np.sum(PB*X**2, axis=0)
+    if dM is None:
+        return SPX, None, None, None
+    SPX_p = 2*np.einsum('ik,ipk->pk', PB*X, dM)
+    M0_p = np.dot(P, dM[:,:,0])
+    SPX_pq = None
+    if hess:
+        # A weighted Gram matrix of the derivatives for each element.
+        dMT = dM.transpose(2,1,0)
+        SPX_pq = 2*np.matmul(dMT*PB.T[:,np.newaxis,:], dMT.transpose(0,2,1)).transpose(1,2,0)
+    return SPX, SPX_p, M0_p, SPX_pq
+
 def compute_objective_part(SPX,QQ0,Q0,Z,a,n,energy=False,subtract_mean=False,divide=1,L=None,R=None,L2=None,R2=None):
     # Divide by Z to normalize
     XiZ       = SPX[a:a+n]/Z
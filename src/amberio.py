@@ -649,6 +649,8 @@ class FrcMod_Reader(BaseReader):
             # The suffix of the parameter ID is built from the atom    #
             # types/classes involved in the interaction.
             self.suffix = ''.join(self.atom)
+            # The atom types are looked up in the whole system.
+            self.molatom = (None, [a.strip() for a in '-'.join(self.atom).split('-') if len(a.strip()) > 0])
 
 #=============================================================================================
 # AMBER parmtop loader (from 'zander', by Randall J. Radmer)
@@ -1299,6 +1301,7 @@ class AMBER(Engine):
             self.AtomLists['Mass'] = prmtop.getMasses()
             self.AtomLists['ResidueNumber'] = [prmtop.getResidueNumber(i) for i in range(na)]
             self.AtomLists['ResidueName'] = [prmtop.getResidueLabel(i) for i in range(na)]
+            self.AtomLists['AtomType'] = [i.strip() for i in prmtop.getAtomTypes()]
             # AMBER virtual sites don't have to have mass zero; this is my
             # best guess at figuring out where they are.
             self.AtomMask = [self.AtomLists['Mass'][i] >= 1.0  or self.AtomLists['Name'][i] != 'LP' for i in range(na)]
@@ -1321,6 +1324,13 @@ class AMBER(Engine):
                     for i in g.nodes():
                         self.AtomLists['MoleculeNumber'][i] = ig
             
+    def topology_labels(self):
+        """ Return the molecule names in the force field .mol2 files and
+        the atom types in the prmtop file. """
+        if not hasattr(self, 'FF') or 'AtomType' not in self.AtomLists: return None
+        molecules = set([self.FF.Readers[fnm].mol for fnm in self.FF.amber_mol2 if fnm in self.mol2])
+        return molecules, set(self.AtomLists['AtomType']) | set(['X'])
+
     def get_charges(self):
         self.leap(read_prmtop=True, count_mols=False)
         return np.array(self.AtomLists['Charge'])
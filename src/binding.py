@@ -181,7 +181,6 @@ class BindingEnergy(Target):
             printcool_dictionary(self.RMSDDict,title="Geometry Optimized Systems (Angstrom), Objective = %.5e\n %-38s %11s %11s" % (self.rmsd_part, "System", "RMSD", "Term"), keywidth=45)
 
     def get(self, mvals, AGrad=False, AHess=False):
-        Answer = {'X':0.0, 'G':np.zeros(self.FF.np), 'H':np.zeros((self.FF.np, self.FF.np))}
         self.PrintDict = OrderedDict()
         self.RMSDDict = OrderedDict()
         EnergyDict = OrderedDict()
@@ -242,14 +241,9 @@ class BindingEnergy(Target):
 
         dV = np.zeros((self.FF.np,len(V)))
         if AGrad or AHess:
-            for p in self.pgrad:
-                dV[p,:], _ = f12d3p(fdwrap(compute, mvals, p), h = self.h, f0 = V)
+            dV = self.fd_derivatives(compute, mvals, V)
 
-        Answer['X'] = np.dot(V,V)
-        for p in self.pgrad:
-            Answer['G'][p] = 2*np.dot(V, dV[p,:])
-            for q in self.pgrad:
-                Answer['H'][p,q] = 2*np.dot(dV[p,:], dV[q,:])
+        Answer = self.gauss_newton(V, dV)
 
         if not in_fd():
             self.objective = Answer['X']
@@ -162,6 +162,10 @@ def main():
     h = TgtOpts['h']
     # Active parameters to differentiate
     pgrad = TgtOpts['pgrad']
+    # Local processes for the finite-difference energy derivatives;
+    # forked processes cannot use the GPU that the parent process has initialized.
+    fd_processes = 1 if EngOpts.get('platname') in ['CUDA', 'OpenCL'] else TgtOpts.get('fd_processes', 1)
+    parameter_dependence = TgtOpts.get('parameter_dependence', 0)
     # Create instances of the MD Engine objects.
     Engine = EngineClass(**EngOpts)
     click() # Start timer.
@@ -171,7 +175,7 @@ def main():
     # In the future, the properties will be stored as data inside the object
     Results = Engine.molecular_dynamics(**MDOpts)
     if AGrad:
-        Results['Potential_Derivatives'] = energy_derivatives(Engine, FF, mvals, h, pgrad, dipole=False)['potential']
+        Results['Potential_Derivatives'] = energy_derivatives(Engine, FF, mvals, h, pgrad, dipole=False, processes=fd_processes, dependence=parameter_dependence)['potential']
     # Set up engine and calculate the potential in the other phase.
     EngOpts_ = deepcopy(EngOpts)
     EngOpts_['implicit_solvent'] = not EngOpts['implicit_solvent']
@@ -180,7 +184,7 @@ def main():
     Energy_ = Engine_.energy()
     Results_ = {'Potentials' : Energy_}
     if AGrad:
-        Derivs_ = energy_derivatives(Engine_, FF, mvals, h, pgrad, dipole=False)['potential']
+        Derivs_ = energy_derivatives(Engine_, FF, mvals, h, pgrad, dipole=False, processes=fd_processes, dependence=parameter_dependence)['potential']
         Results_['Potential_Derivatives'] = Derivs_
     # Calculate the hydration energy of each snapshot and its parametric derivatives.
     if EngOpts['implicit_solvent']:
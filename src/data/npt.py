@@ -28,8 +28,9 @@ import numpy as np
 from copy import deepcopy
 from collections import namedtuple, OrderedDict
 from forcebalance.forcefield import FF
-from forcebalance.nifty import col, flat, lp_dump, lp_load, printcool, printcool_dictionary, statisticalInefficiency, which, _exec, isint, wopen, click
+from forcebalance.nifty import col, flat, lp_dump, lp_load, printcool, printcool_dictionary, statisticalInefficiency, statisticalInefficiencies, bootstrap_stderr, save_result, which, _exec, isint, wopen, click
 from forcebalance.finite_difference import fdwrap, f1d2p, f12d3p, f1d7p, in_fd
+from forcebalance.engine import fd_energy_derivatives
 from forcebalance.molecule import Molecule
 from forcebalance.output import getLogger
 logger = getLogger(__name__)
@@ -42,6 +43,8 @@ parser = argparse.ArgumentParser()
 parser.add_argument('engine', help='MD program that we are using; choose "openmm", "tinker", "amber" or "gromacs"')
 parser.add_argument('temperature',type=float, help='Temperature (K)')
 parser.add_argument('pressure',type=float, help='Pressure (Atm)')
+parser.add_argument('--liquid_md_steps', type=int, help='Number of liquid production steps (overrides liquid_md_steps in the target options)')
+parser.add_argument('--gas_md_steps', type=int, help='Number of gas production steps (overrides gas_md_steps in the target options)')
 
 args = parser.parse_args()
 
@@ -101,6 +104,9 @@ def bzavg(obs,boltz):
         else:
             raise Exception('The dimensions are wrong!')
     elif obs.ndim == 1:
+        if boltz.ndim == 2:
+            # Several sets of weights (e.g. bootstrap resamples), one in each row.
+            return np.dot(boltz,obs)/np.sum(boltz,axis=1)
         return np.dot(obs,boltz)/sum(boltz)
     else:
         raise Exception('The number of dimensions can only be 1 or 2!')
@@ -120,20 +126,24 @@ def PrintEDA(EDA, N):
 #|            and properties                 |#
 #=============================================#
 
-def energy_derivatives(engine, FF, mvals, h, pgrad, length, AGrad=True, dipole=False):
+def energy_derivatives(engine, FF, mvals, h, pgrad, length, AGrad=True, dipole=False, processes=1, dependence=True):
 
     """
     Compute the first and second derivatives of a set of snapshot
     energies with respect to the force field parameters.
 
     This basically calls the finite difference subroutine on the
-    energy_driver subroutine also in this script.
+    energy_driver subroutine also in this script.  The displaced
+    parameter sets are evaluated as one batch, spread over several
+    processes if requested (see engine.fd_energy_derivatives).
 
     @param[in] mvals Mathematical parameter values
     @param[in] h Finite difference step size
     @param[in] phase The phase (liquid, gas) to perform the calculation on
     @param[in] AGrad Switch to turn derivatives on or off; if off, return all zeros
     @param[in] dipole Switch for dipole derivatives.
+    @param[in] processes Number of local processes for the displaced parameter sets
+    @param[in] dependence Skip the parameters that cannot affect the system in the engine
     @return G First derivative of the energies in a N_param x N_coord array
     @return GDx First derivative of the box dipole moment x-component in a N_param x N_coord array
     @return GDy First derivative of the box dipole moment y-component in a N_param x N_coord array
@@ -146,24 +156,11 @@ def energy_derivatives(engine, FF, mvals, h, pgrad, length, AGrad=True, dipole=F
     GDz      = np.zeros((FF.np,length))
     if not AGrad:
         return G, GDx, GDy, GDz
-    def energy_driver(mvals_):
-        FF.make(mvals_)
-        if dipole:
-            return engine.energy_dipole()
-        else:
-            return engine.energy()
-
-    ED0      = energy_driver(mvals)
-    for i in pgrad:
-        logger.info("%i %s\r" % (i, (FF.plist[i] + " "*30)))
-        EDG, _   = f12d3p(fdwrap(energy_driver,mvals,i),h,f0=ED0)
-        if dipole:
-            G[i,:]   = EDG[:,0]
-            GDx[i,:] = EDG[:,1]
-            GDy[i,:] = EDG[:,2]
-            GDz[i,:] = EDG[:,3]
-        else:
-            G[i,:]   = EDG[:]
+    _, EDG = fd_energy_derivatives(engine, FF, mvals, h, pgrad, dipole, processes, dependence)
+    if dipole:
+        G, GDx, GDy, GDz = [EDG[:,:,i] for i in range(4)]
+    else:
+        G = EDG
     return G, GDx, GDy, GDz
 
 def property_derivatives(engine, FF, mvals, h, pgrad, kT, property_driver, property_kwargs, AGrad=True):
@@ -279,12 +276,12 @@ def main():
     pgrad = TgtOptions['pgrad']
     # MD options; time step (fs), production steps, equilibration steps, interval for saving data (ps)
     liquid_timestep = TgtOptions['liquid_timestep']
-    liquid_nsteps = TgtOptions['liquid_md_steps']
+    liquid_nsteps = args.liquid_md_steps if args.liquid_md_steps is not None else TgtOptions['liquid_md_steps']
     liquid_nequil = TgtOptions['liquid_eq_steps']
     liquid_intvl = TgtOptions['liquid_interval']
     liquid_fnm = TgtOptions['liquid_coords']
     gas_timestep = TgtOptions['gas_timestep']
-    gas_nsteps = TgtOptions['gas_md_steps']
+    gas_nsteps = args.gas_md_steps if args.gas_md_steps is not None else TgtOptions['gas_md_steps']
     gas_nequil = TgtOptions['gas_eq_steps']
     gas_intvl = TgtOptions['gas_interval']
     gas_fnm = TgtOptions['gas_coords']
@@ -297,6 +294,9 @@ def main():
     nbarostat = TgtOptions.get('n_mcbarostat', 25)
     anisotropic = TgtOptions.get('anisotropic_box', 0)
     minimize = TgtOptions.get('minimize_energy', 1)
+    block_bootstrap = TgtOptions.get('block_bootstrap', 0)
+    fd_processes = TgtOptions.get('fd_processes', 1)
+    parameter_dependence = TgtOptions.get('parameter_dependence', 0)
 
     # Print all options.
     printcool_dictionary(TgtOptions, title="Options from ForceBalance")
@@ -496,11 +496,17 @@ def main():
     # Compute the energy and dipole derivatives.
     printcool("Condensed phase energy and dipole derivatives\nInitializing array to length %i" % len(Energies), color=4, bold=True)
     click()
-    G, GDx, GDy, GDz = energy_derivatives(Liquid, FF, mvals, h, pgrad, len(Energies), AGrad, dipole=True)
+    # Forked processes cannot use the GPU that the parent process has initialized, which
+    # includes the gas phase derivatives because they come after those of the liquid.
+    if any([EngOpts[i].get("platname") in ['CUDA', 'OpenCL'] for i in EngOpts]):
+        fd_processes = 1
+    G, GDx, GDy, GDz = energy_derivatives(Liquid, FF, mvals, h, pgrad, len(Energies), AGrad, dipole=True,
+                                          processes=fd_processes, dependence=parameter_dependence)
     logger.info("Condensed phase energy derivatives took %.3f seconds\n" % click())
     click()
     printcool("Gas phase energy derivatives", color=4, bold=True)
-    mG, _, __, ___ = energy_derivatives(Gas, FF, mvals, h, pgrad, len(mEnergies), AGrad, dipole=False)
+    mG, _, __, ___ = energy_derivatives(Gas, FF, mvals, h, pgrad, len(mEnergies), AGrad, dipole=False,
+                                        processes=fd_processes, dependence=parameter_dependence)
     logger.info("Gas phase energy derivatives took %.3f seconds\n" % click())
 
     #==============================================#
@@ -586,12 +592,7 @@ def main():
             v_ = kwargs['v_']
         return 1/(kT*T) * (bzavg(h_*v_,b)-bzavg(h_,b)*bzavg(v_,b))/bzavg(v_,b)
     Alpha = calc_alpha(None, **{'h_':H, 'v_':V})
-    Alphaboot = []
-    for i in range(numboots):
-        boot = np.random.randint(L,size=L)
-        Alphaboot.append(calc_alpha(None, **{'h_':H[boot], 'v_':V[boot]}))
-    Alphaboot = np.array(Alphaboot)
-    Alpha_err = np.std(Alphaboot) * max([np.sqrt(statisticalInefficiency(V)),np.sqrt(statisticalInefficiency(H))])
+    Alpha_err = bootstrap_stderr(lambda b: calc_alpha(b, **{'h_':H, 'v_':V}), L, max(statisticalInefficiencies(np.column_stack((V, H)))), numboots, block_bootstrap)
 
     # Thermal expansion coefficient analytic derivative
     GAlpha1 = -1 * Beta * deprod(H*V) * avg(V) / avg(V)**2
@@ -618,12 +619,7 @@ def main():
             v_ = kwargs['v_']
         return bar_unit / kT * (bzavg(v_**2,b)-bzavg(v_,b)**2)/bzavg(v_,b)
     Kappa = calc_kappa(None,**{'v_':V})
-    Kappaboot = []
-    for i in range(numboots):
-        boot = np.random.randint(L,size=L)
-        Kappaboot.append(calc_kappa(None,**{'v_':V[boot]}))
-    Kappaboot = np.array(Kappaboot)
-    Kappa_err = np.std(Kappaboot) * np.sqrt(statisticalInefficiency(V))
+    Kappa_err = bootstrap_stderr(lambda b: calc_kappa(b, **{'v_':V}), L, statisticalInefficiency(V), numboots, block_bootstrap)
 
     # Isothermal compressibility analytic derivative
     Sep = printcool("Isothermal compressibility:  % .4e +- %.4e bar^-1\nAnalytic Derivative:" % (Kappa, Kappa_err))
@@ -651,12 +647,7 @@ def main():
         Cp_ *= 1000 / 4.184
         return Cp_
     Cp = calc_cp(None,**{'h_':H})
-    Cpboot = []
-    for i in range(numboots):
-        boot = np.random.randint(L,size=L)
-        Cpboot.append(calc_cp(None,**{'h_':H[boot]}))
-    Cpboot = np.array(Cpboot)
-    Cp_err = np.std(Cpboot) * np.sqrt(statisticalInefficiency(H))
+    Cp_err = bootstrap_stderr(lambda b: calc_cp(b, **{'h_':H}), L, statisticalInefficiency(H), numboots, block_bootstrap)
 
     # Isobaric heat capacity analytic derivative
     GCp1 = 2*covde(H) * 1000 / 4.184 / (NMol*kT*T)
@@ -691,12 +682,7 @@ def main():
         D2 += bzavg(dz**2,b)-bzavg(dz,b)**2
         return prefactor*D2/bzavg(v_,b)/T
     Eps0 = calc_eps0(None,**{'d_':Dips, 'v_':V})
-    Eps0boot = []
-    for i in range(numboots):
-        boot = np.random.randint(L,size=L)
-        Eps0boot.append(calc_eps0(None,**{'d_':Dips[boot], 'v_':V[boot]}))
-    Eps0boot = np.array(Eps0boot)
-    Eps0_err = np.std(Eps0boot)*np.sqrt(np.mean([statisticalInefficiency(Dips[:,0]),statisticalInefficiency(Dips[:,1]),statisticalInefficiency(Dips[:,2])]))
+    Eps0_err = bootstrap_stderr(lambda b: calc_eps0(b, **{'d_':Dips, 'v_':V}), L, np.mean(statisticalInefficiencies(Dips)), numboots, block_bootstrap)
  
     # Dielectric constant analytic derivative
     Dx = Dips[:,0]
@@ -721,7 +707,10 @@ def main():
     pvals = FF.make(mvals)
 
     logger.info("Writing all simulation data to disk.\n")
-    lp_dump((Rhos, Volumes, Potentials, Energies, Dips, G, [GDx, GDy, GDz], mPotentials, mEnergies, mG, Rho_err, Hvap_err, Alpha_err, Kappa_err, Cp_err, Eps0_err, NMol),'npt_result.p')
+    save_result('npt_result', 'npt', Rhos=Rhos, Volumes=Volumes, Potentials=Potentials, Energies=Energies, Dips=Dips,
+                G=G, GDips=[GDx, GDy, GDz], mPotentials=mPotentials, mEnergies=mEnergies, mG=mG,
+                Rho_err=Rho_err, Hvap_err=Hvap_err, Alpha_err=Alpha_err, Kappa_err=Kappa_err, Cp_err=Cp_err,
+                Eps0_err=Eps0_err, NMol=NMol)
 
 if __name__ == "__main__":
     main()
@@ -28,8 +28,9 @@ import numpy as np
 from copy import deepcopy
 from collections import namedtuple, OrderedDict
 from forcebalance.forcefield import FF
-from forcebalance.nifty import col, flat, lp_dump, lp_load, printcool, printcool_dictionary, statisticalInefficiency, which, _exec, isint, wopen
+from forcebalance.nifty import col, flat, lp_dump, lp_load, printcool, printcool_dictionary, statisticalInefficiency, statisticalInefficiencies, bootstrap_stderr, save_result, which, _exec, isint, wopen
 from forcebalance.finite_difference import fdwrap, f1d2p, f12d3p, f1d7p, in_fd
+from forcebalance.engine import fd_energy_derivatives
 from forcebalance.molecule import Molecule
 from forcebalance.output import getLogger
 logger = getLogger(__name__)
@@ -84,7 +85,7 @@ def mean_stderr(ts):
     if ts.ndim == 1:
         return np.mean(ts, axis = 0), np.std(ts, axis = 0)*np.sqrt(statisticalInefficiency(ts, warn=False)/len(ts))
     else:
-        return np.mean(ts, axis = 0), np.std(ts, axis = 0)*np.sqrt(multiD_statisticalInefficiency(ts, warn=False)/len(ts))
+        return np.mean(ts, axis = 0), np.std(ts, axis = 0)*np.sqrt(statisticalInefficiencies(ts, warn=False)/len(ts))
 
 def bzavg(obs,boltz):
     """ Get the Boltzmann average of an observable. """
@@ -98,6 +99,9 @@ def bzavg(obs,boltz):
         else:
             raise Exception('The dimensions are wrong!')
     elif obs.ndim == 1:
+        if boltz.ndim == 2:
+            # Several sets of weights (e.g. bootstrap resamples), one in each row.
+            return np.dot(boltz,obs)/np.sum(boltz,axis=1)
         return np.dot(obs,boltz)/sum(boltz)
     else:
         raise Exception('The number of dimensions can only be 1 or 2!')
@@ -117,19 +121,23 @@ def PrintEDA(EDA, N):
 #|            and properties                 |#
 #=============================================#
 
-def energy_derivatives(engine, FF, mvals, h, pgrad, length, AGrad=True, dipole=False):
+def energy_derivatives(engine, FF, mvals, h, pgrad, length, AGrad=True, dipole=False, processes=1, dependence=True):
 
     """
     Compute the first and second derivatives of a set of snapshot
     energies with respect to the force field parameters.
 
     This basically calls the finite difference subroutine on the
-    energy_driver subroutine also in this script.
+    energy_driver subroutine also in this script.  The displaced
+    parameter sets are evaluated as one batch, spread over several
+    processes if requested (see engine.fd_energy_derivatives).
 
     @param[in] mvals Mathematical parameter values
     @param[in] h Finite difference step size
     @param[in] AGrad Switch to turn derivatives on or off; if off, return all zeros
     @param[in] dipole Switch for dipole derivatives.
+    @param[in] processes Number of local processes for the displaced parameter sets
+    @param[in] dependence Skip the parameters that cannot affect the system in the engine
     @return G First derivative of the energies in a N_param x N_coord array
     @return GDx First derivative of the box dipole moment x-component in a N_param x N_coord array
     @return GDy First derivative of the box dipole moment y-component in a N_param x N_coord array
@@ -142,24 +150,11 @@ def energy_derivatives(engine, FF, mvals, h, pgrad, length, AGrad=True, dipole=F
     GDz      = np.zeros((FF.np,length))
     if not AGrad:
         return G, GDx, GDy, GDz
-    def energy_driver(mvals_):
-        FF.make(mvals_)
-        if dipole:
-            return engine.energy_dipole()
-        else:
-            return engine.energy()
-
-    ED0      = energy_driver(mvals)
-    for i in pgrad:
-        logger.info("%i %s\r" % (i, (FF.plist[i] + " "*30)))
-        EDG, _   = f12d3p(fdwrap(energy_driver,mvals,i),h,f0=ED0)
-        if dipole:
-            G[i,:]   = EDG[:,0]
-            GDx[i,:] = EDG[:,1]
-            GDy[i,:] = EDG[:,2]
-            GDz[i,:] = EDG[:,3]
-        else:
-            G[i,:]   = EDG[:]
+    _, EDG = fd_energy_derivatives(engine, FF, mvals, h, pgrad, dipole, processes, dependence)
+    if dipole:
+        G, GDx, GDy, GDz = [EDG[:,:,i] for i in range(4)]
+    else:
+        G = EDG
     return G, GDx, GDy, GDz
 
 def property_derivatives(engine, FF, mvals, h, pgrad, kT, property_driver, property_kwargs, AGrad=True):
@@ -285,6 +280,9 @@ def main():
     force_cuda = TgtOptions.get('force_cuda', 0)
     anisotropic = TgtOptions.get('anisotropic_box', 0)
     minimize = TgtOptions.get('minimize_energy', 1)
+    block_bootstrap = TgtOptions.get('block_bootstrap', 0)
+    fd_processes = TgtOptions.get('fd_processes', 1)
+    parameter_dependence = TgtOptions.get('parameter_dependence', 0)
 
     # Print all options.
     printcool_dictionary(TgtOptions, title="Options from ForceBalance")
@@ -416,7 +414,10 @@ def main():
 
     # Compute the energy and dipole derivatives.
     printcool("Condensed phase energy and dipole derivatives\nInitializing array to length %i" % len(Energies), color=4, bold=True)
-    G, GDx, GDy, GDz = energy_derivatives(Lipid, FF, mvals, h, pgrad, len(Energies), AGrad, dipole=True)
+    # Forked processes cannot use the GPU that the parent process has initialized.
+    lipid_fd_processes = 1 if EngOpts["lipid"].get("platname") in ['CUDA', 'OpenCL'] else fd_processes
+    G, GDx, GDy, GDz = energy_derivatives(Lipid, FF, mvals, h, pgrad, len(Energies), AGrad, dipole=True,
+                                          processes=lipid_fd_processes, dependence=parameter_dependence)
 
     #==============================================#
     #  Condensed phase properties and derivatives. #
@@ -480,13 +481,8 @@ def main():
             v_ = kwargs['v_']
         return 1/(kT*T) * (bzavg(h_*v_,b)-bzavg(h_,b)*bzavg(v_,b))/bzavg(v_,b)
     Alpha = calc_alpha(None, **{'h_':H, 'v_':V})
-    Alphaboot = []
     numboots = 1000
-    for i in range(numboots):
-        boot = np.random.randint(L,size=L)
-        Alphaboot.append(calc_alpha(None, **{'h_':H[boot], 'v_':V[boot]}))
-    Alphaboot = np.array(Alphaboot)
-    Alpha_err = np.std(Alphaboot) * max([np.sqrt(statisticalInefficiency(V)),np.sqrt(statisticalInefficiency(H))])
+    Alpha_err = bootstrap_stderr(lambda b: calc_alpha(b, **{'h_':H, 'v_':V}), L, max(statisticalInefficiencies(np.column_stack((V, H)))), numboots, block_bootstrap)
 
     # Thermal expansion coefficient analytic derivative
     GAlpha1 = -1 * Beta * deprod(H*V) * avg(V) / avg(V)**2
@@ -513,12 +509,7 @@ def main():
             v_ = kwargs['v_']
         return bar_unit / kT * (bzavg(v_**2,b)-bzavg(v_,b)**2)/bzavg(v_,b)
     Kappa = calc_kappa(None,**{'v_':V})
-    Kappaboot = []
-    for i in range(numboots):
-        boot = np.random.randint(L,size=L)
-        Kappaboot.append(calc_kappa(None,**{'v_':V[boot]}))
-    Kappaboot = np.array(Kappaboot)
-    Kappa_err = np.std(Kappaboot) * np.sqrt(statisticalInefficiency(V))
+    Kappa_err = bootstrap_stderr(lambda b: calc_kappa(b, **{'v_':V}), L, statisticalInefficiency(V), numboots, block_bootstrap)
 
     # Isothermal compressibility analytic derivative
     Sep = printcool("Isothermal compressibility:  % .4e +- %.4e bar^-1\nAnalytic Derivative:" % (Kappa, Kappa_err))
@@ -546,12 +537,7 @@ def main():
         Cp_ *= 1000 / 4.184
         return Cp_
     Cp = calc_cp(None,**{'h_':H})
-    Cpboot = []
-    for i in range(numboots):
-        boot = np.random.randint(L,size=L)
-        Cpboot.append(calc_cp(None,**{'h_':H[boot]}))
-    Cpboot = np.array(Cpboot)
-    Cp_err = np.std(Cpboot) * np.sqrt(statisticalInefficiency(H))
+    Cp_err = bootstrap_stderr(lambda b: calc_cp(b, **{'h_':H}), L, statisticalInefficiency(H), numboots, block_bootstrap)
 
     # Isobaric heat capacity analytic derivative
     GCp1 = 2*covde(H) * 1000 / 4.184 / (NMol*kT*T)
@@ -586,12 +572,7 @@ def main():
         D2 += bzavg(dz**2,b)-bzavg(dz,b)**2
         return prefactor*D2/bzavg(v_,b)/T
     Eps0 = calc_eps0(None,**{'d_':Dips, 'v_':V})
-    Eps0boot = []
-    for i in range(numboots):
-        boot = np.random.randint(L,size=L)
-        Eps0boot.append(calc_eps0(None,**{'d_':Dips[boot], 'v_':V[boot]}))
-    Eps0boot = np.array(Eps0boot)
-    Eps0_err = np.std(Eps0boot)*np.sqrt(np.mean([statisticalInefficiency(Dips[:,0]),statisticalInefficiency(Dips[:,1]),statisticalInefficiency(Dips[:,2])]))
+    Eps0_err = bootstrap_stderr(lambda b: calc_eps0(b, **{'d_':Dips, 'v_':V}), L, np.mean(statisticalInefficiencies(Dips)), numboots, block_bootstrap)
  
     # Dielectric constant analytic derivative
     Dx = Dips[:,0]
@@ -641,10 +622,8 @@ def main():
             a_ = kwargs['a_']
         al_var = bzavg(a_**2,b)-bzavg(a_,b)**2
         # Avoid dividing by zero if A_L time series is too short.
-        if abs(al_var) > 0: 
-            return (1e3 * 2 * kbT / 128) * (bzavg(a_,b) / al_var)
-        else:
-            return 0 * bzavg(a_,b)
+        nonzero = np.abs(al_var) > 0
+        return np.where(nonzero, (1e3 * 2 * kbT / 128) * (bzavg(a_,b) / np.where(nonzero, al_var, 1.0)), 0 * bzavg(a_,b))
 
     # Convert Als time series from nm^2 to m^2
     Als_m2 = Als * 1e-18
@@ -654,12 +633,7 @@ def main():
     al_avg_sq = al_avg**2
     al_var = al_sq_avg - al_avg_sq
 
-    LKappaboot = []
-    for i in range(numboots):
-        boot = np.random.randint(L,size=L)
-        LKappaboot.append(calc_lkappa(None,**{'a_':Als_m2[boot]}))
-    LKappaboot = np.array(LKappaboot)
-    LKappa_err = np.std(LKappaboot) * np.sqrt(statisticalInefficiency(Als_m2))
+    LKappa_err = bootstrap_stderr(lambda b: calc_lkappa(b, **{'a_':Als_m2}), L, statisticalInefficiency(Als_m2), numboots, block_bootstrap)
 
     # Bilayer Isothermal compressibility analytic derivative
     Sep = printcool("Lipid Isothermal compressibility:  % .4e +- %.4e N/nm^-1\nAnalytic Derivative:" % (LKappa, LKappa_err))
@@ -701,7 +675,9 @@ def main():
     pvals = FF.make(mvals)
 
     logger.info("Writing all simulation data to disk.\n")
-    lp_dump((Rhos, Volumes, Potentials, Energies, Dips, G, [GDx, GDy, GDz], Rho_err, Alpha_err, Kappa_err, Cp_err, Eps0_err, NMol, Als, Al_err, Scds, Scd_err, LKappa_err),'npt_result.p')
+    save_result('npt_result', 'npt_lipid', Rhos=Rhos, Volumes=Volumes, Potentials=Potentials, Energies=Energies, Dips=Dips,
+                G=G, GDips=[GDx, GDy, GDz], Rho_err=Rho_err, Alpha_err=Alpha_err, Kappa_err=Kappa_err, Cp_err=Cp_err,
+                Eps0_err=Eps0_err, NMol=NMol, Als=Als, Al_err=Al_err, Scds=Scds, Scd_err=Scd_err, LKappa_err=LKappa_err)
 
 
 if __name__ == "__main__":
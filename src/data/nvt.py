@@ -55,8 +55,9 @@ import numpy as np
 from copy import deepcopy
 from collections import namedtuple, OrderedDict
 from forcebalance.forcefield import FF
-from forcebalance.nifty import col, flat, lp_dump, lp_load, printcool, printcool_dictionary, statisticalInefficiency, which, _exec, isint, wopen, click
+from forcebalance.nifty import col, flat, lp_dump, lp_load, printcool, printcool_dictionary, statisticalInefficiency, statisticalInefficiencies, bootstrap_stderr, save_result, which, _exec, isint, wopen, click
 from forcebalance.finite_difference import fdwrap, f1d2p, f12d3p, f1d7p, in_fd
+from forcebalance.engine import fd_energy_derivatives
 from forcebalance.molecule import Molecule
 from forcebalance.output import getLogger
 logger = getLogger(__name__)
@@ -119,6 +120,9 @@ def bzavg(obs,boltz):
         else:
             raise Exception('The dimensions are wrong!')
     elif obs.ndim == 1:
+        if boltz.ndim == 2:
+            # Several sets of weights (e.g. bootstrap resamples), one in each row.
+            return np.dot(boltz,obs)/np.sum(boltz,axis=1)
         return np.dot(obs,boltz)/sum(boltz)
     else:
         raise Exception('The number of dimensions can only be 1 or 2!')
@@ -138,20 +142,24 @@ def PrintEDA(EDA, N):
 #|            and properties                 |#
 #=============================================#
 
-def energy_derivatives(engine, FF, mvals, h, pgrad, length, AGrad=True, dipole=False):
+def energy_derivatives(engine, FF, mvals, h, pgrad, length, AGrad=True, dipole=False, processes=1, dependence=True):
 
     """
     Compute the first and second derivatives of a set of snapshot
     energies with respect to the force field parameters.
 
     This basically calls the finite difference subroutine on the
-    energy_driver subroutine also in this script.
+    energy_driver subroutine also in this script.  The displaced
+    parameter sets are evaluated as one batch, spread over several
+    processes if requested (see engine.fd_energy_derivatives).
 
     @param[in] mvals Mathematical parameter values
     @param[in] h Finite difference step size
     @param[in] phase The phase (liquid, gas) to perform the calculation on
     @param[in] AGrad Switch to turn derivatives on or off; if off, return all zeros
     @param[in] dipole Switch for dipole derivatives.
+    @param[in] processes Number of local processes for the displaced parameter sets
+    @param[in] dependence Skip the parameters that cannot affect the system in the engine
     @return G First derivative of the energies in a N_param x N_coord array
     @return GDx First derivative of the box dipole moment x-component in a N_param x N_coord array
     @return GDy First derivative of the box dipole moment y-component in a N_param x N_coord array
@@ -164,24 +172,11 @@ def energy_derivatives(engine, FF, mvals, h, pgrad, length, AGrad=True, dipole=F
     GDz      = np.zeros((FF.np,length))
     if not AGrad:
         return G, GDx, GDy, GDz
-    def energy_driver(mvals_):
-        FF.make(mvals_)
-        if dipole:
-            return engine.energy_dipole()
-        else:
-            return engine.energy()
-
-    ED0      = energy_driver(mvals)
-    for i in pgrad:
-        logger.info("%i %s\r" % (i, (FF.plist[i] + " "*30)))
-        EDG, _   = f12d3p(fdwrap(energy_driver,mvals,i),h,f0=ED0)
-        if dipole:
-            G[i,:]   = EDG[:,0]
-            GDx[i,:] = EDG[:,1]
-            GDy[i,:] = EDG[:,2]
-            GDz[i,:] = EDG[:,3]
-        else:
-            G[i,:]   = EDG[:]
+    _, EDG = fd_energy_derivatives(engine, FF, mvals, h, pgrad, dipole, processes, dependence)
+    if dipole:
+        G, GDx, GDy, GDz = [EDG[:,:,i] for i in range(4)]
+    else:
+        G = EDG
     #reset FF parameters
     FF.make(mvals)
     return G, GDx, GDy, GDz
@@ -299,6 +294,9 @@ def main():
     nbarostat = TgtOptions.get('n_mcbarostat', 25)
     anisotropic = TgtOptions.get('anisotropic_box', 0)
     minimize = TgtOptions.get('minimize_energy', 1)
+    block_bootstrap = TgtOptions.get('block_bootstrap', 0)
+    fd_processes = TgtOptions.get('fd_processes', 1)
+    parameter_dependence = TgtOptions.get('parameter_dependence', 0)
 
     # Print all options.
     printcool_dictionary(TgtOptions, title="Options from ForceBalance")
@@ -364,6 +362,8 @@ def main():
 
     # Create instances of the MD Engine objects.
     Liquid = Engine(name="liquid", **EngOpts["liquid"])
+    # Forked processes cannot use the GPU that the parent process has initialized.
+    liquid_fd_processes = 1 if EngOpts["liquid"].get("platname") in ['CUDA', 'OpenCL'] else fd_processes
 
     #=================================================================#
     # Run the simulation for the full system and analyze the results. #
@@ -411,7 +411,8 @@ def main():
     Potentials_plus = Liquid.energy()
     logger.info("Calculation of energies for perturbed box+ took %.3f seconds\n" %click())
     if AGrad:
-        G_plus, _, _, _ = energy_derivatives(Liquid, FF, mvals, h, pgrad, len(Potentials), AGrad, dipole=False)
+        G_plus, _, _, _ = energy_derivatives(Liquid, FF, mvals, h, pgrad, len(Potentials), AGrad, dipole=False,
+                                             processes=liquid_fd_processes, dependence=parameter_dependence)
         logger.info("Calculation of energy gradients for perturbed box+ took %.3f seconds\n" %click())
     # perturb xy area - ( Note: also need to cancel the previous scaling)
     scale_x = scale_y = np.sqrt(1 - perturb_proportion) * (1.0/scale_x)
@@ -422,7 +423,8 @@ def main():
     Potentials_minus = Liquid.energy()
     logger.info("Calculation of energies for perturbed box- took %.3f seconds\n" %click())
     if AGrad:
-        G_minus, _, _, _ = energy_derivatives(Liquid, FF, mvals, h, pgrad, len(Potentials), AGrad, dipole=False)
+        G_minus, _, _, _ = energy_derivatives(Liquid, FF, mvals, h, pgrad, len(Potentials), AGrad, dipole=False,
+                                              processes=liquid_fd_processes, dependence=parameter_dependence)
         logger.info("Calculation of energy gradients for perturbed box- took %.3f seconds\n" %click())
     # Compute surface tension
     dE_plus = Potentials_plus - Potentials # Unit: kJ/mol
@@ -439,13 +441,9 @@ def main():
     # Use bootstrap method to estimate the error
     num_frames = len(exp_dE_plus)
     numboots = 1000
-    surf_ten_boots = np.zeros(numboots)
-    for i in range(numboots):
-        boots_ordering = np.random.randint(num_frames, size=num_frames)
-        boots_exp_dE_plus = np.take(exp_dE_plus, boots_ordering)
-        boots_exp_dE_minus = np.take(exp_dE_minus, boots_ordering)
-        surf_ten_boots[i] = prefactor * ( np.log(np.mean(boots_exp_dE_plus)) - np.log(np.mean(boots_exp_dE_minus)) )
-    surf_ten_err = np.std(surf_ten_boots) * np.sqrt(np.mean([statisticalInefficiency(exp_dE_plus), statisticalInefficiency(exp_dE_minus)]))
+    def calc_surf_ten(b):
+        return prefactor * ( np.log(bzavg(exp_dE_plus, b)) - np.log(bzavg(exp_dE_minus, b)) )
+    surf_ten_err = bootstrap_stderr(calc_surf_ten, num_frames, np.mean(statisticalInefficiencies(np.column_stack((exp_dE_plus, exp_dE_minus)))), numboots, block_bootstrap)
 
     printcool("Surface Tension:       % .4f +- %.4f mJ m^-2" % (surf_ten, surf_ten_err))
     # Analytic Gradient of surface tension
@@ -470,8 +468,7 @@ def main():
     pvals = FF.make(mvals)
 
     logger.info("Writing all results to disk.\n")
-    result_dict = {'surf_ten': surf_ten, 'surf_ten_err': surf_ten_err, 'G_surf_ten': G_surf_ten}
-    lp_dump(result_dict, 'nvt_result.p')
+    save_result('nvt_result', 'nvt', surf_ten=surf_ten, surf_ten_err=surf_ten_err, G_surf_ten=G_surf_ten)
 
 if __name__ == "__main__":
     main()
@@ -49,7 +49,7 @@ echo "#=======================#"
 echo
 echo $COMMAND
 
-rm -f npt_result.p
+rm -f npt_result.p npt_result.npz
 export PYTHONUNBUFFERED="y"
 
 # Actually run the command.
@@ -51,7 +51,7 @@ echo "#=======================#"
 echo
 echo $COMMAND
 
-rm -f npt_result.p
+rm -f npt_result.p npt_result.npz
 export PYTHONUNBUFFERED="y"
 
 # Unset OMP_NUM_THREADS otherwise gromacs will complain.
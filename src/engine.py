@@ -2,19 +2,144 @@
 
 import abc
 import os
+import glob
+import multiprocessing
 import subprocess
 import shutil
+import tempfile
 import numpy as np
 import time
 from collections import OrderedDict
 import tarfile
 import forcebalance
 from forcebalance.nifty import *
-from forcebalance.finite_difference import fdwrap_G, fdwrap_H, f1d2p, f12d3p
+from forcebalance.finite_difference import fdwrap, fdwrap_G, fdwrap_H, f1d2p, f12d3p, fd_context
 from forcebalance.optimizer import Counter
 from forcebalance.output import getLogger
 logger = getLogger(__name__)
 
+## The function and engines used by the worker processes of batch_map,
+## which inherit them when they are forked.
+_batch_func = None
+_batch_engines = []
+
+def _batch_worker_init():
+    """ Give each batch_map worker its own scratch directory and engine state. """
+    cwd = os.getcwd()
+    wdir = tempfile.mkdtemp(prefix='batch_worker.', dir=cwd)
+    # The files are copied rather than linked, because not everything
+    # writes them with wopen (which would replace a link).
+    for fnm in os.listdir(cwd):
+        if fnm.startswith('batch_worker.'): continue
+        if os.path.isfile(fnm):
+            shutil.copy2(fnm, os.path.join(wdir, fnm))
+        elif os.path.isdir(fnm):
+            os.symlink(os.path.abspath(fnm), os.path.join(wdir, fnm))
+    os.chdir(wdir)
+    for engine in _batch_engines:
+        engine.worker_init()
+
+def _batch_worker_call(arg):
+    return _batch_func(arg)
+
+def batch_map(func, args, engines=None, processes=1):
+    """
+    Evaluate func(arg) for each item in args and yield the results in
+    order.  This is meant for a batch of independent calculations on
+    the same systems, such as the energies at all of the displaced
+    parameter sets of a finite-difference gradient.
+
+    With processes > 1, the calls run concurrently in a pool of at most
+    that many local processes forked from this one, so func may be a
+    closure.  Each process works in its own scratch directory (with a copy
+    of the files in the current one), where FF.make prints its copy of
+    the force field and the engines write the input and output files of
+    the external programs, and calls worker_init on the engines first.
+    Only the results are sent back.
+
+    @param[in] func Function of one argument
+    @param[in] args List of arguments
+    @param[in] engines Engines used by func
+    @param[in] processes Maximum number of processes
+    @return Generator of the results
+    """
+    global _batch_func, _batch_engines
+    args = list(args)
+    if engines is None:
+        engines = []
+    if processes <= 1 or len(args) <= 1:
+        for arg in args:
+            yield func(arg)
+        return
+    logger.debug("Evaluating %i calculations on %i processes\n" % (len(args), processes))
+    _batch_func = func
+    _batch_engines = list(engines)
+    pool = multiprocessing.get_context('fork').Pool(processes=min(processes, len(args)), initializer=_batch_worker_init)
+    try:
+        for result in pool.imap(_batch_worker_call, args):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+        _batch_func = None
+        _batch_engines = []
+        for wdir in glob.glob('batch_worker.*'):
+            shutil.rmtree(wdir, ignore_errors=True)
+
+def fd_energy_derivatives(engine, FF, mvals, h, pgrad, dipole=False, processes=1, dependence=True):
+    """
+    Central finite-difference derivatives of the energies (and
+    optionally the dipole moments) of the snapshots in an engine with
+    respect to the force field parameters, as computed by the condensed
+    phase scripts after the MD.
+
+    The displaced parameter sets are evaluated as one batch (see
+    batch_map), so with processes > 1 they are spread over that many
+    local processes, each with its own engine state (for example an
+    OpenMM Context).  With dependence, the parameters that cannot affect
+    the system of the engine (see Engine.dependent_parameters) are
+    skipped and their derivatives are zero.
+
+    @param[in] engine Engine object for calculating energies
+    @param[in] FF Force field object
+    @param[in] mvals Mathematical parameter values
+    @param[in] h Finite difference step size
+    @param[in] pgrad List of active parameters for differentiation
+    @param[in] dipole Switch for dipole derivatives (uses engine.energy_dipole)
+    @param[in] processes Maximum number of processes
+    @param[in] dependence Skip the parameters that cannot affect the system
+    @return ED0 Energies (or energies and dipoles) at mvals
+    @return EDG First derivatives with shape (FF.np,) + ED0.shape
+    """
+    def single_point(mvals_):
+        FF.make(mvals_)
+        if dipole:
+            return engine.energy_dipole()
+        else:
+            return engine.energy()
+    ED0 = single_point(mvals)
+    EDG = np.zeros((FF.np,) + ED0.shape)
+    if dependence:
+        deps = engine.dependent_parameters()
+        if deps is not None:
+            skip = [i for i in pgrad if i not in deps]
+            if len(skip) > 0:
+                logger.info("Skipping %i parameters that cannot affect system %s: %s\n" % (len(skip), engine.name, ', '.join([FF.plist[i] for i in skip])))
+            pgrad = [i for i in pgrad if i in deps]
+    Tasks = [(i, d*h) for i in pgrad for d in [-1, 1]]
+    def displaced(task):
+        i, dx = task
+        with fd_context():
+            return fdwrap(single_point, mvals, i)(dx)
+    Displaced = {}
+    for (i, dx), ED in zip(Tasks, batch_map(displaced, Tasks, [engine], processes)):
+        Displaced[dx] = ED
+        if len(Displaced) == 2:
+            logger.info("%i %s\r" % (i, (FF.plist[i] + " "*30)))
+            EDG[i], _ = f12d3p(lambda dx: Displaced[dx], h, f0=ED0)
+            Displaced = {}
+    return ED0, EDG
+
 class Engine(forcebalance.BaseClass):
 
     """
@@ -63,6 +188,9 @@ class Engine(forcebalance.BaseClass):
             self.FF = kwargs['FF']
         if hasattr(self,'target') and not hasattr(self,'FF'):
             self.FF = self.target.FF
+        ## Whether the engine takes the force field from FF in memory
+        ## (so that FF.make does not need to print the files for it).
+        self.ff_in_memory = False
         #============================================#
         #| Initialization consists of three stages: |#
         #| 1) Setting up options                    |#
@@ -92,3 +220,56 @@ class Engine(forcebalance.BaseClass):
 
     def prepare(self, **kwargs):
         return
+
+    def worker_init(self):
+        """
+        Called in a freshly forked worker process before it does any
+        calculations.  Engines that hold state which cannot be shared
+        across a fork (for example an OpenMM Context) should discard
+        it here so it gets rebuilt inside the worker.
+        """
+        return
+
+    def topology_labels(self):
+        """
+        Return the labels of the system for matching against the atoms
+        that each parameter involves (FF.patoms), as a tuple of two sets:
+        the names of the molecules, and the atom types and classes.
+        Engines that cannot tell return None.
+        """
+        return None
+
+    def dependence_key(self):
+        """
+        Return a hashable key that identifies this system for the
+        parameter dependency index, or None if the engine has no index.
+        Engines with the same key share the index in the force field.
+        """
+        labels = self.topology_labels()
+        if labels is None: return None
+        return (self.__class__.__name__, frozenset(labels[0]), frozenset(labels[1]))
+
+    def build_dependence(self):
+        """
+        Build the parameter dependency index for this system; see dependent_parameters.
+        """
+        molecules, atoms = self.topology_labels()
+        return self.FF.match_patoms(molecules, atoms)
+
+    def dependent_parameters(self):
+        """
+        Return the parameters that can affect this system, as a
+        dictionary of (mathematical parameter index) -> (the atoms or
+        terms of the system that it enters), or None if unknown, in
+        which case every parameter is assumed to affect it.
+
+        The index is stored in the force field and shared between all
+        engines with the same dependence_key.
+        """
+        if not hasattr(self, 'FF'): return None
+        key = self.dependence_key()
+        if key is None: return None
+        if key not in self.FF.dependence_index:
+            self.FF.dependence_index[key] = self.build_dependence()
+            logger.info("%i out of %i parameters can affect system %s\n" % (len(self.FF.dependence_index[key]), self.FF.np, self.name))
+        return self.FF.dependence_index[key]
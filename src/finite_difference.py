@@ -1,11 +1,47 @@
 """ Finite difference module. """
 from __future__ import division
 
-import traceback
+import threading
+from functools import wraps
 from numpy import dot
 from forcebalance.output import getLogger
 logger = getLogger(__name__)
 
+## Nesting depth of the finite-difference stencils and line searches
+## that are currently being evaluated (separately for each thread).
+_fd_state = threading.local()
+
+class fd_context(object):
+    """
+    Context manager that marks everything called inside it as part of
+    a finite-difference calculation, so that in_fd() returns True.
+    With srch=True it marks a line search instead, which only in_fd_srch() sees.
+    The contexts may be nested.
+
+    The stencil functions in this module enter this context
+    automatically; code that evaluates displaced parameter sets by
+    other means (e.g. in a worker process) should enter it explicitly.
+    """
+    def __init__(self, srch=False):
+        self.attr = 'srch' if srch else 'fd'
+
+    def __enter__(self):
+        setattr(_fd_state, self.attr, getattr(_fd_state, self.attr, 0) + 1)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        setattr(_fd_state, self.attr, getattr(_fd_state, self.attr) - 1)
+        return False
+
+def fd_stencil(func):
+    """ Decorator that evaluates a finite difference stencil inside fd_context. """
+    @wraps(func)
+    def stencil(*args, **kwargs):
+        with fd_context():
+            return func(*args, **kwargs)
+    return stencil
+
+@fd_stencil
 def f1d2p(f, h, f0 = None):
     """
     A two-point finite difference stencil.
@@ -33,6 +69,7 @@ def f1d2p(f, h, f0 = None):
     fp = (f1-f0)/h
     return fp
 
+@fd_stencil
 def f1d5p(f, h):
     """
     A highly accurate five-point finite difference stencil
@@ -60,6 +97,7 @@ def f1d5p(f, h):
     fp = (-1*f2+8*f1-8*fm1+1*fm2)/(12*h)
     return fp
 
+@fd_stencil
 def f1d7p(f, h):
     """
     A highly accurate seven-point finite difference stencil
@@ -69,12 +107,14 @@ def f1d7p(f, h):
     fp = (f3-9*f2+45*f1-45*fm1+9*fm2-fm3)/(60*h)
     return fp
 
+@fd_stencil
 def f12d7p(f, h):
     fm3, fm2, fm1, f0, f1, f2, f3 = [f(i*h) for i in [-3, -2, -1, 0, 1, 2, 3]]
     fp = (f3-9*f2+45*f1-45*fm1+9*fm2-fm3)/(60*h)
     fpp = (2*f3-27*f2+270*f1-490*f0+270*fm1-27*fm2+2*fm3)/(180*h*h)
     return fp, fpp
 
+@fd_stencil
 def f12d3p(f, h, f0 = None):
     """
     A three-point finite difference stencil.
@@ -120,13 +160,13 @@ def in_fd():
     """ Invoking this function from anywhere will tell us whether we're being called by a finite-difference function.
     This is mainly useful for deciding when to update the 'qualitative indicators' and when not to. """
 
-    return any([i in [j[2] for j in traceback.extract_stack()] for i in ['f1d2p','f12d3p','f1d5p','f12d7p','f1d7p']])
+    return getattr(_fd_state, 'fd', 0) > 0
 
 def in_fd_srch():
-    """ Invoking this function from anywhere will tell us whether we're being called by a finite-difference function.
-    This is mainly useful for deciding when to update the 'qualitative indicators' and when not to. """
+    """ Invoking this function from anywhere will tell us whether we're being called by a finite-difference function
+    or from inside a line search (see fd_context). """
 
-    return any([i in [j[2] for j in traceback.extract_stack()] for i in ['f1d2p','f12d3p','f1d5p','f12d7p','f1d7p','search_fun']])
+    return in_fd() or getattr(_fd_state, 'srch', 0) > 0
 
 def fdwrap(func,mvals0,pidx,key=None,**kwargs):
     """
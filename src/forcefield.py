@@ -180,6 +180,25 @@ def determine_fftype(ffname,verbose=False):
         #sys.exit(1)
     return fftype
 
+def TXTFormat(number, precision):
+    """ Format a parameter value for printing to a text force field file. """
+    SciNot = "%% .%ie" % precision
+    if abs(number) < 1000 and abs(number) > 0.001:
+        Decimal = "%% .%if" % precision
+        Num = Decimal % number
+        Mum = Decimal % (-1 * number)
+        if (float(Num) == float(Mum)):
+            return Decimal % abs(number)
+        else:
+            return Decimal % number
+    else:
+        Num = SciNot % number
+        Mum = SciNot % (-1 * number)
+        if (float(Num) == float(Mum)):
+            return SciNot % abs(number)
+        else:
+            return SciNot % number
+
 # Thanks to tos9 from #python on freenode. :)
 class BackedUpDict(dict):
     def __init__(self, backup_dict):
@@ -241,6 +260,8 @@ class FF(forcebalance.BaseClass):
         self.set_option(options, 'use_pvals')
         ## Allow duplicate parameter names (internally construct unique names)
         self.set_option(options, 'duplicate_pnames')
+        ## Keep the force field in memory and only update the parameters that changed
+        self.set_option(options, 'incremental_make')
 
         #======================================#
         #     Variables which are set here     #
@@ -263,6 +284,10 @@ class FF(forcebalance.BaseClass):
         self.pfields     = []
         ## Improved representation of pfields as a networkx graph
         self.pTree       = nx.DiGraph()
+        ## In-memory working copy of the force field used by make_incremental
+        self.make_cache  = None
+        ## Parameter dependency index shared by all engines; (Engine.dependence_key) -> {parameter : atoms or terms}
+        self.dependence_index = {}
         # unit strings that might appear in offxml file
         self.offxml_unit_strs = defaultdict(str)
         ## List of rescaling factors
@@ -346,7 +371,9 @@ class FF(forcebalance.BaseClass):
         return cls(options, verbose=False, printopt=False)
 
     def __getstate__(self):
-        state = deepcopy(self.__dict__)
+        # The working copy for make_incremental is rebuilt on demand.
+        state = deepcopy(dict([(k, v) for k, v in self.__dict__.items() if k != 'make_cache']))
+        state['make_cache'] = None
         for ffname in self.ffdata:
             if self.ffdata_isxml[ffname]:
                 temp = etree.tostring(self.ffdata[ffname])
@@ -751,7 +778,7 @@ class FF(forcebalance.BaseClass):
                 quantity_str = e.get(parameter_name)
                 self.offxml_unit_strs[dest] = unit_str
 
-    def make(self,vals=None,use_pvals=False,printdir=None,precision=12):
+    def make(self,vals=None,use_pvals=False,printdir=None,precision=12,write=True):
         """ Create a new force field using provided parameter values.
 
         This big kahuna does a number of things:
@@ -769,6 +796,8 @@ class FF(forcebalance.BaseClass):
         @param[in] use_pvals Switch for whether to bypass the coordinate transformation
         and use physical parameters directly.
         @param[in] precision Number of decimal points to print out
+        @param[in] write Whether to print the force field files; only used
+        with the incremental_make option (see make_incremental)
 
         """
         if type(vals)==np.ndarray and vals.ndim != 1:
@@ -786,26 +815,12 @@ class FF(forcebalance.BaseClass):
             pvals = self.create_pvals(vals)
 
         OMMFormat = "%%.%ie" % precision
-        def TXTFormat(number, precision):
-            SciNot = "%% .%ie" % precision
-            if abs(number) < 1000 and abs(number) > 0.001:
-                Decimal = "%% .%if" % precision
-                Num = Decimal % number
-                Mum = Decimal % (-1 * number)
-                if (float(Num) == float(Mum)):
-                    return Decimal % abs(number)
-                else:
-                    return Decimal % number
-            else:
-                Num = SciNot % number
-                Mum = SciNot % (-1 * number)
-                if (float(Num) == float(Mum)):
-                    return SciNot % abs(number)
-                else:
-                    return SciNot % number
 
         pvals = list(pvals)
         # pvec1d(vals, precision=4)
+        if self.incremental_make:
+            return self.make_incremental(pvals, printdir, precision, write)
+
         newffdata = deepcopy(self.ffdata)
 
         # The dictionary that takes parameter names to physical values.
@@ -850,39 +865,66 @@ class FF(forcebalance.BaseClass):
                     assign_openff_parameter(self.openff_forcefield, wval, pid)
                 # list(newffdata[fnm].iter())[ln].attrib[fld] = OMMFormat % (wval)
             # Text force fields are a bit harder.
-            # Our pointer is given by the line and field number.
-            # We take care to preserve whitespace in the printout
-            # so that the new force field still has nicely formated
-            # columns.
             else:
-                # Split the string into whitespace and data fields.
-                sline       = self.Readers[fnm].Split(newffdata[fnm][ln])
-                whites      = self.Readers[fnm].Whites(newffdata[fnm][ln])
-                # Align whitespaces and fields (it should go white, field, white, field)
-                if newffdata[fnm][ln][0] != ' ':
-                    whites = [''] + whites
-                # Subtract one whitespace, unless the line begins with a minus sign.
-                if not match('^-',sline[fld]) and len(whites[fld]) > 1:
-                    whites[fld] = whites[fld][:-1]
-                # Actually replace the field with the physical parameter value.
-                if precision == 12:
-                    newrd  = "% 17.12e" % (wval)
-                else:
-                    newrd  = TXTFormat(wval, precision)
-                # The new word might be longer than the old word.
-                # If this is the case, we can try to shave off some whitespace.
-                Lold = len(sline[fld])
-                if not match('^-',sline[fld]):
-                    Lold += 1
-                Lnew = len(newrd)
-                if Lnew > Lold:
-                    Shave = Lnew - Lold
-                    if Shave < (len(whites[fld+1])+2):
-                        whites[fld+1] = whites[fld+1][:-Shave]
-                sline[fld] = newrd
-                # Replace the line in the new force field.
-                newffdata[fnm][ln] = ''.join([(whites[j] if (len(whites[j]) > 0 or j == 0) else ' ')+sline[j] for j in range(len(sline))])+'\n'
+                newffdata[fnm][ln] = self.replace_txt_field(fnm, newffdata[fnm][ln], fld, wval, precision)
+
+        for fnm in newffdata:
+            self.write_ffdata(newffdata, fnm, printdir)
+
+        return pvals
+
+    def replace_txt_field(self, fnm, line, fld, wval, precision=12):
+        """ Replace one field in a line of a text force field file with a new value.
+
+        @param[in] fnm The force field file name (used to look up the Reader)
+        @param[in] line The line to be modified
+        @param[in] fld The index of the field to be replaced
+        @param[in] wval The new (physical) parameter value
+        @param[in] precision Number of decimal points to print out
+        @return The modified line
+
+        """
+        # Our pointer is given by the line and field number.
+        # We take care to preserve whitespace in the printout
+        # so that the new force field still has nicely formated
+        # columns.
+        # Split the string into whitespace and data fields.
+        sline       = self.Readers[fnm].Split(line)
+        whites      = self.Readers[fnm].Whites(line)
+        # Align whitespaces and fields (it should go white, field, white, field)
+        if line[0] != ' ':
+            whites = [''] + whites
+        # Subtract one whitespace, unless the line begins with a minus sign.
+        if not match('^-',sline[fld]) and len(whites[fld]) > 1:
+            whites[fld] = whites[fld][:-1]
+        # Actually replace the field with the physical parameter value.
+        if precision == 12:
+            newrd  = "% 17.12e" % (wval)
+        else:
+            newrd  = TXTFormat(wval, precision)
+        # The new word might be longer than the old word.
+        # If this is the case, we can try to shave off some whitespace.
+        Lold = len(sline[fld])
+        if not match('^-',sline[fld]):
+            Lold += 1
+        Lnew = len(newrd)
+        if Lnew > Lold:
+            Shave = Lnew - Lold
+            if Shave < (len(whites[fld+1])+2):
+                whites[fld+1] = whites[fld+1][:-Shave]
+        sline[fld] = newrd
+        # Replace the line in the new force field.
+        return ''.join([(whites[j] if (len(whites[j]) > 0 or j == 0) else ' ')+sline[j] for j in range(len(sline))])+'\n'
+
+    def write_ffdata(self, newffdata, fnm, printdir=None):
+        """ Print one force field file (given as its in-memory representation) to disk.
+
+        @param[in] newffdata Dictionary of force field file contents, keyed by file name
+        @param[in] fnm The file to be printed
+        @param[in] printdir The directory that the force field is printed to, relative to the project root directory
+        @return The absolute path of the file that was written
 
+        """
         if printdir is not None:
             absprintdir = os.path.join(self.root,printdir)
         else:
@@ -892,34 +934,166 @@ class FF(forcebalance.BaseClass):
             logger.info('Creating the directory %s to print the force field\n' % absprintdir)
             os.makedirs(absprintdir)
 
-        for fnm in newffdata:
-            if self.ffdata_isxml[fnm]:
-                with wopen(os.path.join(absprintdir,fnm), binary=True) as f: newffdata[fnm].write(f)
-            elif 'Script.txt' in fnm:
-                # if the xml file contains a script, ForceBalance will generate
-                # a temporary .txt file containing the script and any updates.
-                # We copy the updates made in the .txt file into the xml file by:
-                #   First, find xml file corresponding to this .txt file
-                #   Second, copy context of the .txt file into the text attribute
-                #           of the script element (assumed to be the last element)
-                #   Third. open the updated xml file as in the if statement above
-                tempText = "".join(newffdata[fnm])
-                fnmXml = fnm.split('Script')[0]+'.xml'
-                Ntemp = len(list(newffdata[fnmXml].iter()))
-                list(newffdata[fnmXml].iter())[Ntemp-1].text = tempText
-                '''
-                scriptElements = [elem for elem in fflist if elem.tag=='Script']
-                if len(scriptElements) > 1:
-                logger.error('XML file'+ffname+'contains more than one script! Consolidate your scripts into one script!\n')
-                raise RuntimeError
-                else:
-                '''
-                with wopen(os.path.join(absprintdir,fnmXml), binary=True) as f: newffdata[fnmXml].write(f)
+        if self.ffdata_isxml[fnm]:
+            with wopen(os.path.join(absprintdir,fnm), binary=True) as f: newffdata[fnm].write(f)
+            return os.path.join(absprintdir,fnm)
+        elif 'Script.txt' in fnm:
+            # if the xml file contains a script, ForceBalance will generate
+            # a temporary .txt file containing the script and any updates.
+            # We copy the updates made in the .txt file into the xml file by:
+            #   First, find xml file corresponding to this .txt file
+            #   Second, copy context of the .txt file into the text attribute
+            #           of the script element (assumed to be the last element)
+            #   Third. open the updated xml file as in the if statement above
+            tempText = "".join(newffdata[fnm])
+            fnmXml = fnm.split('Script')[0]+'.xml'
+            Ntemp = len(list(newffdata[fnmXml].iter()))
+            list(newffdata[fnmXml].iter())[Ntemp-1].text = tempText
+            '''
+            scriptElements = [elem for elem in fflist if elem.tag=='Script']
+            if len(scriptElements) > 1:
+            logger.error('XML file'+ffname+'contains more than one script! Consolidate your scripts into one script!\n')
+            raise RuntimeError
             else:
-                with wopen(os.path.join(absprintdir,fnm)) as f: f.writelines(newffdata[fnm])
+            '''
+            with wopen(os.path.join(absprintdir,fnmXml), binary=True) as f: newffdata[fnmXml].write(f)
+            return os.path.join(absprintdir,fnmXml)
+        else:
+            with wopen(os.path.join(absprintdir,fnm)) as f: f.writelines(newffdata[fnm])
+            return os.path.join(absprintdir,fnm)
+
+    def make_incremental(self, pvals, printdir=None, precision=12, write=True):
+        """ Incremental version of make(), used when the incremental_make option is set.
+
+        A working copy of the force field files is kept in memory
+        between calls, and only the fields whose values have changed
+        since the previous call are patched.  The 'cmd' expressions
+        for evaluated parameters are compiled once.  Files are only
+        printed if write=True, and only if their contents have changed
+        since they were last printed to the same location.
+
+        Engines that run in this process (i.e. OpenMM and SMIRNOFF)
+        may read the current force field from get_ffdata() and call make()
+        with write=False, so that finite-difference calculations
+        do not touch the file system at all.
+
+        @param[in] pvals List of physical parameter values
+        @param[in] printdir The directory that the force fields are printed to
+        @param[in] precision Number of decimal points to print out
+        @param[in] write Whether to print the (changed) force field files
+        @return pvals
 
+        """
+        OMMFormat = "%%.%ie" % precision
+        mc = self.make_cache
+        if mc is None or mc['precision'] != precision:
+            mc = self.create_make_cache(precision)
+        newffdata = mc['ffdata']
+        wvals = mc['wvals']
+        mc['pvals'] = np.array(pvals)
+        PRM = {i:pvals[self.map[i]] for i in self.map}
+        changed = set()
+        changed_lines = set()
+        for i in range(len(self.pfields)):
+            pid,fnm,ln,fld,mult,cmd = self.pfields[i]
+            if cmd is not None:
+                try:
+                    wval = eval(mc['code'][i])
+                    # Attempt to allow evaluated parameters to be functions of each other.
+                    PRM[pid] = wval
+                except:
+                    logger.error(traceback.format_exc() + '\n')
+                    logger.error("The command %s (written in the force field file) cannot be evaluated!\n" % cmd)
+                    raise RuntimeError
+            else:
+                wval = mult*pvals[self.map[pid]]
+            if wval == wvals[i]: continue
+            wvals[i] = wval
+            changed.add(fnm)
+            if self.ffdata_isxml[fnm]:
+                mc['xml_lines'][fnm][ln].attrib[fld] = OMMFormat % (wval) + self.offxml_unit_strs[pid]
+                if hasattr(self, 'offxml') and fnm == self.offxml:
+                    assign_openff_parameter(self.openff_forcefield, wval, pid)
+            else:
+                changed_lines.add((fnm, ln))
+        # Text lines are rebuilt from the original line, applying all of the
+        # fields in the same order as make(), so the whitespace comes out the same.
+        for fnm, ln in changed_lines:
+            line = self.ffdata[fnm][ln]
+            for i in mc['txt_fields'][(fnm, ln)]:
+                line = self.replace_txt_field(fnm, line, self.pfields[i][3], wvals[i], precision)
+            newffdata[fnm][ln] = line
+        for fnm in changed:
+            mc['revision'][fnm] += 1
+            if 'Script.txt' in fnm:
+                # The script is printed as part of its XML file.
+                fnmXml = fnm.split('Script')[0]+'.xml'
+                list(newffdata[fnmXml].iter())[-1].text = "".join(newffdata[fnm])
+                mc['revision'][fnmXml] += 1
+        if write:
+            absprintdir = os.path.join(self.root,printdir) if printdir is not None else os.getcwd()
+            for fnm in newffdata:
+                outfnm = fnm.split('Script')[0]+'.xml' if (not self.ffdata_isxml[fnm] and 'Script.txt' in fnm) else fnm
+                absfnm = os.path.join(absprintdir, outfnm)
+                # Skip files that we printed to the same place before, and haven't changed since.
+                if absfnm in mc['written'] and os.path.isfile(absfnm) and not os.path.islink(absfnm):
+                    revision, mtime = mc['written'][absfnm]
+                    if revision == mc['revision'][outfnm] and mtime == os.stat(absfnm).st_mtime:
+                        continue
+                self.write_ffdata(newffdata, fnm, printdir)
+                mc['written'][absfnm] = (mc['revision'][outfnm], os.stat(absfnm).st_mtime)
         return pvals
 
+    def create_make_cache(self, precision=12):
+        """ Set up the in-memory working copy of the force field used by make_incremental(). """
+        mc = {'precision' : precision,
+              # Working copy of the force field file contents
+              'ffdata' : deepcopy(self.ffdata),
+              # Values that are currently in the working copy (nan means not yet assigned)
+              'wvals' : np.zeros(len(self.pfields)) * np.nan,
+              # Compiled 'cmd' expressions for evaluated parameters
+              'code' : [],
+              # Lists of pfields that are located on each line of a text file
+              'txt_fields' : defaultdict(list),
+              # Number of times each file has been changed, and the revision last printed to each path
+              'revision' : dict([(fnm, 0) for fnm in self.ffdata]),
+              'written' : {}}
+        mc['xml_lines'] = OrderedDict([(fnm, list(mc['ffdata'][fnm].iter())) for fnm in self.fnms if self.ffdata_isxml[fnm]])
+        for i, (pid,fnm,ln,fld,mult,cmd) in enumerate(self.pfields):
+            if cmd is not None:
+                # Bobby Tables, anyone?
+                if any([x in cmd for x in ("system", "subprocess", "import")]):
+                    warn_press_key("The command %s (written in the force field file) appears to be unsafe!" % cmd)
+                try:
+                    mc['code'].append(compile(cmd.replace("PARM","PRM"), '<%s>' % pid, 'eval'))
+                except:
+                    logger.error(traceback.format_exc() + '\n')
+                    logger.error("The command %s (written in the force field file) cannot be evaluated!\n" % cmd)
+                    raise RuntimeError
+            else:
+                mc['code'].append(None)
+            if not self.ffdata_isxml[fnm]:
+                mc['txt_fields'][(fnm, ln)].append(i)
+        self.make_cache = mc
+        return mc
+
+    def get_pvals(self):
+        """ Return the physical parameter values of the in-memory force field
+        (see get_ffdata) as an array. """
+        if self.make_cache is not None:
+            return self.make_cache['pvals'].copy()
+        return np.array(self.pvals0)
+
+    def get_ffdata(self, fnm):
+        """ Return the in-memory contents of a force field file as of
+        the most recent call to make(), if the incremental_make option
+        is set (otherwise, the contents of the original file).
+        XML files are returned as ElementTree objects and text files
+        as lists of lines. """
+        if self.make_cache is not None:
+            return self.make_cache['ffdata'][fnm]
+        return self.ffdata[fnm]
+
     def make_redirect(self,mvals):
         Groups = defaultdict(list)
         for p, pid in enumerate(self.plist):
@@ -1327,7 +1501,7 @@ class FF(forcebalance.BaseClass):
                     qidx = []
                     for imol, iatoms in self.patoms[i]:
                         for iatom in iatoms:
-                            if imol == molname and iatom in molatoms:
+                            if imol == molname and molatoms is not None and iatom in molatoms:
                                 qct += 1
                                 tq += 1
                                 qidx.append(molatoms.index(iatom))
@@ -1538,6 +1712,62 @@ class FF(forcebalance.BaseClass):
                 mathids.append(nx.get_node_attributes(self.pTree, 'param_mathid')[node])
         return mathids
 
+    def match_patoms(self, molecules, atoms):
+        """
+        Find the mathematical parameters that enter a system containing
+        the given molecules and atom labels.
+
+        Each physical parameter enters the interactions recorded in
+        patoms as (molecule name, atoms) when the force field is read.
+        The molecule name is None for parameters that are looked up by
+        atom type or class (e.g. [ bondtypes ] in GROMACS or the TINKER
+        .prm file).  Such an interaction occurs in the system if all of
+        its atom labels do; otherwise it occurs if the molecule does.
+        Parameters without any atoms (global parameters, or XML force
+        fields that don't record them) and parameters that other
+        parameters are evaluated from are assumed to enter every system.
+
+        @param[in] molecules Set of molecule names in the system
+        @param[in] atoms Set of atom types and classes in the system
+        @return OrderedDict of (mathematical parameter) -> (list of matching interactions)
+        """
+        everywhere = set()
+        for pid in self.pTree.nodes():
+            if self.pTree.out_degree(pid) > 0:
+                for src in nx.descendants(self.pTree, pid):
+                    everywhere.add(self.pTree.nodes[src]['param_mathid'])
+        phys = OrderedDict()
+        for i in range(self.np):
+            if len(self.patoms[i]) == 0 or i in everywhere:
+                phys[i] = []
+                continue
+            found = [(mol, involved) for mol, involved in self.patoms[i] if
+                     (mol in molecules if mol is not None else all(["%s" % a in atoms for a in involved]))]
+            if len(found) > 0:
+                phys[i] = found
+        return self.mathematical_dependence(phys)
+
+    def mathematical_dependence(self, phys):
+        """
+        Convert a dependency index of the physical parameters into one of
+        the mathematical parameters, which may be linear combinations of them.
+
+        @param[in] phys Dictionary of (physical parameter) -> (list of atoms or terms)
+        @return OrderedDict of (mathematical parameter) -> (list of atoms or terms)
+        """
+        phys = OrderedDict([(i, list(v)) for i, v in phys.items()])
+        for i, j in self.redirect.items():
+            if i in phys:
+                phys.setdefault(j, []).extend(phys[i])
+        if self.logarithmic_map or self.tmI is None:
+            return OrderedDict([(p, phys[p]) for p in sorted(phys.keys())])
+        answer = OrderedDict()
+        for p in range(self.np):
+            for i in np.nonzero(np.asarray(self.tmI)[:, p])[0]:
+                if i in phys:
+                    answer.setdefault(p, []).extend(phys[i])
+        return answer
+
     def __eq__(self, other):
         # check equality of forcefields using comparison of pfields and map
         if isinstance(other, FF):
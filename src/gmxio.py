@@ -13,6 +13,7 @@ from builtins import str
 from builtins import range
 import os, sys
 import re
+import struct
 from forcebalance.nifty import *
 from forcebalance.nifty import _exec
 from forcebalance import BaseReader
@@ -405,6 +406,7 @@ class ITP_Reader(BaseReader):
         if re.match('^#', line):
             self.overpfx = 'DEFINE'
             self.oversfx = s[1]
+            self.molatom = (None, [])
         elif hasattr(self, 'overpfx'):
             delattr(self, 'overpfx')
             delattr(self, 'oversfx')
@@ -514,6 +516,127 @@ class ITP_Reader(BaseReader):
         else:
             self.suffix = ':' + '-'.join([self.mol,'.'.join(["%s" % i for i in atom])])
         self.molatom = (self.mol, atom if type(atom) is list else [atom])
+        if hasattr(self, 'overpfx'):
+            # A parameter in a #define may be used anywhere.
+            self.molatom = (None, [])
+
+def _xdr_string(buf, pos):
+    """ Read an XDR string (length followed by the characters padded to 4 bytes) from buf at pos. """
+    n = struct.unpack('>i', buf[pos:pos+4])[0]
+    return buf[pos+4:pos+4+n].decode('ascii', 'replace').rstrip('\x00'), pos + 4 + 4*((n + 3)//4)
+
+def read_trr(fnm):
+    """
+    Read a GROMACS .trr trajectory directly, without calling g_traj.
+
+    @param[in] fnm Name of the .trr file.
+    @return answer Dictionary with lists of the frames that contain each
+    of 'box', 'x', 'v' and 'f' (as arrays with shape (natoms, 3) in nm,
+    nm/ps and kJ/mol/nm) and arrays of 'step' and 'time'.
+    """
+    buf = open(fnm, 'rb').read()
+    answer = OrderedDict([('step', []), ('time', []), ('box', []), ('x', []), ('v', []), ('f', [])])
+    pos = 0
+    while pos < len(buf):
+        magic = struct.unpack('>i', buf[pos:pos+4])[0]
+        if magic != 1993:
+            logger.error('%s is not a .trr file or is corrupted at byte %i\n' % (fnm, pos))
+            raise RuntimeError
+        # The magic number is followed by the version string, which is preceded by its length + 1.
+        _, pos = _xdr_string(buf, pos+8)
+        sizes = struct.unpack('>13i', buf[pos:pos+52])
+        pos += 52
+        ir_size, e_size, box_size, vir_size, pres_size, top_size, sym_size, x_size, v_size, f_size, natoms, step, nre = sizes
+        # The precision is not stored, so get it from the size of an array in the frame.
+        for size, count in [(box_size, 9), (x_size, 3*natoms), (v_size, 3*natoms), (f_size, 3*natoms)]:
+            if size:
+                real = '>f%i' % (size // count)
+                break
+        else:
+            real = '>f4'
+        rsize = int(real[2:])
+        t = np.frombuffer(buf, dtype=real, count=1, offset=pos)[0]
+        pos += 2*rsize + ir_size + e_size
+        answer['step'].append(step)
+        answer['time'].append(t)
+        for key, size, shape in [('box', box_size, (3, 3)), (None, vir_size, None), (None, pres_size, None),
+                                 ('x', x_size, (natoms, 3)), ('v', v_size, (natoms, 3)), ('f', f_size, (natoms, 3))]:
+            if size and key is not None:
+                answer[key].append(np.frombuffer(buf, dtype=real, count=size // rsize, offset=pos).reshape(shape).astype(float))
+            pos += size
+    answer['step'] = np.array(answer['step'])
+    answer['time'] = np.array(answer['time'])
+    return answer
+
+def read_edr(fnm):
+    """
+    Read the energy terms from a GROMACS .edr file directly, without calling g_energy.
+
+    @param[in] fnm Name of the .edr file.
+    @return names List of the energy term names.
+    @return energies Array with shape (number of frames, number of terms),
+    skipping frames that have no energies.
+    """
+    buf = open(fnm, 'rb').read()
+    magic, version, nre = struct.unpack('>3i', buf[:12])
+    if magic != -55555:
+        logger.error('%s is not a .edr file, or was written by a GROMACS version older than 4.0\n' % fnm)
+        raise RuntimeError
+    pos = 12
+    names = []
+    for i in range(nre):
+        name, pos = _xdr_string(buf, pos)
+        if version >= 2:
+            _, pos = _xdr_string(buf, pos)
+        names.append(name)
+    # Sizes of the XDR data types in the frame blocks: int, float, double, int64, char, string.
+    xdr_sizes = {0:4, 1:4, 2:8, 3:8, 4:4}
+    energies = []
+    while pos < len(buf):
+        # Each frame starts with -2e10 in the precision of the file.
+        if struct.unpack('>f', buf[pos:pos+4])[0] < -1e10:
+            real = '>f4'
+        elif struct.unpack('>d', buf[pos:pos+8])[0] < -1e10:
+            real = '>f8'
+        else:
+            logger.error('%s is corrupted at byte %i\n' % (fnm, pos))
+            raise RuntimeError
+        rsize = int(real[2:])
+        pos += rsize
+        fmagic, fversion = struct.unpack('>2i', buf[pos:pos+8])
+        if fmagic != -7777777:
+            logger.error('%s is corrupted at byte %i\n' % (fnm, pos))
+            raise RuntimeError
+        if fversion < 4:
+            logger.error('%s was written by a GROMACS version older than 4.5, which is not supported\n' % fnm)
+            raise RuntimeError
+        pos += 8
+        # time (double), step (int64), nsum (int), nsteps (int64), dt (double)
+        nsum = struct.unpack('>i', buf[pos+16:pos+20])[0]
+        pos += 28 + (8 if fversion >= 5 else 0)
+        # Number of energies, number of distance restraints (reserved in version 4+), number of blocks
+        fnre, _, nblock = struct.unpack('>3i', buf[pos:pos+12])
+        pos += 12
+        subblocks = []
+        for b in range(nblock):
+            _, nsub = struct.unpack('>2i', buf[pos:pos+8])
+            pos += 8
+            for s in range(nsub):
+                subblocks.append(struct.unpack('>2i', buf[pos:pos+8]))
+                pos += 8
+        # Three obsolete size fields.
+        pos += 12
+        nval = 3 if nsum > 0 else 1
+        if fnre > 0:
+            energies.append(np.frombuffer(buf, dtype=real, count=fnre*nval, offset=pos)[::nval].astype(float))
+        pos += fnre*nval*rsize
+        for dtype, nr in subblocks:
+            if dtype == 5:
+                for i in range(nr):
+                    _, pos = _xdr_string(buf, pos)
+            else:
+                pos += nr*xdr_sizes[dtype]
+    return names, np.array(energies)
 
 def rm_gmx_baks(dir):
     # Delete the #-prepended files that GROMACS likes to make
@@ -528,7 +651,7 @@ class GMX(Engine):
 
     def __init__(self, name="gmx", **kwargs):
         ## Valid GROMACS-specific keywords.
-        self.valkwd = ['gmxsuffix', 'gmxpath', 'gmx_top', 'gmx_mdp', 'gmx_ndx', 'gmx_eq_barostat', 'gmx_pme_order']
+        self.valkwd = ['gmxsuffix', 'gmxpath', 'gmx_top', 'gmx_mdp', 'gmx_ndx', 'gmx_eq_barostat', 'gmx_pme_order', 'gmx_threads']
         super(GMX,self).__init__(name=name, **kwargs)
 
     def setopts(self, **kwargs):
@@ -551,6 +674,9 @@ class GMX(Engine):
         if 'gmx_eq_barostat' in kwargs:
             self.gmx_eq_barostat = kwargs['gmx_eq_barostat']
 
+        ## Number of threads for single point, rerun and minimization calls to mdrun
+        self.gmx_threads = kwargs.get('gmx_threads', 1)
+
         ## The directory containing GROMACS executables (e.g. mdrun)
         havegmx = False
         if 'gmxpath' in kwargs:
@@ -756,6 +882,37 @@ class GMX(Engine):
             for f in self.FF.fnms: 
                 os.unlink(f)
 
+    def topology_labels(self):
+        """ Return the molecule names in the [ molecules ] section of the
+        .top file, and the atom types and bonded types of their atoms from
+        the [ atoms ] sections in the force field files. """
+        if not hasattr(self, 'FF') or self.top is None: return None
+        if self.top in self.FF.ffdata:
+            lines = self.FF.ffdata[self.top]
+        elif os.path.exists(os.path.join(self.tempdir, self.top)):
+            lines = open(os.path.join(self.tempdir, self.top)).readlines()
+        else:
+            return None
+        molecules = set()
+        sec = None
+        for line in lines:
+            s = line.split(';')[0].split()
+            if len(s) == 0 or s[0].startswith('#'): continue
+            if re.match('^ *\[.*\]', line):
+                sec = re.sub('[\[\] \n]', '', line.strip())
+            elif sec == 'molecules':
+                molecules.add(s[0])
+        readers = [r for r in self.FF.Readers.values() if isinstance(r, ITP_Reader)]
+        atoms = set(['X'])
+        for mol in molecules:
+            # Molecules that are not defined in the force field files could contain any atom type.
+            if not any([mol in r.Molecules for r in readers]): return None
+            for r in readers:
+                atoms.update([a['AtomType'] for a in r.Molecules.get(mol, [])])
+        for r in readers:
+            atoms.update([v['AtomClass'] for k, v in r.AtomTypes.items() if k in atoms and v['AtomClass'] is not None])
+        return molecules, atoms
+
     def get_charges(self):
         # Call gmxdump to get system information and read the charges.
         self.warngmx("grompp -c %s.gro -p %s.top -f %s.mdp -o %s.tpr" % (self.name, self.name, self.name, self.name))
@@ -840,6 +997,16 @@ class GMX(Engine):
             raise RuntimeError
         return o
 
+    def read_energy(self, edrfile, term='Potential'):
+
+        """ Read one energy term over all frames of an .edr file (kJ/mol for energies). """
+
+        names, energies = read_edr(edrfile)
+        if term not in names:
+            logger.error('%s does not contain the energy term %s\n' % (edrfile, term))
+            raise RuntimeError
+        return energies[:, names.index(term)]
+
     def energy_termnames(self, edrfile=None):
 
         """ Get a list of energy term names from the .edr file by parsing a system call to g_energy. """
@@ -892,12 +1059,11 @@ class GMX(Engine):
         edit_mdp(fin="%s.mdp" % self.name, fout="%s-min.mdp" % self.name, options=min_opts)
 
         self.warngmx("grompp -c %s.gro -p %s.top -f %s-min.mdp -o %s-min.tpr" % (self.name, self.name, self.name, self.name))
-        self.callgmx("mdrun -deffnm %s-min -nt 1" % self.name)
+        self.callgmx("mdrun -deffnm %s-min -nt %i" % (self.name, self.gmx_threads))
         # self.callgmx("trjconv -f %s-min.trr -s %s-min.tpr -o %s-min.gro -ndec 9" % (self.name, self.name, self.name), stdin="System")
         self.callgmx("trjconv -f %s-min.trr -s %s-min.tpr -o %s-min.g96" % (self.name, self.name, self.name), stdin="System")
-        self.callgmx("g_energy -xvg no -f %s-min.edr -o %s-min-e.xvg" % (self.name, self.name), stdin='Potential')
-        
-        E = float(open("%s-min-e.xvg" % self.name).readlines()[-1].split()[1])
+
+        E = self.read_energy("%s-min.edr" % self.name)[-1]
         M = Molecule("%s.gro" % self.name, build_topology=False) + Molecule("%s-min.g96" % self.name)
         if not self.pbc:
             M.align(center=False)
@@ -927,21 +1093,18 @@ class GMX(Engine):
 
         ## Call grompp followed by mdrun.
         self.warngmx("grompp -c %s.gro -p %s.top -f %s-1.mdp -o %s.tpr" % (self.name, self.name, self.name, self.name))
-        self.callgmx("mdrun -deffnm %s -nt 1 -rerunvsite %s" % (self.name, "-rerun %s" % traj if traj else ''))
+        self.callgmx("mdrun -deffnm %s -nt %i -rerunvsite %s" % (self.name, self.gmx_threads, "-rerun %s" % traj if traj else ''))
 
         ## Gather information
         Result = OrderedDict()
 
-        ## Calculate and record energy
-        self.callgmx("g_energy -xvg no -f %s.edr -o %s-e.xvg" % (self.name, self.name), stdin='Potential')
-        Efile = open("%s-e.xvg" % self.name).readlines()
-        Result["Energy"] = np.array([float(Eline.split()[1]) for Eline in Efile])
+        ## Read the energy from the .edr file
+        Result["Energy"] = self.read_energy("%s.edr" % self.name)
 
-        ## Calculate and record force
+        ## Read the forces on the real atoms from the .trr file
         if force:
-            self.callgmx("g_traj -xvg no -s %s.tpr -f %s.trr -of %s-f.xvg -fp" % (self.name, self.name, self.name), stdin='System')
-            Result["Force"] = np.array([[float(j) for i, j in enumerate(line.split()[1:]) if self.AtomMask[int(i/3)]] \
-                                        for line in open("%s-f.xvg" % self.name).readlines()])
+            Forces = np.array(read_trr("%s.trr" % self.name)['f'])
+            Result["Force"] = Forces[:, np.array(self.AtomMask, dtype=bool), :].reshape(len(Forces), -1)
         ## Calculate and record dipole
         if dipole:
             self.callgmx("g_dipoles -s %s.tpr -f %s -o %s-d.xvg -xvg no" % (self.name, traj if traj else '%s.gro' % self.name, self.name), stdin="System\n")
@@ -1008,9 +1171,8 @@ class GMX(Engine):
         else:
             self.mol[shot].write("%s.gro" % self.name)
             self.warngmx("grompp -c %s.gro -p %s.top -f %s.mdp -o %s-1.tpr" % (self.name, self.name, self.name, self.name))
-            self.callgmx("mdrun -deffnm %s-1 -nt 1 -rerunvsite" % (self.name, self.name))
-            self.callgmx("g_energy -xvg no -f %s-1.edr -o %s-1-e.xvg" % (self.name, self.name), stdin='Potential')
-            E = float(open("%s-1-e.xvg" % self.name).readlines()[0].split()[1])
+            self.callgmx("mdrun -deffnm %s-1 -nt %i -rerunvsite" % (self.name, self.gmx_threads))
+            E = self.read_energy("%s-1.edr" % self.name)[0]
             return E, 0.0
 
     def interaction_energy(self, fraga, fragb):
@@ -1029,22 +1191,14 @@ class GMX(Engine):
         ## Call grompp followed by mdrun for interacting system.
         self.warngmx("grompp -c %s.gro -p %s.top -f %s-i.mdp -n %s.ndx -o %s-i.tpr" % \
                          (self.name, self.name, self.name, self.name, self.name))
-        self.callgmx("mdrun -deffnm %s-i -nt 1 -rerunvsite -rerun %s-all.gro" % (self.name, self.name))
-        self.callgmx("g_energy -f %s-i.edr -o %s-i-e.xvg -xvg no" % (self.name, self.name), stdin='Potential\n')
-        I = []
-        for line in open('%s-i-e.xvg' % self.name):
-            I.append(sum([float(i) for i in line.split()[1:]]))
-        I = np.array(I)
+        self.callgmx("mdrun -deffnm %s-i -nt %i -rerunvsite -rerun %s-all.gro" % (self.name, self.gmx_threads, self.name))
+        I = self.read_energy("%s-i.edr" % self.name)
 
         ## Call grompp followed by mdrun for noninteracting system.
         self.warngmx("grompp -c %s.gro -p %s.top -f %s-x.mdp -n %s.ndx -o %s-x.tpr" % \
                          (self.name, self.name, self.name, self.name, self.name))
-        self.callgmx("mdrun -deffnm %s-x -nt 1 -rerunvsite -rerun %s-all.gro" % (self.name, self.name))
-        self.callgmx("g_energy -f %s-x.edr -o %s-x-e.xvg -xvg no" % (self.name, self.name), stdin='Potential\n')
-        X = []
-        for line in open('%s-x-e.xvg' % self.name):
-            X.append(sum([float(i) for i in line.split()[1:]]))
-        X = np.array(X)
+        self.callgmx("mdrun -deffnm %s-x -nt %i -rerunvsite -rerun %s-all.gro" % (self.name, self.gmx_threads, self.name))
+        X = self.read_energy("%s-x.edr" % self.name)
 
         return (I - X) / 4.184 # kcal/mol
 
@@ -1139,7 +1293,7 @@ class GMX(Engine):
     def generate_positions(self):
         ## Call grompp followed by mdrun.
         self.warngmx("grompp -c %s.gro -p %s.top -f %s.mdp -o %s.tpr" % (self.name, self.name, self.name, self.name))
-        self.callgmx("mdrun -deffnm %s -nt 1 -rerunvsite -rerun %s-all.gro" % (self.name, self.name))
+        self.callgmx("mdrun -deffnm %s -nt %i -rerunvsite -rerun %s-all.gro" % (self.name, self.gmx_threads, self.name))
         self.callgmx("trjconv -f %s.trr -o %s-out.g96 -novel -noforce" % (self.name, self.name), stdin='System')
         NewMol = Molecule("%s-out.g96" % self.name, build_topology-False)
         return NewMol.xyzs
@@ -1591,6 +1745,8 @@ class AbInitio_GMX(AbInitio):
         self.set_option(tgt_opts,'coords',default="all.gro")
         self.set_option(tgt_opts,'gmx_top',default="topol.top")
         self.set_option(tgt_opts,'gmx_mdp',default="shot.mdp")
+        ## Number of threads for mdrun.
+        self.set_option(tgt_opts,'gmx_threads')
         self.engine_ = GMX
         ## Initialize base class.
         super(AbInitio_GMX,self).__init__(options,tgt_opts,forcefield)
@@ -1598,6 +1754,8 @@ class AbInitio_GMX(AbInitio):
 class BindingEnergy_GMX(BindingEnergy):
     """ Binding energy matching using Gromacs. """
     def __init__(self,options,tgt_opts,forcefield):
+        ## Number of threads for mdrun.
+        self.set_option(tgt_opts,'gmx_threads')
         self.engine_ = GMX
         ## Initialize base class.
         super(BindingEnergy_GMX,self).__init__(options,tgt_opts,forcefield)
@@ -1609,6 +1767,8 @@ class Interaction_GMX(Interaction):
         self.set_option(tgt_opts,'coords',default="all.gro")
         self.set_option(tgt_opts,'gmx_top',default="topol.top")
         self.set_option(tgt_opts,'gmx_mdp',default="shot.mdp")
+        ## Number of threads for mdrun.
+        self.set_option(tgt_opts,'gmx_threads')
         self.engine_ = GMX
         ## Initialize base class.
         super(Interaction_GMX,self).__init__(options,tgt_opts,forcefield)
@@ -1620,6 +1780,8 @@ class Moments_GMX(Moments):
         self.set_option(tgt_opts,'coords',default="conf.gro")
         self.set_option(tgt_opts,'gmx_top',default="topol.top")
         self.set_option(tgt_opts,'gmx_mdp',default="shot.mdp")
+        ## Number of threads for mdrun.
+        self.set_option(tgt_opts,'gmx_threads')
         self.engine_ = GMX
         ## Initialize base class.
         super(Moments_GMX,self).__init__(options,tgt_opts,forcefield)
@@ -1629,6 +1791,8 @@ class Vibration_GMX(Vibration):
     def __init__(self,options,tgt_opts,forcefield):
         ## Default file names for coordinates and key file.
         self.set_option(tgt_opts,'coords',default="conf.gro")
+        ## Number of threads for mdrun.
+        self.set_option(tgt_opts,'gmx_threads')
         self.engine_ = GMX
         ## Initialize base class.
         super(Vibration_GMX,self).__init__(options,tgt_opts,forcefield)
@@ -138,9 +138,8 @@ class Hessian(Target):
 
     def get(self, mvals, AGrad=False, AHess=False):
         """ Evaluate objective function. """
-        Answer = {'X':0.0, 'G':np.zeros(self.FF.np), 'H':np.zeros((self.FF.np, self.FF.np))}
         def compute(mvals_):
-            self.FF.make(mvals_)
+            self.FF.make(mvals_, write=not self.engine.ff_in_memory)
             Xx, Gx, Hx, freqs, normal_modes, M_opt = self.hessian_driver()
             # convert into internal hessian
             Xx *= 1/ Bohr2nm
@@ -156,17 +155,13 @@ class Hessian(Target):
             return (np.sqrt(self.wts)/self.denom) * (compute.Hq_flat - self.ref_Hq_flat)
 
         V = compute(mvals)
-        Answer['X'] = np.dot(V,V) * len(compute.freqs) # HJ: len(compute.freqs) is multiplied to match the scale of X2 with vib freq target X2
         # compute gradients and hessian
         dV = np.zeros((self.FF.np,len(V)))
         if AGrad or AHess:
-            for p in self.pgrad:
-                dV[p,:], _ = f12d3p(fdwrap(compute, mvals, p), h = self.h, f0 = V)
+            dV = self.fd_derivatives(compute, mvals, V)
 
-        for p in self.pgrad:
-            Answer['G'][p] = 2*np.dot(V, dV[p,:]) * len(compute.freqs)
-            for q in self.pgrad:
-                Answer['H'][p,q] = 2*np.dot(dV[p,:], dV[q,:]) * len(compute.freqs)
+        # HJ: len(compute.freqs) is multiplied to match the scale of X2 with vib freq target X2
+        Answer = self.gauss_newton(V, dV, scale=len(compute.freqs))
 
         if not in_fd():
             self.Hq_flat = compute.Hq_flat
@@ -423,18 +423,13 @@ class Hydration(Target):
 
     def get(self, mvals, AGrad=False, AHess=False):
         """ Evaluate objective function. """
-        Answer = {'X':0.0, 'G':np.zeros(self.FF.np), 'H':np.zeros((self.FF.np, self.FF.np))}
         if self.hfemode.lower() == 'single' or self.hfemode.lower() == 'sp':
             D, dD = self.get_sp(mvals, AGrad, AHess)
         elif self.hfemode.lower() == 'ti2':
             D, dD = self.get_ti2(mvals, AGrad, AHess)
         elif self.hfemode.lower() in ['exp_gas', 'exp_liq', 'exp_both']:
             D, dD = self.get_exp(mvals, AGrad, AHess)
-        Answer['X'] = np.dot(D,D) / self.denom**2 / (np.sum(self.whfe) if self.normalize else 1)
-        for p in self.pgrad:
-            Answer['G'][p] = 2*np.dot(D, dD[p,:]) / self.denom**2 / (np.sum(self.whfe) if self.normalize else 1)
-            for q in self.pgrad:
-                Answer['H'][p,q] = 2*np.dot(dD[p,:], dD[q,:]) / self.denom**2 / (np.sum(self.whfe) if self.normalize else 1)
+        Answer = self.gauss_newton(D, dD, scale=1.0 / self.denom**2 / (np.sum(self.whfe) if self.normalize else 1))
         if not in_fd():
             self.calc = self.hfe_dict
             if hasattr(self, 'hfe_err'):
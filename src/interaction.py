@@ -170,7 +170,6 @@ class Interaction(Target):
 
     def get(self, mvals, AGrad=False, AHess=False):
         """ Evaluate objective function. """
-        Answer = {'X':0.0, 'G':np.zeros(self.FF.np), 'H':np.zeros((self.FF.np, self.FF.np))}
 
         # If the weight is zero, turn all derivatives off.
         if (self.weight == 0.0):
@@ -179,7 +178,7 @@ class Interaction(Target):
 
         def callM(mvals_, dielectric=False):
             logger.info("\r")
-            pvals = self.FF.make(mvals_)
+            pvals = self.FF.make(mvals_, write=not self.engine.ff_in_memory)
             return self.engine.interaction_energy(self.select1, self.select2)
 
         logger.info("Executing\r")
@@ -204,16 +203,11 @@ class Interaction(Target):
 
         # Do the finite difference derivative.
         if AGrad or AHess:
-            for p in self.pgrad:
-                dV[p,:], _ = f12d3p(fdwrap(callM, mvals, p), h = self.h, f0 = emm)
+            dV = self.fd_derivatives(callM, mvals, emm)
             # Create the force field one last time.
             pvals  = self.FF.make(mvals)
 
-        Answer['X'] = np.dot(self.prefactor*D/self.divisor,D/self.divisor)
-        for p in self.pgrad:
-            Answer['G'][p] = 2*np.dot(self.prefactor*D/self.divisor, dV[p,:]/self.divisor)
-            for q in self.pgrad:
-                Answer['H'][p,q] = 2*np.dot(self.prefactor*dV[p,:]/self.divisor, dV[q,:]/self.divisor)
+        Answer = self.gauss_newton(D/self.divisor, dV/self.divisor, weights=self.prefactor)
 
         if not in_fd():
             self.emm = emm
@@ -66,17 +66,12 @@ class LeastSquares(Target):
             CHECK_BASIS = False
         else:
             CHECK_BASIS = False
-        Answer = {}
         Fac = 1000000
-        ## Dictionary for derivative terms
-        dM = {}
         # Create the new force field!!
         NP = len(mvals)
-        G = np.zeros(NP)
-        H = np.zeros((NP,NP))
         pvals = self.FF.make(mvals)
         if float('Inf') in pvals:
-            return {'X' : 1e10, 'G' : G, 'H' : H}
+            return {'X' : 1e10, 'G' : np.zeros(NP), 'H' : np.zeros((NP,NP))}
         Ans = self.driver()
         W = Ans[:,2]
         M = Ans[:,1]
@@ -86,6 +81,8 @@ class LeastSquares(Target):
         self.MAQ = np.mean(np.abs(Q))
 
         ns = len(M)
+        ## Array of derivative terms
+        dM = np.zeros((NP, ns))
         # Wrapper to the driver, which returns just the part that changes.
         def callM(mvals_):
             self.FF.make(mvals_)
@@ -106,20 +103,7 @@ class LeastSquares(Target):
                     dM[p] = dM_arr.copy()
             for p in xgrad:
                 self.pgrad.remove(p)
-        Objective = np.dot(W, D**2) * Fac
-        if AGrad:
-            for p in self.pgrad:
-                G[p] = 2 * np.dot(W, D*dM[p])
-                if not AHess: continue
-                H[p, p] = 2 * np.dot(W, dM[p]**2)
-                for q in range(p):
-                    if q not in self.pgrad: continue
-                    GNP = 2 * np.dot(W, dM[p] * dM[q])
-                    H[q,p] = GNP
-                    H[p,q] = GNP
-        G *= Fac
-        H *= Fac
-        Answer = {'X':Objective, 'G':G, 'H':H}
+        Answer = self.gauss_newton(D, dM, weights=W, scale=Fac, AGrad=AGrad, AHess=AGrad and AHess)
         if not in_fd():
             self.D = D
             self.objective = Answer['X']
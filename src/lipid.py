@@ -17,6 +17,7 @@ from forcebalance.finite_difference import *
 from forcebalance.nifty import *
 from forcebalance.nifty import _exec
 from forcebalance.target import Target
+from forcebalance.liquid import kln_to_kn, mbar_free_energies, mbar_weights
 import numpy as np
 from forcebalance.molecule import Molecule
 from re import match, sub
@@ -110,6 +111,8 @@ class Lipid(Target):
         self.do_self_pol = (self.self_pol_mu0 > 0.0 and self.self_pol_alpha > 0.0)
         # Enable anisotropic periodic box
         self.set_option(tgt_opts,'anisotropic_box',forceprint=True)
+        # Estimate the property uncertainties with the block bootstrap
+        self.set_option(tgt_opts,'block_bootstrap')
         # Whether to save trajectories (0 = never, 1 = delete after good step, 2 = keep all)
         self.set_option(tgt_opts,'save_traj')
 
@@ -181,6 +184,9 @@ class Lipid(Target):
         self.SavedTraj = defaultdict(dict)
         ## Evaluated energies for all trajectories (i.e. all iterations and all temperatures), using all mvals
         self.MBarEnergy = defaultdict(lambda:defaultdict(dict))
+        ## MBAR free energies from the last analysis, keyed by the tuple of sampled phase points,
+        ## which are the initial guess for the next one
+        self.mbar_f_k = {}
 
     def prepare_temp_directory(self):
         """ Prepare the temporary directory by copying in important files. """
@@ -307,7 +313,7 @@ class Lipid(Target):
         if all([i in os.listdir(there) for i in self.Labels]):
             for d in os.listdir(there):
                 if d in self.Labels:
-                    if os.path.exists(os.path.join(there, d, 'npt_result.p')):
+                    if result_path(os.path.join(there, d, 'npt_result')) is not None:
                         havepts += 1
         if (float(havepts)/len(self.Labels)) > 0.75:
             return 1
@@ -316,7 +322,7 @@ class Lipid(Target):
     def npt_simulation(self, temperature, pressure, simnum):
         """ Submit a NPT simulation to the Work Queue. """
         wq = getWorkQueue()
-        if not os.path.exists('npt_result.p'):
+        if result_path('npt_result') is None:
             link_dir_contents(os.path.join(self.root,self.rundir),os.getcwd())
             self.last_traj += [os.path.join(os.getcwd(), i) for i in self.extra_output]
             self.lipid_mol[simnum%len(self.lipid_mol)].write(self.lipid_coords, ftype='tinker' if self.engname == 'tinker' else None)
@@ -328,7 +334,7 @@ class Lipid(Target):
             else:
                 queue_up(wq, command = cmdstr+' > npt.out 2>&1',
                          input_files = self.nptfiles + self.scripts + ['forcebalance.p'],
-                         output_files = ['npt_result.p', 'npt.out'] + self.extra_output, tgt=self)
+                         output_files = ['npt_result.npz', 'npt.out'] + self.extra_output, tgt=self)
 
     def polarization_correction(self,mvals):
         d = self.gas_engine.get_multipole_moments(optimize=True)['dipole']
@@ -557,32 +563,18 @@ class Lipid(Target):
             if 'n_ic' in self.RefData:
                 self.lipid_mols[PT] = [Molecule(last_frame) for last_frame in self.lipid_mols[PT]]
                 n_uniq_ic = int(self.RefData['n_ic'][PT])
-                for ic in range(n_uniq_ic):
-                    if os.path.exists('./%s/trj_%s/npt_result.p' % (label, ic)):
-                        # Read in each each parallel simulation's data, and concatenate each property time series.
-                        ts = lp_load('./%s/trj_%s/npt_result.p' % (label, ic))
-                        if ic == 0:
-                            ts_concat = list(ts)
-                        else:
-                            for d_arr in range(len(ts)):
-                                if isinstance(ts[d_arr], np.ndarray):
-                                    # Gradients need a unique append format.
-                                    if d_arr == 5:
-                                        ts_concat[d_arr] = np.append(ts_concat[d_arr], ts[d_arr], axis = 1)
-                                    else:
-                                        ts_concat[d_arr] = np.append(ts_concat[d_arr], ts[d_arr], axis = 0)
-                                if isinstance(ts_concat[d_arr], list):
-                                    ts_concat[d_arr] = [np.append(ts_concat[d_arr][i], ts[d_arr][i], axis = 1) for i in range(len(ts_concat[d_arr]))]
-                        # Write concatenated time series to a pickle file.
-                        if ic == (int(n_uniq_ic) - 1):
-                            lp_dump((ts_concat), './%s/npt_result.p' % label)
-            if os.path.exists('./%s/npt_result.p' % label):
-                logger.info('Reading information from ./%s/npt_result.p\n' % label)
+                # Read in each parallel simulation's data, and concatenate each property time series.
+                ICResults = [load_result('./%s/trj_%s/npt_result' % (label, ic), 'npt_lipid', mmap=True) for ic in range(n_uniq_ic)]
+                if ICResults[-1] is not None:
+                    ICResults = [ts for ts in ICResults if ts is not None]
+                    save_result('./%s/npt_result' % label, 'npt_lipid', **ICResults[0].concatenate(ICResults[1:]))
+            if result_path('./%s/npt_result' % label) is not None:
+                logger.info('Reading information from %s\n' % result_path('./%s/npt_result' % label))
                 Points.append(PT)
-                Results[tt] = lp_load('./%s/npt_result.p' % label)
+                Results[tt] = load_result('./%s/npt_result' % label, 'npt_lipid', mmap=True)
                 tt += 1
             else:
-                logger.warning('The file ./%s/npt_result.p does not exist so we cannot read it\n' % label)
+                logger.warning('The file ./%s/npt_result.npz does not exist so we cannot read it\n' % label)
                 pass
                 # for obs in self.RefData:
                 #     del self.RefData[obs][PT]
@@ -590,9 +582,11 @@ class Lipid(Target):
             logger.error('The lipid simulations have terminated with \x1b[1;91mno readable data\x1b[0m - this is a problem!\n')
             raise RuntimeError
 
-        # Assign variable names to all the stuff in npt_result.p
-        Rhos, Vols, Potentials, Energies, Dips, Grads, GDips, \
-            Rho_errs, Alpha_errs, Kappa_errs, Cp_errs, Eps0_errs, NMols, Als, Al_errs, Scds, Scd_errs, LKappa_errs = ([Results[t][i] for t in range(len(Points))] for i in range(18))
+        # Gather the fields of npt_result at all of the phase points.
+        Rhos, Vols, Energies, Dips, Grads, GDips, \
+            Rho_errs, Alpha_errs, Kappa_errs, Cp_errs, Eps0_errs, NMols, Als, Al_errs, Scds, Scd_errs, LKappa_errs = \
+            ([Results[t][key] for t in range(len(Points))] for key in ['Rhos', 'Volumes', 'Energies', 'Dips', 'G', 'GDips', 'Rho_err', 'Alpha_err', 'Kappa_err',
+                                                                     'Cp_err', 'Eps0_err', 'NMol', 'Als', 'Al_err', 'Scds', 'Scd_err', 'LKappa_err'])
         # Determine the number of molecules
         if len(set(NMols)) != 1:
             logger.error(str(NMols))
@@ -663,8 +657,11 @@ class Lipid(Target):
         W1 = None
         if len(BPoints) > 1:
             logger.info("Running MBAR analysis on %i states...\n" % len(BPoints))
-            mbar = pymbar.MBAR(U_kln, N_k, verbose=mbar_verbose, relative_tolerance=5.0e-8)
-            W1 = mbar.getWeights()
+            u_kn = kln_to_kn(U_kln)
+            key = tuple(BPoints)
+            f_k = mbar_free_energies(u_kn, N_k, self.mbar_f_k.get(key), verbose=mbar_verbose)
+            self.mbar_f_k[key] = f_k
+            W1 = mbar_weights(u_kn, N_k, u_kn, f_k)
             logger.info("Done\n")
         elif len(BPoints) == 1:
             W1 = np.ones((BPoints*Shots,BPoints))
@@ -30,10 +30,14 @@ from forcebalance.optimizer import Counter
 from collections import defaultdict, namedtuple, OrderedDict
 import csv
 import copy
+import hashlib
 
 from forcebalance.output import getLogger
 logger = getLogger(__name__)
 
+# The unit that converts atmospheres * nm**3 into kj/mol :)
+pvkj=0.061019351687175
+
 def weight_info(W, PT, N_k, verbose=True, PTS=None):
     C = []
     N = 0
@@ -83,6 +87,80 @@ def weight_info(W, PT, N_k, verbose=True, PTS=None):
         logger.info("InfoContent: % .2f snapshots (%.2f %%)\n" % (I, 100*I/len(W)))
     return C
 
+## MBAR free energies that were already solved for, keyed by a hash of the reduced potentials.
+MBAR_CACHE = OrderedDict()
+## Number of solutions to keep in the MBAR cache.
+MBAR_CACHE_SIZE = 64
+
+def kln_to_kn(U_kln):
+    """
+    Convert reduced potentials from the U_kln layout (the energy of
+    snapshot n from state k at state l) to u_kn (K x N), where the
+    snapshots of state 0 come first, then those of state 1 and so on.
+    """
+    return np.transpose(U_kln, (1, 0, 2)).reshape(U_kln.shape[1], -1)
+
+def mbar_free_energies(u_kn, N_k, f_k=None, verbose=False):
+
+    """
+    Dimensionless free energies of the sampled states from MBAR.
+
+    Solutions are cached by a hash of the input, so analyzing the same
+    data again (for example in read() or when continuing an
+    optimization) does not solve MBAR again.  An initial guess, such as
+    the free energies of the same states in the previous iteration,
+    lets the solver start close to the solution.
+
+    @param[in] u_kn Reduced potentials of the snapshots at the sampled states (K x N)
+    @param[in] N_k Number of snapshots from each sampled state
+    @param[in] f_k Initial guess of the free energies (optional)
+    @param[in] verbose Print the progress of the solver
+    @return f_k Free energies of the sampled states relative to the first one
+
+    """
+    u_kn = np.ascontiguousarray(u_kn, dtype=np.float64)
+    N_k = np.array(N_k, dtype=np.int64)
+    if len(N_k) == 1:
+        return np.zeros(1)
+    key = hashlib.sha1(u_kn.tobytes() + N_k.tobytes() + str(u_kn.shape).encode()).hexdigest()
+    if key in MBAR_CACHE:
+        MBAR_CACHE.move_to_end(key)
+        return MBAR_CACHE[key].copy()
+    if f_k is not None and np.shape(f_k) == N_k.shape and np.all(np.isfinite(f_k)):
+        f_k = np.array(f_k, dtype=np.float64) - f_k[0]
+    else:
+        f_k = None
+    f_k = pymbar.MBAR(u_kn, N_k, verbose=verbose, relative_tolerance=5.0e-8, initial_f_k=f_k).f_k
+    MBAR_CACHE[key] = f_k.copy()
+    while len(MBAR_CACHE) > MBAR_CACHE_SIZE:
+        MBAR_CACHE.popitem(last=False)
+    return f_k
+
+def mbar_weights(u_kn, N_k, u_jn, f_k=None):
+
+    """
+    MBAR weights of the snapshots at a set of target states, which do
+    not need to be among the sampled states.
+
+    @param[in] u_kn Reduced potentials of the snapshots at the sampled states (K x N);
+    the first N_k[0] snapshots come from state 0, the next N_k[1] from state 1 and so on
+    @param[in] N_k Number of snapshots from each sampled state
+    @param[in] u_jn Reduced potentials of the snapshots at the target states (J x N)
+    @param[in] f_k Free energies of the sampled states, if already known (see mbar_free_energies)
+    @return W Weights of the snapshots at each target state (N x J); each column sums to one
+
+    """
+    N_k = np.array(N_k)
+    if f_k is None:
+        f_k = mbar_free_energies(u_kn, N_k)
+    # Logarithm of the mixture of sampled distributions that the snapshots are drawn from.
+    x = (np.log(N_k) + f_k)[:, np.newaxis] - u_kn
+    xmax = np.max(x, axis=0)
+    logw = -u_jn - (xmax + np.log(np.sum(np.exp(x - xmax), axis=0)))
+    W = np.exp(logw - np.max(logw, axis=1)[:, np.newaxis])
+    W /= np.sum(W, axis=1)[:, np.newaxis]
+    return W.T
+
 # NPT_Trajectory = namedtuple('NPT_Trajectory', ['fnm', 'Rhos', 'pVs', 'Energies', 'Grads', 'mEnergies', 'mGrads', 'Rho_errs', 'Hvap_errs'])
 
 class Liquid(Target):
@@ -144,6 +222,8 @@ class Liquid(Target):
         self.do_self_pol = (self.self_pol_mu0 > 0.0 and self.self_pol_alpha > 0.0)
         # Enable anisotropic periodic box
         self.set_option(tgt_opts,'anisotropic_box',forceprint=True)
+        # Estimate the property uncertainties with the block bootstrap
+        self.set_option(tgt_opts,'block_bootstrap')
         # Whether to save trajectories (0 = never, 1 = delete after good step, 2 = keep all)
         self.set_option(tgt_opts,'save_traj')
         # Set the number of molecules by hand (in case ForceBalance doesn't get the right number from the structure)
@@ -162,6 +242,21 @@ class Liquid(Target):
         self.set_option(tgt_opts,'pure_num_grad', forceprint=True)
         # Finite difference size for pure_num_grad
         self.set_option(tgt_opts,'liquid_fdiff_h', forceprint=True)
+        # Number of previous simulation sets to keep for reweighting to new parameters
+        self.set_option(tgt_opts,'liquid_reweight')
+        # Effective sample size needed to use reweighting instead of new simulations
+        self.set_option(tgt_opts,'reweight_neff')
+        # Largest parameter change over which stored simulations are reweighted
+        self.set_option(tgt_opts,'reweight_max_step')
+        # Target for the statistical errors that chooses the simulation length at each phase point
+        self.set_option(tgt_opts,'liquid_error_target')
+        # Upper limit of the simulation length chosen from the errors
+        self.set_option(tgt_opts,'liquid_max_md_steps')
+        if self.liquid_error_target > 0.0 and self.adapt_errors:
+            # adapt_errors combines the data sets at the same parameters and doubles liquid_md_steps,
+            # which assumes that every phase point ran liquid_md_steps.
+            logger.error("liquid_error_target chooses the simulation length at each phase point and cannot be combined with adapt_errors\n")
+            raise RuntimeError
         #======================================#
         #     Variables which are set here     #
         #======================================#
@@ -228,6 +323,16 @@ class Liquid(Target):
         ## Saved results for all iterations
         # self.SavedMVals = []
         self.AllResults = defaultdict(lambda:defaultdict(list))
+        ## Snapshots from the most recent sets of simulations, as a list of (mvals, [simulations])
+        self.Snapshots = []
+        ## Snapshot data and weights for the current parameters if they were reweighted instead of simulated
+        self.Reweighted = None
+        ## MBAR free energies from the last analysis, keyed by the tuple of sampled phase points
+        ## (with the phase), which are the initial guess for the next one
+        self.mbar_f_k = {}
+        ## Numbers of liquid and gas production steps for the next simulation at each phase point,
+        ## if they were chosen from the errors (see adapt_md_steps)
+        self.md_steps = OrderedDict()
 
     def post_init(self, options):
         # Prepare the temporary directory.
@@ -359,21 +464,24 @@ class Liquid(Target):
         if all([i in os.listdir(there) for i in self.Labels]):
             for d in os.listdir(there):
                 if d in self.Labels:
-                    if os.path.exists(os.path.join(there, d, 'npt_result.p')):
+                    if result_path(os.path.join(there, d, 'npt_result')) is not None:
                         havepts += 1
         if (float(havepts)/len(self.Labels)) > 0.75:
             return 1
         else:
             return 0
 
-    def npt_simulation(self, temperature, pressure, simnum):
-        """ Submit a NPT simulation to the Work Queue. """
+    def npt_simulation(self, temperature, pressure, simnum, md_steps=None):
+        """ Submit a NPT simulation to the Work Queue, optionally with the
+        numbers of liquid and gas production steps (md_steps). """
         wq = getWorkQueue()
-        if not os.path.exists('npt_result.p'):
+        if result_path('npt_result') is None:
             link_dir_contents(os.path.join(self.root,self.rundir),os.getcwd())
             self.last_traj += [os.path.join(os.getcwd(), i) for i in self.extra_output]
             self.liquid_mol[simnum%len(self.liquid_mol)].write(self.liquid_coords, ftype='tinker' if self.engname == 'tinker' else None)
             cmdstr = '%s python npt.py %s %.3f %.3f' % (self.nptpfx, self.engname, temperature, pressure)
+            if md_steps is not None:
+                cmdstr += ' --liquid_md_steps %i --gas_md_steps %i' % md_steps
             if wq is None:
                 logger.info("Running condensed phase simulation locally.\n")
                 logger.info("You may tail -f %s/npt.out in another terminal window\n" % os.getcwd())
@@ -388,12 +496,12 @@ class Liquid(Target):
                     mol2_send = []
                 queue_up(wq, command = cmdstr+' > npt.out 2>&1 ',
                          input_files = self.nptfiles + self.scripts + mol2_send + ['forcebalance.p'],
-                         output_files = ['npt_result.p', 'npt.out'] + self.extra_output, tgt=self)
+                         output_files = ['npt_result.npz', 'npt.out'] + self.extra_output, tgt=self)
 
     def nvt_simulation(self, temperature):
         """ Submit a NVT simulation to the Work Queue. """
         wq = getWorkQueue()
-        if not os.path.exists('nvt_result.p'):
+        if result_path('nvt_result') is None:
             link_dir_contents(os.path.join(self.root,self.rundir),os.getcwd())
             cmdstr = '%s python nvt.py %s %.3f' % (self.nptpfx, self.engname, temperature)
             if wq is None:
@@ -410,7 +518,7 @@ class Liquid(Target):
                     mol2_send = []
                 queue_up(wq, command = cmdstr+' > nvt.out 2>&1 ',
                          input_files = self.nvtfiles + self.scripts + mol2_send + ['forcebalance.p'],
-                         output_files = ['nvt_result.p', 'nvt.out'] + self.extra_output, tgt=self)
+                         output_files = ['nvt_result.npz', 'nvt.out'] + self.extra_output, tgt=self)
 
     def polarization_correction(self,mvals):
         self.FF.make(mvals)
@@ -542,6 +650,12 @@ class Liquid(Target):
         # This routine is called by Objective.stage() will run before "get".
         # It submits the jobs to the Work Queue and the stage() function will wait for jobs to complete.
         #
+        # If the snapshots of previous simulations can be reweighted to these parameters, no jobs are needed.
+        if self.liquid_reweight and not self.pure_num_grad and self.reweight(mvals):
+            printcool("Target: %s - reweighting previous simulations instead of launching new ones" % self.name, color=0)
+            lp_dump((self.FF,mvals,self.OptionDict,AGrad),'forcebalance.p')
+            return
+        self.Reweighted = None
         # First dump the force field to a pickle file
         printcool("Target: %s - launching MD simulations\nTime steps: %i (eq) + %i (md)" % (self.name, self.liquid_eq_steps, self.liquid_md_steps), color=0)
         if 'surf_ten' in self.RefData:
@@ -574,7 +688,7 @@ class Liquid(Target):
                 if not os.path.exists(label):
                     os.makedirs(label)
                 os.chdir(label)
-                self.npt_simulation(T,P,snum)
+                self.npt_simulation(T,P,snum,self.md_steps.get(pt))
                 if 'surf_ten' in self.RefData and pt in self.RefData['surf_ten']:
                     self.nvt_simulation(T)
                 os.chdir('..')
@@ -620,6 +734,7 @@ class Liquid(Target):
         if len(mvals) > 0 and (np.max(np.abs(mvals1 - mvals)) > 1e-3):
             warn_press_key("mvals from forcebalance.p does not match up with internal values! (Are you reading data from a previous run?)\nmvals(call)=%s mvals(disk)=%s" % (mvals, mvals1))
 
+        Stored = []
         for dn in range(Counter()-1, -1, -1):
             cwd = os.getcwd()
             os.chdir(self.absrd(inum=dn))
@@ -630,23 +745,27 @@ class Liquid(Target):
             tt = 0
             logger.info('Reading liquid data from %s\n' % os.getcwd())
             for label, PT in zip(self.Labels, self.PhasePoints):
-                if os.path.exists('./%s/npt_result.p' % label):
+                if result_path('./%s/npt_result' % label) is not None:
                     Points.append(PT)
-                    Results[tt] = lp_load('./%s/npt_result.p' % label)
+                    Results[tt] = load_result('./%s/npt_result' % label, 'npt', mmap=True)
                     if 'hvap' in self.RefData and PT[0] not in [i[0] for i in mPoints]:
                         mPoints.append(PT)
                     tt += 1
                 else:
                     logger.warning('In %s :\n' % os.getcwd())
-                    logger.warning('The file ./%s/npt_result.p does not exist so we cannot read it\n' % label)
+                    logger.warning('The file ./%s/npt_result.npz does not exist so we cannot read it\n' % label)
                     pass
             if len(Points) == 0:
+                if self.liquid_reweight:
+                    # The properties at this iteration were estimated by reweighting.
+                    os.chdir(cwd)
+                    continue
                 logger.error('The liquid simulations have terminated with \x1b[1;91mno readable data\x1b[0m - this is a problem!\n')
                 raise RuntimeError
 
-            # Assign variable names to all the stuff in npt_result.p
-            Rhos, Vols, Potentials, Energies, Dips, Grads, GDips, mPotentials, mEnergies, mGrads, \
-                Rho_errs, Hvap_errs, Alpha_errs, Kappa_errs, Cp_errs, Eps0_errs, NMols = ([Results[t][i] for t in range(len(Points))] for i in range(17))
+            # Gather the fields of npt_result at all of the phase points.
+            Rhos, Vols, Energies, Dips, Grads, GDips, mEnergies, mGrads, NMols = \
+                ([Results[t][key] for t in range(len(Points))] for key in ['Rhos', 'Volumes', 'Energies', 'Dips', 'G', 'GDips', 'mEnergies', 'mG', 'NMol'])
             # Determine the number of molecules
             if len(set(NMols)) != 1:
                 logger.error(str(NMols))
@@ -655,6 +774,9 @@ class Liquid(Target):
             else:
                 NMol = list(set(NMols))[0]
 
+            if self.liquid_reweight:
+                Stored.append((mprev, Points, mPoints, Results))
+
             if not self.adapt_errors:
                 self.AllResults = defaultdict(lambda:defaultdict(list))
 
@@ -663,29 +785,185 @@ class Liquid(Target):
                 logger.info("Data sets is not full, will not use for concatenation.\n")
                 astrm += "_"*(dn+1)
 
-            self.AllResults[astrm]['Pts'].append(Points)
-            self.AllResults[astrm]['mPts'].append(mPoints)
-            self.AllResults[astrm]['E'].append(np.array(Energies))
-            self.AllResults[astrm]['V'].append(np.array(Vols))
-            self.AllResults[astrm]['R'].append(np.array(Rhos))
-            self.AllResults[astrm]['Dx'].append(np.array([d[:,0] for d in Dips]))
-            self.AllResults[astrm]['Dy'].append(np.array([d[:,1] for d in Dips]))
-            self.AllResults[astrm]['Dz'].append(np.array([d[:,2] for d in Dips]))
-            self.AllResults[astrm]['G'].append(np.array(Grads))
-            self.AllResults[astrm]['GDx'].append(np.array([gd[0] for gd in GDips]))
-            self.AllResults[astrm]['GDy'].append(np.array([gd[1] for gd in GDips]))
-            self.AllResults[astrm]['GDz'].append(np.array([gd[2] for gd in GDips]))
-            self.AllResults[astrm]['L'].append(len(Energies[0]))
-            self.AllResults[astrm]['Steps'].append(self.liquid_md_steps)
-
-            if len(mPoints) > 0:
-                self.AllResults[astrm]['mE'].append(np.array([i for pt, i in zip(Points,mEnergies) if pt in mPoints]))
-                self.AllResults[astrm]['mG'].append(np.array([i for pt, i in zip(Points,mGrads) if pt in mPoints]))
+            self.store_results(astrm, Points, mPoints, Energies, Vols, Rhos, Dips, Grads, GDips, mEnergies, mGrads)
 
             os.chdir(cwd)
 
+        # Store the snapshots in the order of the iterations.
+        for args in reversed(Stored):
+            self.store_snapshots(*args)
+        if self.liquid_reweight and not any([result_path('./%s/npt_result' % label) is not None for label in self.Labels]):
+            self.reweight(mvals)
         return self.get(mvals, AGrad, AHess)
 
+    def store_results(self, astrm, Points, mPoints, Energies, Vols, Rhos, Dips, Grads, GDips, mEnergies, mGrads):
+
+        """
+        Add the time series of one set of simulations to AllResults,
+        where the data sets at the same parameters are combined.  The
+        series are kept per phase point, because the simulations at
+        different phase points may have different lengths (see
+        adapt_md_steps).
+
+        @param[in] astrm Key of the parameter values in AllResults
+        @param[in] Points Phase points of the simulations
+        @param[in] mPoints Phase points that have gas phase simulations for the enthalpy of vaporization
+        @param[in] Energies, Vols, Rhos, Dips, Grads, GDips, mEnergies, mGrads Fields of npt_result at each phase point
+
+        """
+        self.AllResults[astrm]['Pts'].append(Points)
+        self.AllResults[astrm]['mPts'].append(mPoints)
+        self.AllResults[astrm]['E'].append([np.array(e) for e in Energies])
+        self.AllResults[astrm]['V'].append([np.array(v) for v in Vols])
+        self.AllResults[astrm]['R'].append([np.array(r) for r in Rhos])
+        self.AllResults[astrm]['Dx'].append([np.array(d)[:,0] for d in Dips])
+        self.AllResults[astrm]['Dy'].append([np.array(d)[:,1] for d in Dips])
+        self.AllResults[astrm]['Dz'].append([np.array(d)[:,2] for d in Dips])
+        self.AllResults[astrm]['G'].append([np.array(g) for g in Grads])
+        self.AllResults[astrm]['GDx'].append([np.array(gd)[0] for gd in GDips])
+        self.AllResults[astrm]['GDy'].append([np.array(gd)[1] for gd in GDips])
+        self.AllResults[astrm]['GDz'].append([np.array(gd)[2] for gd in GDips])
+        self.AllResults[astrm]['L'].append([len(e) for e in Energies])
+        self.AllResults[astrm]['Steps'].append(self.liquid_md_steps)
+        if len(mPoints) > 0:
+            self.AllResults[astrm]['mE'].append([np.array(i) for pt, i in zip(Points,mEnergies) if pt in mPoints])
+            self.AllResults[astrm]['mG'].append([np.array(i) for pt, i in zip(Points,mGrads) if pt in mPoints])
+
+    def store_snapshots(self, mvals, Points, mPoints, Results):
+
+        """
+        Keep the snapshots of one set of simulations so that they can be
+        reweighted to other parameters (see reweight).  Only the most
+        recent liquid_reweight sets are kept.  Sets without energy
+        derivatives are skipped, because the derivatives are needed to
+        evaluate the snapshot energies at other parameters.
+
+        @param[in] mvals Mathematical parameter values of the simulations
+        @param[in] Points Phase points of the simulations
+        @param[in] mPoints Phase points that have gas phase simulations for the enthalpy of vaporization
+        @param[in] Results Contents of npt_result for each phase point (see load_result)
+
+        """
+        Sims = []
+        for t, PT in enumerate(Points):
+            Result = Results[t]
+            if not np.any(Result['G']):
+                return
+            Sim = OrderedDict([('PT', PT), ('NMol', Result['NMol']), ('E', np.array(Result['Energies'])), ('V', np.array(Result['Volumes'])),
+                               ('R', np.array(Result['Rhos'])), ('D', np.array(Result['Dips']).T), ('G', np.array(Result['G'])),
+                               ('GD', np.array(Result['GDips'])), ('Errs', [Result[key] for key in ['Rho_err', 'Hvap_err', 'Alpha_err', 'Kappa_err', 'Cp_err', 'Eps0_err']])])
+            if PT in mPoints:
+                Sim['mE'] = np.array(Result['mEnergies'])
+                Sim['mG'] = np.array(Result['mG'])
+            Sims.append(Sim)
+        for m0, Sims0 in self.Snapshots:
+            if np.array_equal(m0, mvals) and np.array_equal(Sims0[0]['E'], Sims[0]['E']):
+                return
+        self.Snapshots.append((np.array(mvals), Sims))
+        del self.Snapshots[:-self.liquid_reweight]
+
+    def reweight(self, mvals):
+
+        """
+        Try to estimate the properties at new parameter values by
+        reweighting the stored snapshots of previous simulations with
+        MBAR, instead of running new simulations.  Every stored
+        simulation is one sampled state, and the energies of all of the
+        snapshots at its parameters and at the new parameters are
+        evaluated to first order using their parameter derivatives.
+        Because this estimate is only good for small parameter changes,
+        only the simulations within reweight_max_step of the new
+        parameters are used.
+
+        This only succeeds if there are enough effective samples at
+        every phase point (see the reweight_neff option), which is
+        usually the case for small optimization steps, such as after
+        a step is rejected.
+
+        @param[in] mvals Mathematical parameter values
+        @return True if the snapshots were reweighted (in self.Reweighted)
+
+        """
+        self.Reweighted = None
+        if len(self.Snapshots) == 0 or 'surf_ten' in self.RefData:
+            return False
+        mvals = np.array(mvals)
+        # The energies at the new parameters are extrapolated to first order, which the
+        # effective sample size cannot check, so only nearby simulations are used.
+        Snapshots = [(m0, Sims) for m0, Sims in self.Snapshots if np.linalg.norm(mvals - m0) <= self.reweight_max_step]
+        if len(Snapshots) == 0:
+            logger.info("No stored liquid simulations within %.3f of the current parameters, running new simulations\n" % self.reweight_max_step)
+            return False
+        Sims = [(m0, Sim) for m0, Sims in Snapshots for Sim in Sims]
+        mSims = [(m0, Sim) for m0, Sim in Sims if 'mE' in Sim]
+        if 'hvap' in self.RefData:
+            mPoints = []
+            for PT in self.PhasePoints:
+                if PT[0] not in [i[0] for i in mPoints]:
+                    mPoints.append(PT)
+            if len(mSims) == 0:
+                return False
+        else:
+            mPoints = []
+        NMols = set([Sim['NMol'] for m0, Sim in Sims])
+        if len(NMols) != 1:
+            return False
+        NMol = list(NMols)[0]
+
+        def energies(Sims, key, m):
+            # Energies of all snapshots at parameters m, to first order in the parameter changes.
+            return np.concatenate([Sim[key] + np.dot(m - m0, Sim[key.replace('E', 'G')]) for m0, Sim in Sims])
+
+        def pressure(PT):
+            return PT[1] / 1.01325 if PT[2] == 'bar' else PT[1]
+
+        # Condensed phase.
+        N_k = np.array([len(Sim['E']) for m0, Sim in Sims])
+        V = np.concatenate([Sim['V'] for m0, Sim in Sims])
+        Ecache = {}
+        def reduced_potential(m, PT):
+            key = tuple(m)
+            if key not in Ecache:
+                Ecache[key] = energies(Sims, 'E', m)
+            return (Ecache[key] + pressure(PT)*V*pvkj) / (kb*PT[0])
+        u_kn = np.array([reduced_potential(m0, Sim['PT']) for m0, Sim in Sims])
+        u_jn = np.array([reduced_potential(mvals, PT) for PT in self.PhasePoints])
+        W2 = mbar_weights(u_kn, N_k, u_jn)
+        Neff = 1.0 / np.sum(W2**2, axis=0)
+        # Gas phase.
+        if len(mPoints) > 0:
+            mN_k = np.array([len(Sim['mE']) for m0, Sim in mSims])
+            mEcache = {}
+            def m_reduced_potential(m, PT):
+                key = tuple(m)
+                if key not in mEcache:
+                    mEcache[key] = energies(mSims, 'mE', m)
+                return mEcache[key] / (kb*PT[0])
+            mu_kn = np.array([m_reduced_potential(m0, Sim['PT']) for m0, Sim in mSims])
+            mu_jn = np.array([m_reduced_potential(mvals, PT) for PT in mPoints])
+            mW2 = mbar_weights(mu_kn, mN_k, mu_jn)
+            mNeff = 1.0 / np.sum(mW2**2, axis=0)
+        else:
+            mN_k, mW2, mNeff = np.ones(1), None, np.array([np.inf])
+        logger.info("Reweighting %i stored liquid simulations to the current parameters: %.1f effective samples (%.1f in the gas phase) at the worst phase point\n"
+                    % (len(Sims), np.min(Neff), np.min(mNeff)))
+        if np.min(Neff) < self.reweight_neff * np.mean(N_k) or np.min(mNeff) < self.reweight_neff * np.mean(mN_k):
+            logger.info("Not enough effective samples, running new simulations\n")
+            return False
+
+        D = np.concatenate([Sim['D'] for m0, Sim in Sims], axis=1)
+        GD = np.concatenate([Sim['GD'] for m0, Sim in Sims], axis=2)
+        dD = np.concatenate([np.einsum('p,ipn->in', mvals - m0, Sim['GD']) for m0, Sim in Sims], axis=1)
+        Data = OrderedDict([('E', Ecache[tuple(mvals)]), ('V', V), ('R', np.concatenate([Sim['R'] for m0, Sim in Sims])),
+                            ('Dx', D[0] + dD[0]), ('Dy', D[1] + dD[1]), ('Dz', D[2] + dD[2]),
+                            ('G', np.concatenate([Sim['G'] for m0, Sim in Sims], axis=1)),
+                            ('GDx', GD[0]), ('GDy', GD[1]), ('GDz', GD[2]),
+                            ('mE', mEcache[tuple(mvals)] if len(mPoints) > 0 else None),
+                            ('mG', np.concatenate([Sim['mG'] for m0, Sim in mSims], axis=1) if len(mPoints) > 0 else None)])
+        Errs = OrderedDict([(key, [Sim['Errs'][i] for m0, Sim in Sims]) for i, key in enumerate(['rho', 'hvap', 'alpha', 'kappa', 'cp', 'eps0'])])
+        self.Reweighted = (list(self.PhasePoints), mPoints, NMol, Data, W2, mW2, N_k, Errs)
+        return True
+
     def get(self, mvals, AGrad=True, AHess=True):
         """ Wrapper of self.get_normal() and self.get_pure_num_grad() """
         if self.pure_num_grad:
@@ -732,6 +1010,11 @@ class Liquid(Target):
         if len(mvals) > 0 and (np.max(np.abs(mvals1 - mvals)) > 1e-3):
             warn_press_key("mvals from forcebalance.p does not match up with internal values! (Are you reading data from a previous run?)\nmvals(call)=%s mvals(disk)=%s" % (mvals, mvals1))
 
+        if self.Reweighted is not None:
+            # No simulations were run at these parameters; use the snapshots of previous simulations.
+            Points, mPoints, NMol, Data, W2, mW2, N_k, Errs = self.Reweighted
+            return self.calc_properties(mvals, AGrad, Points, mPoints, NMol, Data, W2, mW2, N_k, Errs, {})
+
         mbar_verbose = False
 
         Answer = {}
@@ -744,10 +1027,10 @@ class Liquid(Target):
         stResults = {} # Storing the results from the NVT run for surface tension
         tt = 0
         for label, PT in zip(self.Labels, self.PhasePoints):
-            if os.path.exists('./%s/npt_result.p' % label):
-                logger.info('Reading information from ./%s/npt_result.p\n' % label)
+            if result_path('./%s/npt_result' % label) is not None:
+                logger.info('Reading information from %s\n' % result_path('./%s/npt_result' % label))
                 Points.append(PT)
-                Results[tt] = lp_load('./%s/npt_result.p' % label)
+                Results[tt] = load_result('./%s/npt_result' % label, 'npt', mmap=True)
                 if 'hvap' in self.RefData and PT[0] not in [i[0] for i in mPoints]:
                     mPoints.append(PT)
                 if 'mbar' in self.RefData and PT in self.RefData['mbar'] and self.RefData['mbar'][PT]:
@@ -755,16 +1038,16 @@ class Liquid(Target):
                     if 'hvap' in self.RefData and PT[0] not in [i[0] for i in mBPoints]:
                         mBPoints.append(PT)
                 if 'surf_ten' in self.RefData and PT in self.RefData['surf_ten']:
-                    if os.path.exists('./%s/nvt_result.p' % label):
-                        stResults[PT] = lp_load('./%s/nvt_result.p' % label)
+                    if result_path('./%s/nvt_result' % label) is not None:
+                        stResults[PT] = load_result('./%s/nvt_result' % label, 'nvt')
                     else:
                         logger.warning('In %s :\n' % os.getcwd())
-                        logger.warning('The file ./%s/nvt_result.p does not exist so we cannot read it\n' % label)
+                        logger.warning('The file ./%s/nvt_result.npz does not exist so we cannot read it\n' % label)
                         pass
                 tt += 1
             else:
                 logger.warning('In %s :\n' % os.getcwd())
-                logger.warning('The file ./%s/npt_result.p does not exist so we cannot read it\n' % label)
+                logger.warning('The file ./%s/npt_result.npz does not exist so we cannot read it\n' % label)
                 pass
         if len(Points) == 0:
             logger.error('The liquid simulations have terminated with \x1b[1;91mno readable data\x1b[0m - this is a problem!\n')
@@ -776,9 +1059,11 @@ class Liquid(Target):
         if len(mBPoints) == 1:
             mBPoints = []
 
-        # Assign variable names to all the stuff in npt_result.p
-        Rhos, Vols, Potentials, Energies, Dips, Grads, GDips, mPotentials, mEnergies, mGrads, \
-            Rho_errs, Hvap_errs, Alpha_errs, Kappa_errs, Cp_errs, Eps0_errs, NMols = ([Results[t][i] for t in range(len(Points))] for i in range(17))
+        # Gather the fields of npt_result at all of the phase points.
+        Rhos, Vols, Energies, Dips, Grads, GDips, mEnergies, mGrads, NMols, \
+            Rho_errs, Hvap_errs, Alpha_errs, Kappa_errs, Cp_errs, Eps0_errs = \
+            ([Results[t][key] for t in range(len(Points))] for key in ['Rhos', 'Volumes', 'Energies', 'Dips', 'G', 'GDips', 'mEnergies', 'mG', 'NMol',
+                                                                     'Rho_err', 'Hvap_err', 'Alpha_err', 'Kappa_err', 'Cp_err', 'Eps0_err'])
         # Determine the number of molecules
         if len(set(NMols)) != 1:
             logger.error(str(NMols))
@@ -787,6 +1072,9 @@ class Liquid(Target):
         else:
             NMol = list(set(NMols))[0]
 
+        if self.liquid_reweight:
+            self.store_snapshots(mvals, Points, mPoints, Results)
+
         if not self.adapt_errors:
             self.AllResults = defaultdict(lambda:defaultdict(list))
 
@@ -794,34 +1082,7 @@ class Liquid(Target):
         if len(Points) != len(self.Labels):
             logger.info("Data sets is not full, will not use for concatenation.")
             astrm += "_"*(Counter()+1)
-        self.AllResults[astrm]['Pts'].append(Points)
-        self.AllResults[astrm]['mPts'].append(Points)
-        self.AllResults[astrm]['E'].append(np.array(Energies))
-        self.AllResults[astrm]['V'].append(np.array(Vols))
-        self.AllResults[astrm]['R'].append(np.array(Rhos))
-        self.AllResults[astrm]['Dx'].append(np.array([d[:,0] for d in Dips]))
-        self.AllResults[astrm]['Dy'].append(np.array([d[:,1] for d in Dips]))
-        self.AllResults[astrm]['Dz'].append(np.array([d[:,2] for d in Dips]))
-        self.AllResults[astrm]['G'].append(np.array(Grads))
-        self.AllResults[astrm]['GDx'].append(np.array([gd[0] for gd in GDips]))
-        self.AllResults[astrm]['GDy'].append(np.array([gd[1] for gd in GDips]))
-        self.AllResults[astrm]['GDz'].append(np.array([gd[2] for gd in GDips]))
-        self.AllResults[astrm]['L'].append(len(Energies[0]))
-        self.AllResults[astrm]['Steps'].append(self.liquid_md_steps)
-
-        if len(mPoints) > 0:
-            mE_idx = 0
-            # QYD: here we use a dictionary to store the index in mE/mG, which is different with the index in Points
-            mE_idx_dict = dict()
-            all_mEs, all_mGs = [], []
-            for pt, mEs, mGs in zip(Points, mEnergies, mGrads):
-                if pt in mPoints:
-                    all_mEs.append(mEs)
-                    all_mGs.append(mGs)
-                    mE_idx_dict[pt] = mE_idx
-                    mE_idx += 1
-            self.AllResults[astrm]['mE'].append(np.array(all_mEs))
-            self.AllResults[astrm]['mG'].append(np.array(all_mGs))
+        self.store_results(astrm, Points, mPoints, Energies, Vols, Rhos, Dips, Grads, GDips, mEnergies, mGrads)
 
         # Number of data sets belonging to this value of the parameters.
         Nrpt = len(self.AllResults[astrm]['R'])
@@ -839,16 +1100,163 @@ class Liquid(Target):
             self.gas_md_steps *= 2
 
         # Concatenate along the data-set axis (more than 1 element  if we've returned to these parameters.)
-        E, V, R, Dx, Dy, Dz = \
-            (np.hstack(tuple(self.AllResults[astrm][i])) for i in \
-                 ['E', 'V', 'R', 'Dx', 'Dy', 'Dz'])
+        def join(key, axis=0):
+            return [np.concatenate([rpt[t] for rpt in self.AllResults[astrm][key]], axis=axis) for t in range(len(self.AllResults[astrm][key][0]))]
+        E, V, R, Dx, Dy, Dz = (join(i) for i in ['E', 'V', 'R', 'Dx', 'Dy', 'Dz'])
+        G, GDx, GDy, GDz = (join(i, axis=1) for i in ['G', 'GDx', 'GDy', 'GDz'])
+        # Number of snapshots at each phase point.
+        N_k = np.array([len(e) for e in E])
+
+        if len(mPoints) > 0:
+            mE = join('mE')
+            mG = join('mG', axis=1)
+            mN_k = np.array([len(e) for e in mE])
+        # Run MBAR using the total energies. Required for estimates that use the kinetic energy.
+        # Use the value of the energy for snapshot n from all simulations k at potential m
+        BN_k = np.array([N_k[Points.index(PT)] for PT in BPoints], dtype=int)
+        W1 = None
+        if len(BPoints) > 1:
+            logger.info("Running MBAR analysis on %i states...\n" % len(BPoints))
+            BE = np.concatenate([E[Points.index(PT)] for PT in BPoints])
+            BV = np.concatenate([V[Points.index(PT)] for PT in BPoints])
+            u_kn = np.zeros([len(BPoints), len(BE)])
+            for m, PT in enumerate(BPoints):
+                T = PT[0]
+                P = PT[1] / 1.01325 if PT[2] == 'bar' else PT[1]
+                beta = 1. / (kb * T)
+                # The correct Boltzmann factors include PV.
+                # Note that because the Boltzmann factors are computed from the conditions at simulation "m",
+                # the pV terms must be rescaled to the pressure at simulation "m".
+                u_kn[m] = (BE + P*BV*pvkj) * beta
+            key = ('liquid', tuple(BPoints))
+            f_k = mbar_free_energies(u_kn, BN_k, self.mbar_f_k.get(key), verbose=mbar_verbose)
+            self.mbar_f_k[key] = f_k
+            W1 = mbar_weights(u_kn, BN_k, u_kn, f_k)
+            logger.info("Done\n")
+
+        def fill_weights(weights, phase_points, mbar_points, counts):
+            """ Fill in the weight matrix with MBAR weights where MBAR was run,
+            and equal weights otherwise.  The snapshots of phase point k
+            are rows offsets[k]:offsets[k+1], where the offsets come from
+            the number of snapshots at each phase point (counts). """
+            offsets = np.concatenate(([0], np.cumsum(counts))).astype(int)
+            moffsets = np.concatenate(([0], np.cumsum([counts[phase_points.index(PT)] for PT in mbar_points]))).astype(int)
+            new_weights = np.zeros([offsets[-1],len(phase_points)])
+            for m, PT in enumerate(phase_points):
+                if PT in mbar_points:
+                    mm = mbar_points.index(PT)
+                    for kk, PT1 in enumerate(mbar_points):
+                        k = phase_points.index(PT1)
+                        logger.debug("Will fill W2[%i:%i,%i] with W1[%i:%i,%i]\n" % (offsets[k],offsets[k+1],m,moffsets[kk],moffsets[kk+1],mm))
+                        new_weights[offsets[k]:offsets[k+1],m] = weights[moffsets[kk]:moffsets[kk+1],mm]
+                else:
+                    logger.debug("Will fill W2[%i:%i,%i] with equal weights\n" % (offsets[m],offsets[m+1],m))
+                    new_weights[offsets[m]:offsets[m+1],m] = 1.0/counts[m]
+            return new_weights
 
-        G, GDx, GDy, GDz = \
-            (np.hstack((np.concatenate(tuple(self.AllResults[astrm][i]), axis=2))) for i in ['G', 'GDx', 'GDy', 'GDz'])
+        W2 = fill_weights(W1, Points, BPoints, N_k)
 
         if len(mPoints) > 0:
-            mE = np.hstack(tuple(self.AllResults[astrm]['mE']))
-            mG = np.hstack((np.concatenate(tuple(self.AllResults[astrm]['mG']), axis=2)))
+            # Run MBAR on the monomers.  This is barely necessary.
+            mW1 = None
+            if len(mBPoints) > 1:
+                mBN_k = np.array([mN_k[mPoints.index(PT)] for PT in mBPoints], dtype=int)
+                mBE = np.concatenate([mE[mPoints.index(PT)] for PT in mBPoints])
+                mu_kn = np.array([mBE * (1. / (kb * PT[0])) for PT in mBPoints])
+                if np.abs(np.std(mBE)) > 1e-6:
+                    key = ('gas', tuple(mBPoints))
+                    mf_k = mbar_free_energies(mu_kn, mBN_k, self.mbar_f_k.get(key))
+                    self.mbar_f_k[key] = mf_k
+                    mW1 = mbar_weights(mu_kn, mBN_k, mu_kn, mf_k)
+            mW2 = fill_weights(mW1, mPoints, mBPoints if mW1 is not None else [], mN_k)
+            mE = np.concatenate(mE)
+            mG = np.concatenate(mG, axis=1)
+        else:
+            mE, mG, mW2 = None, None, None
+
+        Data = OrderedDict([('E', np.concatenate(E)), ('V', np.concatenate(V)), ('R', np.concatenate(R)),
+                            ('Dx', np.concatenate(Dx)), ('Dy', np.concatenate(Dy)), ('Dz', np.concatenate(Dz)),
+                            ('G', np.concatenate(G, axis=1)), ('GDx', np.concatenate(GDx, axis=1)),
+                            ('GDy', np.concatenate(GDy, axis=1)), ('GDz', np.concatenate(GDz, axis=1)), ('mE', mE), ('mG', mG)])
+        Errs = OrderedDict([('rho', Rho_errs), ('hvap', Hvap_errs), ('alpha', Alpha_errs),
+                            ('kappa', Kappa_errs), ('cp', Cp_errs), ('eps0', Eps0_errs)])
+        property_results = self.calc_properties(mvals, AGrad, Points, mPoints, NMol, Data, W2, mW2, N_k, Errs, stResults)
+        self.adapt_md_steps(Points, mPoints, N_k, property_results)
+        return property_results
+
+    def adapt_md_steps(self, Points, mPoints, N_k, property_results):
+
+        """
+        Choose the number of production steps of the next liquid
+        simulation at each phase point (see liquid_error_target).
+
+        The standard error of an average is proportional to one over
+        the square root of the simulation length, with a prefactor set
+        by the statistical inefficiency of the time series.  The errors
+        of this set of simulations thus give the length that brings the
+        error of each fitted property to liquid_error_target times its
+        denominator, and the longest of these is used for the phase
+        point.  Easy phase points get shorter simulations and noisy
+        ones get longer simulations, within a factor of eight of
+        liquid_md_steps (or up to liquid_max_md_steps).  The gas phase
+        simulation is scaled by the same factor.
+
+        @param[in] Points Phase points of the simulations
+        @param[in] mPoints Phase points to calculate the enthalpy of vaporization at
+        @param[in] N_k Number of snapshots at each phase point
+        @param[in] property_results Calculated properties with their errors and derivatives
+
+        """
+        if self.liquid_error_target <= 0.0: return
+        # Number of time steps between snapshots.
+        nsave = max(1, int(1000 * self.liquid_interval / self.liquid_timestep))
+        gsave = max(1, int(1000 * self.gas_interval / self.gas_timestep))
+        min_steps = max(2*nsave, self.liquid_md_steps // 8)
+        max_steps = self.liquid_max_md_steps if self.liquid_max_md_steps > 0 else 8 * self.liquid_md_steps
+        PrintDict = OrderedDict()
+        for t, PT in enumerate(Points):
+            Ratios = OrderedDict()
+            for key in ['rho', 'hvap', 'alpha', 'kappa', 'cp', 'eps0']:
+                if getattr(self, 'w_'+key) == 0.0 or key not in self.RefData or PT not in self.RefData[key]: continue
+                if key == 'hvap' and PT not in mPoints: continue
+                err_target = self.liquid_error_target * getattr(self, key+'_denom', 1.0)
+                Ratios[key] = (property_results[key][1][PT] / err_target)**2
+            if len(Ratios) == 0 or not np.isfinite(max(Ratios.values())): continue
+            # The steps needed to reach the error target, from the steps that were used.
+            steps = N_k[t] * nsave * max(Ratios.values())
+            steps = int(np.ceil(min(max(steps, min_steps), max_steps) / nsave)) * nsave
+            gas_steps = int(np.ceil(self.gas_md_steps * float(steps) / self.liquid_md_steps / gsave)) * gsave
+            self.md_steps[PT] = (steps, gas_steps)
+            PrintDict["%.2fK-%.1f%s" % PT] = "%10i %10i %10i   %s" % (N_k[t] * nsave, steps, gas_steps, max(Ratios, key=Ratios.get))
+        if len(PrintDict) > 0:
+            printcool_dictionary(PrintDict, title="%s: production steps for the next simulations\n%-20s %10s %10s %10s   %s" %
+                                 (self.name, "Phase Point", "Last", "Liquid", "Gas", "Limiting"), keywidth=20)
+
+    def calc_properties(self, mvals, AGrad, Points, mPoints, NMol, Data, W2, mW2, N_k, Errs, stResults):
+
+        """
+        Calculate the liquid properties and their derivatives at each
+        phase point as weighted averages over the snapshots.
+
+        @param[in] mvals Mathematical parameter values
+        @param[in] AGrad Switch to turn on analytic gradient
+        @param[in] Points Phase points to calculate the properties at
+        @param[in] mPoints Phase points to calculate the enthalpy of vaporization at
+        @param[in] NMol Number of molecules in the liquid
+        @param[in] Data Snapshot energies (E), volumes (V), densities (R) and dipoles (Dx, Dy, Dz),
+        their parameter derivatives (G, GDx, GDy, GDz), and the gas phase energies and derivatives (mE, mG)
+        @param[in] W2 Weights of the snapshots at each phase point
+        @param[in] mW2 Weights of the gas phase snapshots at each phase point in mPoints
+        @param[in] N_k Number of snapshots from each simulation
+        @param[in] Errs Statistical errors of the properties from each simulation
+        @param[in] stResults Surface tension results from the NVT simulations
+        @return property_results
+
+        """
+        mbar_verbose = False
+        E, V, R, Dx, Dy, Dz, G, GDx, GDy, GDz, mE, mG = Data.values()
+        Rho_errs, Hvap_errs, Alpha_errs, Kappa_errs, Cp_errs, Eps0_errs = Errs.values()
+
         Rho_calc = OrderedDict([])
         Rho_grad = OrderedDict([])
         Rho_std  = OrderedDict([])
@@ -871,77 +1279,6 @@ class Liquid(Target):
         Surf_ten_grad = OrderedDict([])
         Surf_ten_std = OrderedDict([])
 
-        # The unit that converts atmospheres * nm**3 into kj/mol :)
-        pvkj=0.061019351687175
-
-        # Run MBAR using the total energies. Required for estimates that use the kinetic energy.
-        BSims = len(BPoints)
-        Shots = len(E[0])
-        N_k = np.ones(BSims, dtype=int)*Shots
-        # Use the value of the energy for snapshot t from simulation k at potential m
-        U_kln = np.zeros([BSims,BSims,Shots])
-        for m, PT in enumerate(BPoints):
-            T = PT[0]
-            P = PT[1] / 1.01325 if PT[2] == 'bar' else PT[1]
-            beta = 1. / (kb * T)
-            for k in range(BSims):
-                # The correct Boltzmann factors include PV.
-                # Note that because the Boltzmann factors are computed from the conditions at simulation "m",
-                # the pV terms must be rescaled to the pressure at simulation "m".
-                kk = Points.index(BPoints[k])
-                U_kln[k, m, :]   = E[kk] + P*V[kk]*pvkj
-                U_kln[k, m, :]  *= beta
-        W1 = None
-        if len(BPoints) > 1:
-            logger.info("Running MBAR analysis on %i states...\n" % len(BPoints))
-            mbar = pymbar.MBAR(U_kln, N_k, verbose=mbar_verbose, relative_tolerance=5.0e-8)
-            W1 = mbar.getWeights()
-            logger.info("Done\n")
-        elif len(BPoints) == 1:
-            W1 = np.ones((Shots,1))
-            W1 /= Shots
-
-        def fill_weights(weights, phase_points, mbar_points, snapshots):
-            """ Fill in the weight matrix with MBAR weights where MBAR was run,
-            and equal weights otherwise. """
-            new_weights = np.zeros([len(phase_points)*snapshots,len(phase_points)])
-            for m, PT in enumerate(phase_points):
-                if PT in mbar_points:
-                    mm = mbar_points.index(PT)
-                    for kk, PT1 in enumerate(mbar_points):
-                        k = phase_points.index(PT1)
-                        logger.debug("Will fill W2[%i:%i,%i] with W1[%i:%i,%i]\n" % (k*snapshots,k*snapshots+snapshots,m,kk*snapshots,kk*snapshots+snapshots,mm))
-                        new_weights[k*snapshots:(k+1)*snapshots,m] = weights[kk*snapshots:(kk+1)*snapshots,mm]
-                else:
-                    logger.debug("Will fill W2[%i:%i,%i] with equal weights\n" % (m*snapshots,(m+1)*snapshots,m))
-                    new_weights[m*snapshots:(m+1)*snapshots,m] = 1.0/snapshots
-            return new_weights
-
-        W2 = fill_weights(W1, Points, BPoints, Shots)
-
-        if len(mPoints) > 0:
-            # Run MBAR on the monomers.  This is barely necessary.
-            mW1 = None
-            mShots = len(mE[0])
-            if len(mBPoints) > 1:
-                mBSims = len(mBPoints)
-                mN_k = np.ones(mBSims, dtype=int)*mShots
-                mU_kln = np.zeros([mBSims,mBSims,mShots])
-                for m, PT in enumerate(mBPoints):
-                    T = PT[0]
-                    beta = 1. / (kb * T)
-                    for k in range(mBSims):
-                        mE_idx = mE_idx_dict[mBPoints[k]]
-                        mU_kln[k, m, :]  = mE[mE_idx]
-                        mU_kln[k, m, :] *= beta
-                if np.abs(np.std(mE)) > 1e-6 and mBSims > 1:
-                    mmbar = pymbar.MBAR(mU_kln, mN_k, verbose=False, relative_tolerance=5.0e-8, method='self-consistent-iteration')
-                    mW1 = mmbar.getWeights()
-            elif len(mBPoints) == 1:
-                mW1 = np.ones((mShots,1))
-                mW1 /= mShots
-            mW2 = fill_weights(mW1, mPoints, mBPoints, mShots)
-
         if self.do_self_pol:
             EPol = self.polarization_correction(mvals)
             GEPol = np.array([(f12d3p(fdwrap(self.polarization_correction, mvals, p), h = self.h, f0 = EPol)[0] if p in self.pgrad else 0.0) for p in range(self.FF.np)])
@@ -966,7 +1303,7 @@ class Liquid(Target):
             H = E + PV
             # The weights that we want are the last ones.
             W = flat(W2[:,i])
-            C = weight_info(W, PT, np.ones(len(Points), dtype=int)*Shots, verbose=mbar_verbose)
+            C = weight_info(W, PT, N_k, verbose=mbar_verbose)
             Gbar = flat(np.dot(G, col(W)))
             mBeta = -1/kb/T
             Beta  = 1/kb/T
@@ -3,12 +3,15 @@ from __future__ import division
 from __future__ import print_function
 
 import copy
+import hashlib
 import itertools
 import os
 import re
+import shutil
 import sys
 import sysconfig
 import json
+import tempfile
 from collections import OrderedDict, namedtuple, Counter
 from ctypes import *
 from datetime import date
@@ -1119,6 +1122,113 @@ def axis_angle(axis, angle):
     R = form_rot(q)
     return R
 
+## Keywords at the start of the lines in a qdata.txt file, mapped to
+## the keys of the dictionary returned by load_qdata.
+## 'FORCES' is from an earlier version and a misnomer.
+QDATA_FIELDS = OrderedDict([('COORDS', 'xyzs'), ('ENERGY', 'qm_energies'), ('INTERACTION', 'qm_interaction'),
+                            ('GRADIENT', 'qm_grads'), ('FORCES', 'qm_grads'),
+                            ('ESPXYZ', 'qm_espxyzs'), ('ESPVAL', 'qm_espvals')])
+## Fields that contain one number per line.
+QDATA_SCALARS = ['qm_energies', 'qm_interaction']
+
+def qdata_arrays(flat):
+    """
+    Turn the flattened contents of a qdata.txt file into arrays.
+
+    Parameters
+    ----------
+    flat : dict
+        Maps each key to a tuple (data, lengths) where data is a 1D array
+        of all the numbers in the field and lengths is the number of
+        values on each line
+
+    Returns
+    -------
+    OrderedDict
+        The one-number fields are 1D arrays; the other fields are 2D arrays
+        with one row per line, or lists of 1D arrays if the lines have
+        different lengths.  These are views into the data arrays.
+    """
+    Answer = OrderedDict()
+    for key, (data, lengths) in flat.items():
+        if key in QDATA_SCALARS:
+            Answer[key] = data
+        elif len(lengths) > 0 and np.all(lengths == lengths[0]):
+            Answer[key] = data.reshape(len(lengths), lengths[0])
+        else:
+            Answer[key] = np.split(data, np.cumsum(lengths)[:-1])
+    return Answer
+
+def load_qdata(fnm, cache=False):
+    """
+    Read the coordinates, energies, gradients and ESP data in a qdata.txt file.
+
+    If cache is True, the numbers are also saved in binary form to a
+    directory next to the file (e.g. qdata.txt.cache) containing a .npy
+    file of the flattened numbers in each field, another with the number
+    of values on each line, and the SHA-1 hash of the text file.  The next
+    call with the same file contents memory-maps these arrays
+    (copy-on-write) instead of parsing the text again; a stale cache is
+    replaced, and one that cannot be written is skipped.
+
+    Parameters
+    ----------
+    fnm : str
+        Name of the qdata.txt file
+    cache : bool
+        Read and write the binary cache
+
+    Returns
+    -------
+    OrderedDict
+        Keys are 'xyzs', 'qm_energies', 'qm_interaction', 'qm_grads',
+        'qm_espxyzs' and 'qm_espvals', where present in the file;
+        the arrays are laid out as described in qdata_arrays.
+    """
+    cdir = fnm + '.cache'
+    if cache:
+        sha = hashlib.sha1()
+        with open(fnm, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+        digest = sha.hexdigest()
+        try:
+            with open(os.path.join(cdir, 'index.txt')) as f:
+                index = f.read().split()
+            if len(index) > 0 and index[0] == digest:
+                return qdata_arrays(OrderedDict([(key, (np.load(os.path.join(cdir, key+'.npy'), mmap_mode='c'),
+                                                        np.load(os.path.join(cdir, key+'.len.npy'))))
+                                                 for key in index[1:]]))
+        except (IOError, OSError, ValueError):
+            pass
+    rows = OrderedDict()
+    with open(fnm) as f:
+        for line in f:
+            sline = line.split()
+            if len(sline) > 0 and sline[0] in QDATA_FIELDS:
+                key = QDATA_FIELDS[sline[0]]
+                rows.setdefault(key, []).append(sline[1:2] if key in QDATA_SCALARS else sline[1:])
+    flat = OrderedDict()
+    for key, lines in rows.items():
+        flat[key] = (np.array(list(itertools.chain(*lines)), dtype=float), np.array([len(l) for l in lines], dtype=int))
+    if cache:
+        tmp = None
+        try:
+            # Write to a temporary directory first, so other processes never see a partial cache.
+            tmp = tempfile.mkdtemp(prefix=os.path.basename(cdir)+'.', dir=os.path.dirname(os.path.abspath(fnm)))
+            for key, (data, lengths) in flat.items():
+                np.save(os.path.join(tmp, key+'.npy'), data)
+                np.save(os.path.join(tmp, key+'.len.npy'), lengths)
+            with open(os.path.join(tmp, 'index.txt'), 'w') as f:
+                print(' '.join([digest] + list(flat.keys())), file=f)
+            if os.path.isdir(cdir):
+                shutil.rmtree(cdir)
+            os.rename(tmp, cdir)
+        except (IOError, OSError):
+            if tmp is not None:
+                shutil.rmtree(tmp, ignore_errors=True)
+    return qdata_arrays(flat)
+
 class Molecule(object):
     """ Lee-Ping's general file format conversion class.
 
@@ -3061,39 +3171,15 @@ class Molecule(object):
         return Answer
 
     def read_qdata(self, fnm, **kwargs):
-        xyzs     = []
-        energies = []
-        grads   = []
-        espxyzs  = []
-        espvals  = []
-        interaction = []
-        for line in open(fnm):
-            line = line.strip().expandtabs()
-            if 'COORDS' in line:
-                xyzs.append(np.array([float(i) for i in line.split()[1:]]).reshape(-1,3))
-            elif 'FORCES' in line or 'GRADIENT' in line: # 'FORCES' is from an earlier version and a misnomer
-                grads.append(np.array([float(i) for i in line.split()[1:]]).reshape(-1,3))
-            elif 'ESPXYZ' in line:
-                espxyzs.append(np.array([float(i) for i in line.split()[1:]]).reshape(-1,3))
-            elif 'ESPVAL' in line:
-                espvals.append(np.array([float(i) for i in line.split()[1:]]))
-            elif 'ENERGY' in line:
-                energies.append(float(line.split()[1]))
-            elif 'INTERACTION' in line:
-                interaction.append(float(line.split()[1]))
-        Answer = {}
-        if len(xyzs) > 0:
-            Answer['xyzs'] = xyzs
-        if len(energies) > 0:
-            Answer['qm_energies'] = energies
-        if len(interaction) > 0:
-            Answer['qm_interaction'] = interaction
-        if len(grads) > 0:
-            Answer['qm_grads'] = grads
-        if len(espxyzs) > 0:
-            Answer['qm_espxyzs'] = espxyzs
-        if len(espvals) > 0:
-            Answer['qm_espvals'] = espvals
+        Answer = load_qdata(fnm, cache=kwargs.get('qdata_cache', False))
+        for key in ['xyzs', 'qm_grads', 'qm_espxyzs']:
+            if key in Answer:
+                Answer[key] = [x.reshape(-1,3) for x in Answer[key]]
+        if 'qm_espvals' in Answer:
+            Answer['qm_espvals'] = list(Answer['qm_espvals'])
+        for key in QDATA_SCALARS:
+            if key in Answer:
+                Answer[key] = Answer[key].tolist()
         return Answer
 
     def read_mol2(self, fnm, **kwargs):
@@ -169,9 +169,8 @@ class Moments(Target):
 
     def get(self, mvals, AGrad=False, AHess=False):
         """ Evaluate objective function. """
-        Answer = {'X':0.0, 'G':np.zeros(self.FF.np), 'H':np.zeros((self.FF.np, self.FF.np))}
         def get_momvals(mvals_):
-            self.FF.make(mvals_)
+            self.FF.make(mvals_, write=not self.engine.ff_in_memory)
             moments = self.engine.multipole_moments(polarizability='polarizability' in self.ref_moments, optimize=self.optimize_geometry)
             # Unpack from dictionary.
             return self.unpack_moments(moments)
@@ -185,14 +184,9 @@ class Moments(Target):
         dV = np.zeros((self.FF.np,len(calc_momvals)))
 
         if AGrad or AHess:
-            for p in self.pgrad:
-                dV[p,:], _ = f12d3p(fdwrap(get_momvals, mvals, p), h = self.h, f0 = calc_momvals)
+            dV = self.fd_derivatives(get_momvals, mvals, calc_momvals)
                 
-        Answer['X'] = np.dot(D,D)
-        for p in self.pgrad:
-            Answer['G'][p] = 2*np.dot(D, dV[p,:])
-            for q in self.pgrad:
-                Answer['H'][p,q] = 2*np.dot(dV[p,:], dV[q,:])
+        Answer = self.gauss_newton(D, dV)
 
         if not in_fd():
             self.calc_moments = calc_moments
@@ -17,12 +17,14 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import codecs
 import filecmp
 import itertools
 import distutils.dir_util
 import os
 import re
 import shutil
+import struct
 import sys
 from select import select
 
@@ -35,9 +37,15 @@ try:
 except ImportError:
     from itertools import izip_longest as zip_longest
 import threading
+import queue
+import socket
+import tempfile
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 from pickle import Pickler, Unpickler
 import tarfile
 import time
+import zipfile
 import subprocess
 import math
 import six # For six.string_types
@@ -715,55 +723,110 @@ def statisticalInefficiency(A_n, B_n=None, fast=False, mintime=3, warn=True):
     tau, where tau is the correlation time).  We enforce g >= 1.0.
 
     """
-    # Create numpy copies of input arguments.
+    # The correlation function of every column is computed at once with FFTs.
     A_n = np.array(A_n)
     if B_n is not None:
         B_n = np.array(B_n)
-    else:
-        B_n = np.array(A_n)
-    # Get the length of the timeseries.
-    N = A_n.shape[0]
-    # Be sure A_n and B_n have the same dimensions.
-    if A_n.shape != B_n.shape:
-        logger.error('A_n and B_n must have same dimensions.\n')
+    if A_n.size != A_n.shape[0]:
+        logger.error('A_n must be a single timeseries; use statisticalInefficiencies for many.\n')
         raise ParameterError
-    # Initialize statistical inefficiency estimate with uncorrelated value.
-    g = 1.0
-    # Compute mean of each timeseries.
-    mu_A = A_n.mean()
-    mu_B = B_n.mean()
+    return statisticalInefficiencies(A_n, B_n, fast, mintime, warn)[0]
+
+def statisticalInefficiencies(A_n, B_n=None, fast=False, mintime=3, warn=True):
+
+    """
+    Compute the (cross) statistical inefficiencies of many timeseries at once.
+
+    This gives the same results as calling statisticalInefficiency on
+    each column, but the correlation functions are computed using FFTs.
+    Correlation function values close to zero, where rounding errors
+    could change the point where the sum is terminated, are recomputed
+    directly.
+
+    @param[in] A_n (required, numpy array) - A_n[n, k] is nth value of
+    timeseries k.  A one-dimensional array is a single timeseries.
+
+    @param[in] B_n (optional, numpy array) - B_n[n, k] is nth value of
+    timeseries k to be cross-correlated with A_n[:, k].
+
+    @param[in] fast, mintime, warn - As in statisticalInefficiency.
+
+    @return g Array of the estimated statistical inefficiencies of the timeseries (each >= 1.0).
+
+    """
     # Make temporary copies of fluctuation from mean.
-    dA_n = A_n.astype(np.float64) - mu_A
-    dB_n = B_n.astype(np.float64) - mu_B
+    A_n = np.array(A_n, dtype=np.float64)
+    A_n = A_n.reshape(A_n.shape[0], -1)
+    dA_n = A_n - A_n.mean(axis=0)
+    if B_n is not None:
+        B_n = np.array(B_n, dtype=np.float64)
+        B_n = B_n.reshape(B_n.shape[0], -1)
+        # Be sure A_n and B_n have the same dimensions.
+        if A_n.shape != B_n.shape:
+            logger.error('A_n and B_n must have same dimensions.\n')
+            raise ParameterError
+        dB_n = B_n - B_n.mean(axis=0)
+    else:
+        dB_n = dA_n
+    # Get the length of the timeseries.
+    N, K = dA_n.shape
     # Compute estimator of covariance of (A,B) using estimator that will ensure C(0) = 1.
-    sigma2_AB = (dA_n * dB_n).mean() # standard estimator to ensure C(0) = 1
-    # Trap the case where this covariance is zero, and we cannot proceed.
-    if sigma2_AB == 0:
-        if warn:
-            logger.warning('Sample covariance sigma_AB^2 = 0 -- cannot compute statistical inefficiency\n')
-        return 1.0
-    # Accumulate the integrated correlation time by computing the normalized correlation time at
-    # increasing values of t.  Stop accumulating if the correlation function goes negative, since
-    # this is unlikely to occur unless the correlation function has decayed to the point where it
-    # is dominated by noise and indistinguishable from zero.
-    t = 1
-    increment = 1
-    while t < N-1:
-        # compute normalized fluctuation correlation function at time t
-        C = sum( dA_n[0:(N-t)]*dB_n[t:N] + dB_n[0:(N-t)]*dA_n[t:N] ) / (2.0 * float(N-t) * sigma2_AB)
-        # Terminate if the correlation function has crossed zero and we've computed the correlation
-        # function at least out to 'mintime'.
-        if (C <= 0.0) and (t > mintime):
-            break
-        # Accumulate contribution to the statistical inefficiency.
-        g += 2.0 * C * (1.0 - float(t)/float(N)) * float(increment)
-        # Increment t and the amount by which we increment t.
-        t += increment
-        # Increase the interval if "fast mode" is on.
-        if fast: increment += 1
-    # g must be at least unity
-    if g < 1.0: g = 1.0
-    # Return the computed statistical inefficiency.
+    sigma2_AB = (dA_n * dB_n).mean(axis=0)
+    # Sums over n of dA_n[n]*dB_n[n+t] + dB_n[n]*dA_n[n+t] for all t, from FFTs padded
+    # to at least twice the length so that the correlations do not wrap around.
+    nfft = 2**int(np.ceil(np.log2(max(2*N, 2))))
+    fA = np.fft.rfft(dA_n, n=nfft, axis=0)
+    if B_n is not None:
+        fB = np.fft.rfft(dB_n, n=nfft, axis=0)
+        S = np.fft.irfft(np.conj(fA)*fB + np.conj(fB)*fA, n=nfft, axis=0)[:N]
+    else:
+        S = 2*np.fft.irfft(np.conj(fA)*fA, n=nfft, axis=0)[:N]
+    g = np.ones(K)
+    t_all = np.arange(N)
+    for k in range(K):
+        # Trap the case where this covariance is zero, and we cannot proceed.
+        if sigma2_AB[k] == 0:
+            if warn:
+                logger.warning('Sample covariance sigma_AB^2 = 0 -- cannot compute statistical inefficiency\n')
+            continue
+        # Normalized fluctuation correlation function at times t = 1 .. N-2.
+        C = S[1:N-1, k] / (2.0 * (N-t_all[1:N-1]) * sigma2_AB[k])
+        def exact(t):
+            return (np.dot(dA_n[0:(N-t), k], dB_n[t:N, k]) + np.dot(dB_n[0:(N-t), k], dA_n[t:N, k])) / (2.0 * float(N-t) * sigma2_AB[k])
+        # Accumulate the integrated correlation time by computing the normalized correlation time at
+        # increasing values of t.  Stop accumulating if the correlation function goes negative, since
+        # this is unlikely to occur unless the correlation function has decayed to the point where it
+        # is dominated by noise and indistinguishable from zero.
+        if fast:
+            t = 1
+            increment = 1
+            gk = 1.0
+            while t < N-1:
+                Ct = C[t-1]
+                if abs(Ct) < 1e-8: Ct = exact(t)
+                # Terminate if the correlation function has crossed zero and we've computed the correlation
+                # function at least out to 'mintime'.
+                if (Ct <= 0.0) and (t > mintime):
+                    break
+                gk += 2.0 * Ct * (1.0 - float(t)/float(N)) * float(increment)
+                t += increment
+                increment += 1
+        else:
+            # Find the first time after mintime where the correlation function crosses zero,
+            # checking the values that are too close to zero to trust the FFTs.
+            tstop = N-1
+            for t in (np.nonzero((C <= 1e-8) & (t_all[1:N-1] > mintime))[0] + 1):
+                if C[t-1] > -1e-8:
+                    C[t-1] = exact(t)
+                if C[t-1] <= 0.0:
+                    tstop = t
+                    break
+            for t in np.nonzero(np.abs(C[:tstop-1]) < 1e-8)[0] + 1:
+                C[t-1] = exact(t)
+            gk = 1.0 + np.sum(2.0 * C[:tstop-1] * (1.0 - t_all[1:tstop]/float(N)))
+        # g must be at least unity
+        g[k] = max(gk, 1.0)
+    # Return the computed statistical inefficiencies.
     return g
 
 def mean_stderr(ts):
@@ -771,18 +834,71 @@ def mean_stderr(ts):
     return np.mean(ts), \
       np.std(ts)*np.sqrt(statisticalInefficiency(ts, warn=False)/len(ts))
 
-# Slices a 2D array of data by column.  The new array is fed into the statisticalInefficiency function.
+# Computes the statistical inefficiency of each column of a 2D array of data (see statisticalInefficiencies),
+# and returns it in every row of the corresponding column.
 def multiD_statisticalInefficiency(A_n, B_n=None, fast=False, mintime=3, warn=True):
     n_row = A_n.shape[0]
     n_col = A_n.shape[-1]
     multiD_sI = np.zeros((n_row, n_col))
-    for col in range(n_col):
-        if B_n is None:
-            multiD_sI[:,col] = statisticalInefficiency(A_n[:,col], B_n, fast, mintime, warn)
-        else:
-            multiD_sI[:,col] = statisticalInefficiency(A_n[:,col], B_n[:,col], fast, mintime, warn)
+    multiD_sI[:,:] = statisticalInefficiencies(A_n, B_n, fast, mintime, warn)
     return multiD_sI
 
+def bootstrap_weights(L, numboots=1000, block=1, maxsize=2**22):
+    """
+    Draw bootstrap resamples of the frames of a timeseries, expressed as
+    the number of times that each frame is drawn.  Averaging over a
+    resample is the same as a weighted average over the original frames.
+
+    @param[in] L Number of frames in the timeseries
+    @param[in] numboots Number of resamples
+    @param[in] block Resample blocks of this many consecutive frames (moving block bootstrap)
+    @param[in] maxsize Maximum number of elements in each array of weights
+    @return Generator of weight arrays with shape (number of resamples, L)
+    """
+    block = max(1, min(int(block), L))
+    nblocks = -(-L // block)
+    chunk = max(1, maxsize // L)
+    for start in range(0, numboots, chunk):
+        n = min(chunk, numboots - start)
+        if block == 1:
+            idx = np.random.randint(L, size=(n, L))
+        else:
+            # Join blocks that start at random frames, and cut the result to the original length.
+            starts = np.random.randint(L-block+1, size=(n, nblocks))
+            idx = (starts[:, :, np.newaxis] + np.arange(block)).reshape(n, -1)[:, :L]
+        idx += L*np.arange(n)[:, np.newaxis]
+        yield np.bincount(idx.ravel(), minlength=n*L).reshape(n, L).astype(float)
+
+def bootstrap(func, L, numboots=1000, block=1):
+    """
+    Bootstrap samples of a quantity computed from a timeseries.
+
+    @param[in] func Function that takes frame weights with shape (n, L) and returns the n
+    values of the quantity, such as the calc_ functions of the condensed phase scripts
+    (which take them as the Boltzmann weights)
+    @param[in] L, numboots, block As in bootstrap_weights
+    @return Array of numboots values of the quantity
+    """
+    return np.concatenate([np.atleast_1d(func(b)) for b in bootstrap_weights(L, numboots, block)])
+
+def bootstrap_stderr(func, L, g, numboots=1000, block=False):
+    """
+    Bootstrap estimate of the standard error of a quantity computed from
+    a correlated timeseries with statistical inefficiency g.
+
+    By default the frames are resampled individually and the spread is
+    scaled by sqrt(g); with block=True, blocks of ceil(g) consecutive
+    frames are resampled instead so the resamples keep the correlation.
+
+    @param[in] func, L, numboots As in bootstrap
+    @param[in] g Statistical inefficiency of the timeseries
+    @param[in] block Use the block bootstrap
+    @return Standard error of the quantity
+    """
+    if block:
+        return np.std(bootstrap(func, L, numboots, int(np.ceil(g))))
+    return np.std(bootstrap(func, L, numboots)) * np.sqrt(g)
+
 #========================================#
 #|      Loading compressed pickles      |#
 #========================================#
@@ -859,6 +975,168 @@ def lp_load(fnm):
         answer = load_uncompress()
     return answer
 
+#=================================================#
+#|  Result files of the condensed phase scripts  |#
+#=================================================#
+
+## Version of the format of the result files, which is stored in each file.
+RESULT_VERSION = 1
+
+## Fields of the result files written by each of the condensed phase
+## scripts, with the axis of each field that runs over the snapshots
+## (None if it does not).  The older pickle result files contain a tuple
+## (or dictionary) with the fields in this order.
+RESULT_SCHEMAS = {
+    'npt' : OrderedDict([('Rhos', 0), ('Volumes', 0), ('Potentials', 0), ('Energies', 0), ('Dips', 0), ('G', 1), ('GDips', 2),
+                         ('mPotentials', 0), ('mEnergies', 0), ('mG', 1), ('Rho_err', None), ('Hvap_err', None),
+                         ('Alpha_err', None), ('Kappa_err', None), ('Cp_err', None), ('Eps0_err', None), ('NMol', None)]),
+    'npt_lipid' : OrderedDict([('Rhos', 0), ('Volumes', 0), ('Potentials', 0), ('Energies', 0), ('Dips', 0), ('G', 1), ('GDips', 2),
+                               ('Rho_err', None), ('Alpha_err', None), ('Kappa_err', None), ('Cp_err', None), ('Eps0_err', None),
+                               ('NMol', None), ('Als', 0), ('Al_err', None), ('Scds', 0), ('Scd_err', None), ('LKappa_err', None)]),
+    'nvt' : OrderedDict([('surf_ten', None), ('surf_ten_err', None), ('G_surf_ten', None)])
+    }
+
+def result_path(fnm):
+    """
+    Return the path of a result file of a condensed phase script,
+    given its name without the extension (e.g. "npt_result"); the
+    .npz file is preferred over an older .p file.  Return None if
+    neither of them exists.
+    """
+    for ext in ['.npz', '.p']:
+        if os.path.exists(fnm + ext):
+            return fnm + ext
+    return None
+
+def save_result(fnm, schema, **fields):
+    """
+    Write the results of a condensed phase script to an uncompressed
+    .npz file, with one array for each field of the schema (see
+    RESULT_SCHEMAS) and the schema name and format version.  Reading
+    such a file with load_result only loads the fields that are used,
+    and the arrays may be memory-mapped.
+
+    @param[in] fnm Name of the file without the extension
+    @param[in] schema Name of the schema in RESULT_SCHEMAS
+    @param[in] fields Values of all of the fields in the schema
+    """
+    names = list(RESULT_SCHEMAS[schema].keys())
+    if set(fields.keys()) != set(names):
+        logger.error("The fields of a %s result must be %s\n" % (schema, ', '.join(names)))
+        raise RuntimeError
+    if os.path.islink(fnm + '.npz'):
+        logger.warning("Trying to write to a symbolic link %s, removing it first\n" % (fnm + '.npz'))
+        os.unlink(fnm + '.npz')
+    np.savez(fnm + '.npz', _schema=np.array(schema), _version=np.array(RESULT_VERSION),
+             **OrderedDict([(k, np.asarray(fields[k])) for k in names]))
+
+class ResultFile(object):
+    """
+    Fields of a result file of a condensed phase script, which are read
+    by name when they are first used.  Older pickle files (.p) are read
+    in full and their fields are named by the schema.
+
+    @param[in] fnm Path of the .npz or .p file
+    @param[in] schema Name of the schema in RESULT_SCHEMAS
+    @param[in] mmap Memory-map the arrays of a .npz file instead of reading them
+    """
+    def __init__(self, fnm, schema, mmap=False):
+        # The arrays are memory-mapped when first used, possibly from another directory.
+        self.fnm = os.path.abspath(fnm)
+        self.schema = schema
+        self.mmap = mmap
+        self.data = OrderedDict()
+        names = list(RESULT_SCHEMAS[schema].keys())
+        if fnm.endswith('.npz'):
+            self.npz = np.load(fnm, allow_pickle=False)
+            stored = (str(self.npz['_schema']), int(self.npz['_version']))
+            if stored[0] != schema or stored[1] > RESULT_VERSION:
+                logger.error("%s contains a %s result of version %i, expected a %s result of version <= %i\n" % (fnm, stored[0], stored[1], schema, RESULT_VERSION))
+                raise RuntimeError
+            missing = [k for k in names if k not in self.npz.files]
+            if len(missing) > 0:
+                logger.error("%s is missing the fields %s\n" % (fnm, ', '.join(missing)))
+                raise RuntimeError
+        else:
+            self.npz = None
+            values = lp_load(fnm)
+            if isinstance(values, dict):
+                values = [values[k] for k in names]
+            if len(values) != len(names):
+                logger.error("%s contains %i fields, expected %i for a %s result\n" % (fnm, len(values), len(names), schema))
+                raise RuntimeError
+            for k, v in zip(names, values):
+                self.data[k] = self.scalar(np.asarray(v))
+
+    def keys(self):
+        return list(RESULT_SCHEMAS[self.schema].keys())
+
+    def __contains__(self, key):
+        return key in RESULT_SCHEMAS[self.schema]
+
+    def __getitem__(self, key):
+        if key not in self.data:
+            if key not in self:
+                raise KeyError(key)
+            self.data[key] = self.scalar(self.npz_memmap(key) if self.mmap else self.npz[key])
+        return self.data[key]
+
+    @staticmethod
+    def scalar(value):
+        """ Return the fields that are single numbers as Python scalars. """
+        return value.item() if value.ndim == 0 else value
+
+    def npz_memmap(self, key):
+        """ Memory-map one array of the .npz file, if it is stored without compression. """
+        info = self.npz.zip.getinfo(key + '.npy')
+        if info.compress_type != zipfile.ZIP_STORED:
+            return self.npz[key]
+        with open(self.fnm, 'rb') as f:
+            # The array follows the local file header of the zip entry.
+            f.seek(info.header_offset)
+            header = f.read(30)
+            f.seek(info.header_offset + 30 + sum(struct.unpack('<HH', header[26:30])))
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+            offset = f.tell()
+        if len(shape) == 0 or np.prod(shape) == 0 or dtype.hasobject:
+            return self.npz[key]
+        return np.memmap(self.fnm, dtype=dtype, mode='r', offset=offset, shape=shape, order='F' if fortran else 'C')
+
+    def concatenate(self, others):
+        """
+        Join the snapshots of this result with those of other results of
+        the same kind, such as several simulations at the same phase
+        point; the fields that do not run over the snapshots are taken
+        from this one.
+
+        @param[in] others List of ResultFile objects
+        @return Dictionary of the joined fields
+        """
+        answer = OrderedDict()
+        for key, axis in RESULT_SCHEMAS[self.schema].items():
+            if axis is None:
+                answer[key] = self[key]
+            else:
+                answer[key] = np.concatenate([self[key]] + [o[key] for o in others], axis=axis)
+        return answer
+
+def load_result(fnm, schema, mmap=False):
+    """
+    Read the result file of a condensed phase script (see save_result).
+
+    @param[in] fnm Name of the file without the extension
+    @param[in] schema Name of the schema in RESULT_SCHEMAS
+    @param[in] mmap Memory-map the arrays instead of reading them
+    @return ResultFile with the fields of the result, or None if there is no file
+    """
+    path = result_path(fnm)
+    if path is None: return None
+    return ResultFile(path, schema, mmap)
+
 #==============================#
 #|      Work Queue stuff      |#
 #==============================#
@@ -896,12 +1174,189 @@ def createWorkQueue(wq_port, debug=True, name=package):
     #WORK_QUEUE.specify_keepalive_timeout(8640000)
     #WORK_QUEUE.specify_keepalive_interval(8640000)
 
+def createLocalWorkQueue(processes, scratch=None):
+    """ Create a LocalWorkQueue that runs the Work Queue tasks on this machine. """
+    global WORK_QUEUE
+    WORK_QUEUE = LocalWorkQueue(processes, scratch=scratch)
+
 def destroyWorkQueue():
     # Convenience function to destroy the Work Queue objects.
     global WORK_QUEUE, WQIDS
+    if isinstance(WORK_QUEUE, LocalWorkQueue):
+        WORK_QUEUE.shutdown()
     WORK_QUEUE = None
     WQIDS = defaultdict(list)
 
+class LocalTask(object):
+    """
+    A task for the LocalWorkQueue, with the parts of the work_queue.Task
+    interface that ForceBalance uses.
+    """
+    def __init__(self, command):
+        self.command = command
+        self.tag = command
+        self.id = None
+        self.input_files = []
+        self.output_files = []
+        ## Number of times the task has been submitted.
+        self.attempts = 0
+        ## 0 if the task ran and its output files were retrieved, like work_queue.WORK_QUEUE_RESULT_SUCCESS.
+        self.result = None
+        ## Exit code of the command.
+        self.return_status = None
+        self.hostname = socket.gethostname()
+        ## Run time of the command in microseconds.
+        self.cmd_execution_time = 0
+        self.total_bytes_transferred = 0
+
+    def specify_input_file(self, local_name, remote_name=None, cache=False):
+        self.input_files.append((local_name, remote_name if remote_name is not None else os.path.basename(local_name)))
+
+    def specify_output_file(self, local_name, remote_name=None, cache=False):
+        self.output_files.append((local_name, remote_name if remote_name is not None else os.path.basename(local_name)))
+
+    def specify_tag(self, tag):
+        self.tag = tag
+
+class LocalWorkQueue(object):
+    """
+    Stand-in for a Work Queue master and its workers that runs the tasks
+    on this machine, at most a given number at a time.
+
+    Each task runs in its own scratch directory, like on a Work Queue
+    worker: the input files are copied in, the command is run there and
+    the output files are moved back to where they were requested.  Tasks
+    whose output files are missing are reported as failed (and wq_wait1
+    submits them again); to keep a broken calculation from running
+    forever, a task fails for good after max_attempts tries, and its
+    scratch directory is kept for inspection.
+    """
+    def __init__(self, processes, scratch=None, max_attempts=3):
+        self.processes = processes
+        self.scratch = scratch
+        self.max_attempts = max_attempts
+        # The tasks are external commands, so threads are enough to run them concurrently.
+        self.executor = ThreadPoolExecutor(max_workers=processes)
+        self.finished = queue.Queue()
+        self.lock = threading.Lock()
+        self.taskid = 0
+        self.counts = {'submitted' : 0, 'running' : 0, 'done' : 0, 'retrieved' : 0, 'bytes_sent' : 0, 'bytes_received' : 0}
+
+    def specify_name(self, name):
+        return
+
+    def specify_algorithm(self, algorithm):
+        return
+
+    def submit(self, task):
+        task.attempts += 1
+        if task.attempts > self.max_attempts:
+            logger.error("Task '%s' failed %i times, giving up\n" % (task.tag, self.max_attempts))
+            raise RuntimeError
+        with self.lock:
+            self.taskid += 1
+            task.id = self.taskid
+            self.counts['submitted'] += 1
+        self.executor.submit(self.run, task)
+        return task.id
+
+    def run(self, task):
+        with self.lock:
+            self.counts['running'] += 1
+        try:
+            task.result = 1
+            sandbox = tempfile.mkdtemp(prefix='wq_task.', dir=self.scratch)
+            nbytes = 0
+            for local_name, remote_name in task.input_files:
+                dest = os.path.join(sandbox, remote_name)
+                if not os.path.exists(os.path.dirname(dest)):
+                    os.makedirs(os.path.dirname(dest))
+                if os.path.isdir(local_name):
+                    shutil.copytree(local_name, dest)
+                else:
+                    shutil.copy2(local_name, dest)
+                    nbytes += os.path.getsize(dest)
+            with self.lock:
+                self.counts['bytes_sent'] += nbytes
+            sent = nbytes
+            t0 = time.time()
+            with open(os.devnull, 'w') as devnull:
+                task.return_status = subprocess.call(task.command, shell=True, cwd=sandbox, stdout=devnull, stderr=devnull)
+            task.cmd_execution_time = int((time.time() - t0) * 1e6)
+            missing = []
+            for local_name, remote_name in task.output_files:
+                src = os.path.join(sandbox, remote_name)
+                if os.path.exists(src):
+                    nbytes += os.path.getsize(src)
+                    if os.path.isdir(local_name) and not os.path.islink(local_name):
+                        shutil.rmtree(local_name)
+                    elif os.path.lexists(local_name):
+                        os.remove(local_name)
+                    shutil.move(src, local_name)
+                else:
+                    missing.append(remote_name)
+            task.total_bytes_transferred = nbytes
+            with self.lock:
+                self.counts['bytes_received'] += nbytes - sent
+            if missing:
+                logger.warning("Task '%s' did not produce %s; keeping its directory %s\n" % (task.tag, ' '.join(missing), sandbox))
+                # Like work_queue.WORK_QUEUE_RESULT_OUTPUT_MISSING
+                task.result = 2
+            else:
+                shutil.rmtree(sandbox, ignore_errors=True)
+                task.result = 0
+        except Exception:
+            logger.warning("Task '%s' could not be run:\n%s\n" % (task.tag, traceback.format_exc()))
+        finally:
+            with self.lock:
+                self.counts['running'] -= 1
+                self.counts['done'] += 1
+            self.finished.put(task)
+
+    def wait(self, timeout):
+        """ Return a finished task, or None if none finished within timeout seconds. """
+        try:
+            task = self.finished.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        with self.lock:
+            self.counts['retrieved'] += 1
+        return task
+
+    def empty(self):
+        """ True if all of the submitted tasks have been returned by wait. """
+        with self.lock:
+            return self.counts['retrieved'] == self.counts['submitted']
+
+    @property
+    def stats(self):
+        """ The fields of work_queue.WorkQueue.stats that ForceBalance prints. """
+        with self.lock:
+            c = dict(self.counts)
+        stats = type('LocalWorkQueueStats', (object,), {})()
+        stats.workers_init = 0
+        stats.workers_connected = stats.workers_joined = self.processes
+        stats.workers_removed = 0
+        stats.workers_busy = c['running']
+        stats.workers_idle = self.processes - c['running']
+        stats.tasks_running = c['running']
+        stats.tasks_waiting = c['submitted'] - c['done'] - c['running']
+        stats.tasks_dispatched = c['submitted']
+        stats.tasks_submitted = c['submitted']
+        stats.tasks_done = c['done']
+        stats.bytes_sent = c['bytes_sent']
+        stats.bytes_received = c['bytes_received']
+        return stats
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+def _wq_task(wq, command):
+    """ Create a task for the Work Queue or for the LocalWorkQueue. """
+    if isinstance(wq, LocalWorkQueue):
+        return LocalTask(command)
+    return work_queue.Task(command)
+
 def queue_up(wq, command, input_files, output_files, tag=None, tgt=None, verbose=True, print_time=60):
     """
     Submit a job to the Work Queue.
@@ -912,7 +1367,7 @@ def queue_up(wq, command, input_files, output_files, tag=None, tgt=None, verbose
     @param[in] output_files (list of files) A list of locations of the output files.
     """
     global WQIDS
-    task = work_queue.Task(command)
+    task = _wq_task(wq, command)
     cwd = os.getcwd()
     for f in input_files:
         lf = os.path.join(cwd,f)
@@ -944,7 +1399,7 @@ def queue_up_src_dest(wq, command, input_files, output_files, tag=None, tgt=None
     remote locations of the output files.
     """
     global WQIDS
-    task = work_queue.Task(command)
+    task = _wq_task(wq, command)
     for f in input_files:
         # print f[0], f[1]
         task.specify_input_file(f[0],f[1],cache=False)
@@ -1346,27 +1801,47 @@ def copy_tree_over(src, dest):
 
 # Thanks to cesarkawakami on #python (IRC freenode) for this code.
 class LineChunker(object):
-    def __init__(self, callback):
+    def __init__(self, callback, expand_cr=False):
         self.callback = callback
         self.buf = ""
+        # The decoder keeps the partial multi-byte characters at the end of
+        # a read until the rest of them arrive.
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        # Whether to turn carriage returns (and CR-LF pairs) into newlines.
+        self.expand_cr = expand_cr
+        self.cr = ""
 
     def push(self, data):
         # Added by LPW during Py3 compatibility; ran into some trouble decoding strings such as
         # "a" with umlaut on top.  I guess we can ignore these for now.  For some reason,
         # Py2 never required decoding of data, I can simply add it to the wtring.
         # self.buf += data # Old Py2 code...
-        self.buf += data.decode('utf-8')#errors='ignore')
+        self.buf += self.expand(self.decoder.decode(data))
         self.nomnom()
 
+    def expand(self, text, final=False):
+        if not self.expand_cr: return text
+        text = self.cr + text
+        self.cr = ""
+        # A carriage return at the end may be the first half of a CR-LF pair.
+        if text.endswith("\r") and not final:
+            text, self.cr = text[:-1], "\r"
+        return text.replace("\r\n", "\n").replace("\r", "\n")
+
     def close(self):
+        self.buf += self.expand(self.decoder.decode(b'', final=True), final=True)
+        self.nomnom()
         if self.buf:
             self.callback(self.buf + "\n")
+            self.buf = ""
 
     def nomnom(self):
         # Splits buffer by new line or carriage return, and passes
         # the splitted results onto processing.
-        while "\n" in self.buf or "\r" in self.buf:
-            chunk, sep, self.buf = re.split(r"(\r|\n)", self.buf, maxsplit=1)
+        if "\n" not in self.buf and "\r" not in self.buf: return
+        parts = re.split(r"(\r|\n)", self.buf)
+        self.buf = parts[-1]
+        for chunk, sep in zip(parts[0:-1:2], parts[1:-1:2]):
             self.callback(chunk + sep)
 
     def __enter__(self):
@@ -1375,7 +1850,7 @@ class LineChunker(object):
     def __exit__(self, *args, **kwargs):
         self.close()
 
-def _exec(command, print_to_screen = False, outfnm = None, logfnm = None, stdin = "", print_command = True, copy_stdout = True, copy_stderr = False, persist = False, expand_cr=False, print_error=True, rbytes=1, cwd=None, **kwargs):
+def _exec(command, print_to_screen = False, outfnm = None, logfnm = None, stdin = "", print_command = True, copy_stdout = True, copy_stderr = False, persist = False, expand_cr=False, print_error=True, rbytes=65536, cwd=None, **kwargs):
     """Runs command line using subprocess, optionally returning stdout.
     Options:
     command (required) = Name of the command you want to execute
@@ -1388,11 +1863,13 @@ def _exec(command, print_to_screen = False, outfnm = None, logfnm = None, stdin
     expand_cr = Whether to expand carriage returns into newlines (useful for GROMACS mdrun).
     print_error = Whether to print error messages on a crash. Should be true most of the time.
     persist = Continue execution even if the command gives a nonzero return code.
-    rbytes = Number of bytes to read from stdout and stderr streams at a time.  GMX requires rbytes = 1 otherwise streams are interleaved.  Higher values for speed.
+    rbytes = Largest number of bytes to read from the stdout and stderr streams at a time.  Each read returns whatever is available,
+             and the two streams are split into lines separately, so lines from stdout and stderr are never mixed.
     """
 
     # Dictionary of options to be passed to the Popen object.
-    cmd_options={'shell':isinstance(command, six.string_types), 'stdin':PIPE, 'stdout':PIPE, 'stderr':PIPE, 'universal_newlines':expand_cr, 'cwd':cwd}
+    # The streams are read as bytes; carriage returns are expanded by the LineChunker.
+    cmd_options={'shell':isinstance(command, six.string_types), 'stdin':PIPE, 'stdout':PIPE, 'stderr':PIPE, 'cwd':cwd}
 
     # If the current working directory is provided, the outputs will be written to there as well.
     if cwd is not None:
@@ -1402,17 +1879,15 @@ def _exec(command, print_to_screen = False, outfnm = None, logfnm = None, stdin
             logfnm = os.path.abspath(os.path.join(cwd, logfnm))
 
     # "write to file" : Function for writing some characters to the log and/or output files.
+    # The files are opened on the first write and kept open until the process is finished.
+    wfiles = OrderedDict()
     def wtf(out):
-        if logfnm is not None:
-            with open(logfnm,'ab+') as f:
-                f.write(out.encode('utf-8'))
-                f.flush()
-        if outfnm is not None:
-            with open(outfnm,'wb+' if wtf.first else 'ab+') as f:
-                f.write(out.encode('utf-8'))
-                f.flush()
-        wtf.first = False
-    wtf.first = True
+        out = out.encode('utf-8')
+        for key, fnm, mode in (('log', logfnm, 'ab+'), ('out', outfnm, 'wb+')):
+            if fnm is None: continue
+            if key not in wfiles:
+                wfiles[key] = open(fnm, mode)
+            wfiles[key].write(out)
 
     # Preserve backwards compatibility; sometimes None gets passed to stdin.
     if stdin is None: stdin = ""
@@ -1466,71 +1941,34 @@ def _exec(command, print_to_screen = False, outfnm = None, logfnm = None, stdin
             process_out.stdout.append(read)
             wtf(read)
     process_err.stderr = []
-    # This reads the streams one byte at a time, and passes it to the LineChunker
-    # which splits it by either newline or carriage return.
+    # This reads whatever is available on the streams (up to rbytes), and passes it to
+    # the LineChunker which splits it by either newline or carriage return.
     # If the stream has ended, then it is removed from the list.
-    with LineChunker(process_out) as out_chunker, LineChunker(process_err) as err_chunker:
+    with LineChunker(process_out, expand_cr) as out_chunker, LineChunker(process_err, expand_cr) as err_chunker:
+        chunkers = {p.stdout : (out_chunker, 'stdout'), p.stderr : (err_chunker, 'stderr')}
         while True:
             to_read, _, _ = select(streams, [], [])
             for fh in to_read:
-                # We want to call fh.read below, but this can lead to a system hang when executing Tinker on mac.
-                # This hang can be avoided by running fh.read1 (with a "1" at the end), however python2.7
-                # doesn't implement ByteStream.read1. So, to enable python3 builds on mac to work, we pick the "best"
-                # fh.read function we can get
-                if hasattr(fh, 'read1'):
-                    fhread = fh.read1
-                else:
-                    fhread = fh.read
-
-                if fh is p.stdout:
-                    read_nbytes = 0
-                    read = ''.encode('utf-8')
-                    while True:
-                        if read_nbytes == 0:
-                            read += fhread(rbytes)
-                            read_nbytes += rbytes
-                        else:
-                            read += fhread(1)
-                            read_nbytes += 1
-                        if read_nbytes > 10+rbytes:
-                            raise RuntimeError("Failed to decode stdout from external process.")
-                        if not read:
-                            streams.remove(p.stdout)
-                            p.stdout.close()
-                            break
-                        else:
-                            try:
-                                out_chunker.push(read)
-                                break
-                            except UnicodeDecodeError:
-                                pass
-                elif fh is p.stderr:
-                    read_nbytes = 0
-                    read = ''.encode('utf-8')
-                    while True:
-                        if read_nbytes == 0:
-                            read += fhread(rbytes)
-                            read_nbytes += rbytes
-                        else:
-                            read += fhread(1)
-                            read_nbytes += 1
-                        if read_nbytes > 10+rbytes:
-                            raise RuntimeError("Failed to decode stderr from external process.")
-                        if not read:
-                            streams.remove(p.stderr)
-                            p.stderr.close()
-                            break
-                        else:
-                            try:
-                                err_chunker.push(read)
-                                break
-                            except UnicodeDecodeError:
-                                pass
-                else:
-                    raise RuntimeError
+                # Reading the file descriptor directly returns as soon as there is any data
+                # (fh.read can hang when executing Tinker on mac), and never leaves data in
+                # a Python buffer where select cannot see it.
+                read = os.read(fh.fileno(), rbytes)
+                chunker, name = chunkers[fh]
+                if not read:
+                    streams.remove(fh)
+                    fh.close()
+                    continue
+                try:
+                    chunker.push(read)
+                except UnicodeDecodeError:
+                    raise RuntimeError("Failed to decode %s from external process." % name)
+            for f in wfiles.values():
+                f.flush()
             if len(streams) == 0: break
 
     p.wait()
+    for f in wfiles.values():
+        f.close()
 
     process_out.stdout = ''.join(process_out.stdout)
     process_err.stderr = ''.join(process_err.stderr)
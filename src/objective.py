@@ -7,12 +7,19 @@ from builtins import range
 from builtins import object
 import sys
 import inspect
+import atexit
+import contextlib
+import io
+import multiprocessing
+import multiprocessing.connection
+import time
 #from implemented import Implemented_Targets
 import numpy as np
 from collections import defaultdict, OrderedDict
 import forcebalance
-from forcebalance.finite_difference import in_fd
-from forcebalance.nifty import printcool_dictionary, createWorkQueue, getWorkQueue, wq_wait
+import forcebalance.optimizer
+from forcebalance.finite_difference import in_fd, fd_context, _fd_state
+from forcebalance.nifty import printcool_dictionary, createWorkQueue, createLocalWorkQueue, getWorkQueue, wq_wait, warn_press_key
 import datetime
 import traceback
 from forcebalance.output import getLogger
@@ -134,6 +141,171 @@ Implemented_Targets = {
 ## This is the canonical lettering that corresponds to : objective function, gradient, Hessian.
 Letters = ['X','G','H']
 
+def _target_task(Tgt, task, mvals, Order, verbose, customdir):
+    """ Carry out one task for a target in a TargetPool worker. """
+    if task == 'get':
+        Tgt.stage(mvals, AGrad = Order >= 1, AHess = Order >= 2, customdir=customdir)
+        Tgt.bSave = True
+        Funcs = [Tgt.get_X, Tgt.get_G, Tgt.get_H]
+        Ans = Funcs[Order](mvals, customdir=customdir)
+        if verbose:
+            Tgt.meta_indicate(customdir=customdir)
+        Tgt.evaluated = True
+        return Ans
+    elif task == 'indicate':
+        Tgt.meta_indicate()
+    else:
+        raise RuntimeError("Unknown task %s" % task)
+
+def _target_worker(conn, Targets):
+    """
+    Main loop of a TargetPool worker process.  It evaluates the
+    targets that it owns whenever the main process asks, and sends back
+    the results together with the printout.
+    """
+    # Keep the printout instead of writing it, so the main process can print it in order.
+    # The package logger goes back to its default handler, which writes to sys.stdout.
+    sys.stdout = sys.stderr = io.StringIO()
+    fblogger = getLogger('forcebalance')
+    for hdlr in fblogger.handlers[:]:
+        fblogger.removeHandler(hdlr)
+    def printout():
+        text = sys.stdout.getvalue()
+        sys.stdout.seek(0)
+        sys.stdout.truncate(0)
+        return text
+    for Tgt in Targets.values():
+        for engine in Tgt.get_engines():
+            engine.worker_init()
+    while True:
+        message = conn.recv()
+        if message is None: break
+        name, task, args, state = message
+        Tgt = Targets[name]
+        # Bring this copy of the target up to date with the main process.
+        forcebalance.optimizer.ITERATION = state['iteration']
+        for key in ['h', 'goodstep', 'evaluated']:
+            setattr(Tgt, key, state[key])
+        t0 = time.time()
+        try:
+            with contextlib.ExitStack() as stack:
+                for i in range(state['fd']): stack.enter_context(fd_context())
+                for i in range(state['srch']): stack.enter_context(fd_context(srch=True))
+                result = _target_task(Tgt, task, *args)
+            conn.send((True, result, time.time() - t0, printout()))
+        except:
+            conn.send((False, traceback.format_exc(), time.time() - t0, printout()))
+    conn.close()
+
+class TargetPool(object):
+    """
+    A pool of local processes that evaluate the targets in parallel.
+
+    Each target is owned by one worker process for the whole
+    calculation, which keeps its copy of the target and engines
+    (e.g. the OpenMM Context) between evaluations.  The workers are forked
+    from the main process; the targets are divided among them starting
+    from the longest-running ones (as recorded from previous evaluations),
+    each going to the worker with the least work so far.  Because the
+    targets cannot move between workers, later evaluations only change
+    the order in which each worker goes through its own targets.
+    """
+    def __init__(self, Targets, processes, Times):
+        ## The most recent run time of each target, updated after each evaluation.
+        self.Times = OrderedDict(Times)
+        processes = min(processes, len(Targets))
+        Load = [0.0 for i in range(processes)]
+        self.owner = OrderedDict()
+        # Longest-running targets first.
+        for name in sorted([Tgt.name for Tgt in Targets], key=lambda name: -Times.get(name, 0.0)):
+            i = Load.index(min(Load))
+            self.owner[name] = i
+            Load[i] += Times.get(name, 0.0)
+        logger.info("Evaluating %i targets on %i processes, expected time per process: %s seconds\n" % (len(Targets), processes, ' '.join(['%.1f' % i for i in Load])))
+        ctx = multiprocessing.get_context('fork')
+        self.conns = []
+        self.procs = []
+        for i in range(processes):
+            Owned = OrderedDict([(Tgt.name, Tgt) for Tgt in Targets if self.owner[Tgt.name] == i])
+            parent, child = ctx.Pipe()
+            proc = ctx.Process(target=_target_worker, args=(child, Owned))
+            proc.start()
+            child.close()
+            self.conns.append(parent)
+            self.procs.append(proc)
+        atexit.register(self.close)
+
+    def queues(self, names):
+        """
+        Return the targets that each worker should work through, with the
+        longest-running ones (in their most recent evaluation) first.
+        """
+        order = sorted(names, key=lambda name: -self.Times.get(name, 0.0))
+        return [[name for name in order if self.owner[name] == i] for i in range(len(self.conns))]
+
+    def run(self, Targets, task, args=()):
+        """
+        Carry out a task for each of the targets, and return the
+        results and run times.  Each worker works through its own targets
+        longest-first; their printout is shown in the order of the
+        targets as soon as all of the earlier ones are finished.  The run
+        times of the 'get' task set the order of the next evaluation.
+        """
+        Tgts = OrderedDict([(Tgt.name, Tgt) for Tgt in Targets])
+        Queues = self.queues(list(Tgts.keys()))
+        state = {'iteration' : forcebalance.optimizer.Counter(), 'fd' : getattr(_fd_state, 'fd', 0), 'srch' : getattr(_fd_state, 'srch', 0)}
+        Busy = OrderedDict()
+        def submit(i):
+            if len(Queues[i]) > 0:
+                name = Queues[i].pop(0)
+                Tgt = Tgts[name]
+                state.update({'h' : Tgt.h, 'goodstep' : Tgt.goodstep, 'evaluated' : Tgt.evaluated})
+                self.conns[i].send((name, task, args, state))
+                Busy[self.conns[i]] = (i, name)
+        for i in range(len(self.conns)):
+            submit(i)
+        Results = OrderedDict()
+        Times = OrderedDict()
+        Logs = OrderedDict()
+        Errors = []
+        Printed = 0
+        while len(Busy) > 0:
+            for conn in multiprocessing.connection.wait(list(Busy.keys())):
+                i, name = Busy.pop(conn)
+                ok, result, Times[name], Logs[name] = conn.recv()
+                if ok:
+                    Results[name] = result
+                else:
+                    Errors.append((name, result))
+                    Results[name] = None
+                if len(Errors) == 0:
+                    submit(i)
+            while Printed < len(Tgts) and list(Tgts.keys())[Printed] in Logs:
+                logger.info(Logs[list(Tgts.keys())[Printed]])
+                Printed += 1
+        if len(Errors) > 0:
+            for name, tb in Errors:
+                logger.error("Target %s failed in a worker process:\n%s\n" % (name, tb))
+            raise RuntimeError
+        if task == 'get':
+            self.Times.update(Times)
+        return Results, Times
+
+    def close(self):
+        """ Stop the worker processes. """
+        for conn, proc in zip(self.conns, self.procs):
+            if proc.is_alive():
+                try:
+                    conn.send(None)
+                except (IOError, OSError):
+                    pass
+        for proc in self.procs:
+            proc.join(10)
+            if proc.is_alive():
+                proc.terminate()
+        self.conns = []
+        self.procs = []
+
 class Objective(forcebalance.BaseClass):
     """ Objective function.
 
@@ -162,8 +334,23 @@ class Objective(forcebalance.BaseClass):
         self.set_option(options, 'normalize_weights')
         ## Work Queue Port (The specific target itself may or may not actually use this.)
         self.set_option(options, 'wq_port')
+        ## Number of local processes that run the Work Queue tasks when there is no Work Queue port.
+        self.set_option(options, 'wq_local')
         ## Asynchronous objective function evaluation (i.e. execute Work Queue and local objective concurrently.)
         self.set_option(options, 'asynchronous')
+        ## Number of local processes for evaluating the targets in parallel.
+        self.set_option(options, 'target_processes')
+        if self.target_processes > 1 and (self.wq_port != 0 or self.wq_local > 0 or self.asynchronous):
+            warn_press_key("target_processes cannot be combined with Work Queue or asynchronous evaluation; evaluating the targets in this process")
+            self.target_processes = 1
+        if self.target_processes > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+            warn_press_key("target_processes requires forked processes, which are not available on this platform")
+            self.target_processes = 1
+        ## The pool of processes that evaluate the targets, created after the targets
+        ## have been evaluated once in this process to record how long each one takes.
+        self.TargetPool = None
+        ## The most recent run time of each target.
+        self.TargetTimes = OrderedDict()
 
         ## The list of fitting targets
         self.Targets = []
@@ -178,7 +365,7 @@ class Objective(forcebalance.BaseClass):
             # Target class from the Implemented_Targets dictionary
             # using opts['type'] as the key.  The object is created by
             # passing (options, opts, forcefield) to the constructor.
-            if opts["remote"] and self.wq_port != 0: Tgt = forcebalance.target.RemoteTarget(options, opts, forcefield)
+            if opts["remote"] and (self.wq_port != 0 or self.wq_local > 0): Tgt = forcebalance.target.RemoteTarget(options, opts, forcefield)
             else: Tgt = Implemented_Targets[opts['type']](options,opts,forcefield)
             self.Targets.append(Tgt)
             printcool_dictionary(Tgt.PrintOptionDict,"Setup for target %s :" % Tgt.name)
@@ -205,6 +392,9 @@ class Objective(forcebalance.BaseClass):
         if self.wq_port != 0:
             createWorkQueue(self.wq_port)
             logger.info('Work Queue is listening on %d\n' % self.wq_port)
+        elif self.wq_local > 0:
+            createLocalWorkQueue(self.wq_local)
+            logger.info('Running the Work Queue tasks on %i local processes\n' % self.wq_local)
 
         printcool_dictionary(self.PrintOptionDict, "Setup for objective function :")
 
@@ -212,9 +402,37 @@ class Objective(forcebalance.BaseClass):
     def Target_Terms(self, mvals, Order=0, verbose=False, customdir=None):
         ## This is the objective function; it's a dictionary containing the value, first and second derivatives
         Objective = {'X':0.0, 'G':np.zeros(self.FF.np), 'H':np.zeros((self.FF.np,self.FF.np))}
+        if self.target_processes > 1 and self.TargetPool is None and len(self.TargetTimes) == len(self.Targets):
+            self.TargetPool = TargetPool(self.Targets, self.target_processes, self.TargetTimes)
+        if self.TargetPool is not None:
+            # The worker processes stage and evaluate the targets that they own.
+            Answers, Times = self.TargetPool.run(self.Targets, 'get', (mvals, Order, verbose, customdir))
+            self.TargetTimes.update(Times)
+            # The contributions are added up in the order of the targets.
+            for Tgt in self.Targets:
+                Ans = Answers[Tgt.name]
+                if not in_fd():
+                    self.ObjDict[Tgt.name] = {'w' : Tgt.weight/self.WTot , 'x' : Ans['X']}
+                for i in range(3):
+                    Objective[Letters[i]] += Ans[Letters[i]]*Tgt.weight/self.WTot
+        else:
+            self.Target_Terms_Local(mvals, Objective, Order, verbose, customdir)
+        # The target has evaluated at least once.
+        for Tgt in self.Targets:
+            Tgt.evaluated = True
+        # Safeguard to make sure we don't have exact zeros on Hessian diagonal
+        for i in range(self.FF.np):
+            if Objective['H'][i,i] == 0.0:
+                Objective['H'][i,i] = 1.0
+        return Objective
+
+    def Target_Terms_Local(self, mvals, Objective, Order=0, verbose=False, customdir=None):
+        """ Evaluate the targets in this process and add their contributions to Objective. """
         # Loop through the targets, stage the directories and submit the Work Queue processes.
         for Tgt in self.Targets:
+            t0 = time.time()
             Tgt.stage(mvals, AGrad = Order >= 1, AHess = Order >= 2, customdir=customdir)
+            self.TargetTimes[Tgt.name] = time.time() - t0
         if self.asynchronous:
             # Asynchronous evaluation of objective function and Work Queue tasks.
             # Create a list of the targets, and remove them from the list as they are finished.
@@ -247,12 +465,14 @@ class Objective(forcebalance.BaseClass):
             if wq is not None:
                 wq_wait(wq)
             for Tgt in self.Targets:
+                t0 = time.time()
                 # The first call is always done at the midpoint.
                 Tgt.bSave = True
                 # List of functions that I can call.
                 Funcs   = [Tgt.get_X, Tgt.get_G, Tgt.get_H]
                 # Call the appropriate function
                 Ans = Funcs[Order](mvals, customdir=customdir)
+                self.TargetTimes[Tgt.name] += time.time() - t0
                 # Print out the qualitative indicators
                 if verbose:
                     Tgt.meta_indicate(customdir=customdir)
@@ -261,14 +481,14 @@ class Objective(forcebalance.BaseClass):
                     self.ObjDict[Tgt.name] = {'w' : Tgt.weight/self.WTot , 'x' : Ans['X']}
                 for i in range(3):
                     Objective[Letters[i]] += Ans[Letters[i]]*Tgt.weight/self.WTot
-        # The target has evaluated at least once.
-        for Tgt in self.Targets:
-            Tgt.evaluated = True
-        # Safeguard to make sure we don't have exact zeros on Hessian diagonal
-        for i in range(self.FF.np):
-            if Objective['H'][i,i] == 0.0:
-                Objective['H'][i,i] = 1.0
-        return Objective
+
+    def Target_Indicate(self):
+        """ Print the qualitative indicators of the targets. """
+        if self.TargetPool is not None:
+            self.TargetPool.run(self.Targets, 'indicate')
+        else:
+            for Tgt in self.Targets:
+                Tgt.meta_indicate()
 
     def Indicate(self):
         """ Print objective function contributions. """
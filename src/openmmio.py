@@ -8,6 +8,7 @@ from __future__ import division
 from builtins import zip
 from builtins import range
 import os
+import hashlib
 from forcebalance import BaseReader
 from forcebalance.abinitio import AbInitio
 from forcebalance.binding import BindingEnergy
@@ -23,6 +24,8 @@ import numpy as np
 import sys
 import pickle
 import shutil
+from types import SimpleNamespace
+from io import BytesIO
 from copy import deepcopy
 from forcebalance.engine import Engine
 from forcebalance.molecule import *
@@ -53,6 +56,10 @@ except ImportError:
     # Need to have "pass" conditional if neither is installed so that non-openmm builds can parse this file
     pass
 
+try:
+    from lxml import etree
+except: pass
+
 def force_name(force):
     if openmm_post76:
         name = force.getName()
@@ -451,6 +458,68 @@ def UpdateSimulationParameters(src_system, dest_simulation):
                 dest_simulation.context.setParameter(pName, pValue)
 
 
+## Forces whose per-term parameters may be changed in an existing Context
+## with updateParametersInContext.  For each kind of term, the names of the
+## methods that return the number of terms and get / set the term parameters.
+ParameterTerms = {'HarmonicBondForce' : [('getNumBonds', 'getBondParameters', 'setBondParameters')],
+                  'HarmonicAngleForce' : [('getNumAngles', 'getAngleParameters', 'setAngleParameters')],
+                  'PeriodicTorsionForce' : [('getNumTorsions', 'getTorsionParameters', 'setTorsionParameters')],
+                  'RBTorsionForce' : [('getNumTorsions', 'getTorsionParameters', 'setTorsionParameters')],
+                  'NonbondedForce' : [('getNumParticles', 'getParticleParameters', 'setParticleParameters'),
+                                      ('getNumExceptions', 'getExceptionParameters', 'setExceptionParameters')],
+                  'CustomNonbondedForce' : [('getNumParticles', 'getParticleParameters', 'setParticleParameters')],
+                  'CustomBondForce' : [('getNumBonds', 'getBondParameters', 'setBondParameters')],
+                  'CustomAngleForce' : [('getNumAngles', 'getAngleParameters', 'setAngleParameters')],
+                  'CustomTorsionForce' : [('getNumTorsions', 'getTorsionParameters', 'setTorsionParameters')],
+                  'CustomCompoundBondForce' : [('getNumBonds', 'getBondParameters', 'setBondParameters')],
+                  'GBSAOBCForce' : [('getNumParticles', 'getParticleParameters', 'setParticleParameters')]}
+
+def ParameterLeaves(params):
+    """ Return the floating point numbers in the parameters of a force term (e.g. from getBondParameters) as a flat list. """
+    if isinstance(params, Quantity):
+        return ParameterLeaves(params._value)
+    elif isinstance(params, (list, tuple)):
+        leaves = []
+        for i in params:
+            leaves += ParameterLeaves(i)
+        return leaves
+    elif isinstance(params, float):
+        return [params]
+    return []
+
+def ReplaceLeaves(params, leaves):
+    """ Replace the floating point numbers in the parameters of a force term
+    with values taken in order from the iterator 'leaves' (the inverse of ParameterLeaves). """
+    if isinstance(params, Quantity):
+        return Quantity(ReplaceLeaves(params._value, leaves), params.unit)
+    elif isinstance(params, Vec3):
+        return Vec3(*[ReplaceLeaves(i, leaves) for i in params])
+    elif isinstance(params, (list, tuple)):
+        return type(params)([ReplaceLeaves(i, leaves) for i in params])
+    elif isinstance(params, float):
+        return float(next(leaves))
+    return params
+
+def GetTermParameters(force, kind, i):
+    """ Get the parameters of term i of the given kind (an index into ParameterTerms) from a force. """
+    return getattr(force, ParameterTerms[force.__class__.__name__][kind][1])(i)
+
+def SetTermParameters(force, kind, i, params):
+    """ Set the parameters of term i of the given kind (an index into ParameterTerms) in a force. """
+    setter = getattr(force, ParameterTerms[force.__class__.__name__][kind][2])
+    # Per-particle parameters of custom nonbonded forces are returned as a tuple and set as a list.
+    if isinstance(params, tuple):
+        setter(i, list(params))
+    else:
+        setter(i, *params)
+
+def GetSystemSignature(system):
+    """ Return the particle masses, constraints and virtual sites of a system,
+    which cannot be changed by updating the force parameters in a Context. """
+    masses = [system.getParticleMass(i)._value for i in range(system.getNumParticles())]
+    constraints = [(lambda c: (c[0], c[1], c[2]._value))(system.getConstraintParameters(i)) for i in range(system.getNumConstraints())]
+    return masses, constraints, list(GetVirtualSiteParameters(system)), system.getNumForces()
+
 def SetAmoebaVirtualExclusions(system):
     if any([force_name(f) == "AmoebaMultipoleForce" for f in system.getForces()]):
         # logger.info("Cajoling AMOEBA covalent maps so they work with virtual sites.\n")
@@ -673,9 +742,17 @@ class OpenMM(Engine):
         if hasattr(self,'target'):
             self.platname = self.target.platname
             self.precision = self.target.precision
+            ## Update parameters in the existing Context without rebuilding the System.
+            self.fast_update = getattr(self.target, 'fast_update', False)
+            ## Number of Contexts over which the snapshots are divided.
+            self.batch_contexts = getattr(self.target, 'batch_contexts', 1)
         else:
             self.platname = platname
             self.precision = precision
+            self.fast_update = False
+            self.batch_contexts = 1
+        ## Physical parameter values of the System in the Simulation (for fast_update).
+        self.fast_pvals = None
 
         valnames = [Platform.getPlatform(i).getName() for i in range(Platform.getNumPlatforms())]
         if self.platname not in valnames:
@@ -773,6 +850,8 @@ class OpenMM(Engine):
         if hasattr(self, 'FF'):
             self.ffxml = [self.FF.openmmxml]
             self.forcefield = ForceField(os.path.join(self.root, self.FF.ffdir, self.FF.openmmxml))
+            ## With incremental_make, the force field is taken from memory rather than from the XML file.
+            self.ff_in_memory = self.FF.incremental_make
         else:
             self.ffxml = listfiles(kwargs.get('ffxml'), 'xml', err=True)
             self.forcefield = ForceField(*self.ffxml)
@@ -857,6 +936,18 @@ class OpenMM(Engine):
             self.mmopts.setdefault('nonbondedMethod', NoCutoff)
             self.mmopts['removeCMMotion'] = False
 
+        ## Map parameters to the terms that they change in the System.
+        if self.fast_update:
+            if self.ff_in_memory:
+                # Kept by the target because some targets delete and recreate their engines.
+                maps = self.target.__dict__.setdefault('fast_update_maps', {})
+                if self.name not in maps:
+                    maps[self.name] = self.build_parameter_map()
+                self.param_map, self.param_map_pvals = maps[self.name]
+            else:
+                warn_once("openmm_fast_update requires incremental_make; the System will be rebuilt for every parameter update.")
+                self.fast_update = False
+
         ## Generate list of OpenMM-compatible positions
         mod = self.generate_xyz_omm(self.mol)
         ## Build a topology and atom lists.
@@ -1003,47 +1094,21 @@ class OpenMM(Engine):
         """
         if len(kwargs) > 0:
             self.simkwargs = kwargs
-        self.forcefield = ForceField(*self.ffxml)
-        # OpenMM classes for force generators
-        ismgens = [forcefield.AmoebaGeneralizedKirkwoodGenerator, forcefield.AmoebaWcaDispersionGenerator,
-                     forcefield.CustomGBGenerator, forcefield.GBSAOBCGenerator]
-        if self.ism is not None:
-            if self.ism == False:
-                self.forcefield._forces = [f for f in self.forcefield._forces if not any([isinstance(f, f_) for f_ in ismgens])]
-            elif self.ism == True:
-                if len([f for f in self.forcefield._forces if any([isinstance(f, f_) for f_ in ismgens])]) == 0:
-                    logger.error("There is no implicit solvent model!\n")
-                    raise RuntimeError
-        self.mod = Modeller(self.pdb.topology, self.pdb.positions)
-        self.mod.addExtraParticles(self.forcefield)
-        # Add bonds for virtual sites. (Experimental)
-        if self.vbonds: AddVirtualSiteBonds(self.mod, self.forcefield)
-        #printcool_dictionary(self.mmopts, title="Creating/updating simulation in engine %s with system settings:" % (self.name))
-        # for b in list(self.mod.topology.bonds()):
-        #     print b[0].index, b[1].index
-        try:
-            self.system = self.forcefield.createSystem(self.mod.topology, **self.mmopts)
-        # This try/except block catches a failure case introduced by the release of openmm 7.7
-        # where a ValueError would be raised if createSystem was given an unused kwarg.
-        # Now, when that error occurs, we remove the unused kwargs from mmopts.
-        # More info at https://github.com/leeping/forcebalance/issues/246
-        except ValueError as e:
-            if 'useSwitchingFunction' not in str(e):
-                raise e
-            self.mmopts.pop('useSwitchingFunction')
-            self.mmopts.pop('switchingDistance')
-            self.system = self.forcefield.createSystem(self.mod.topology, **self.mmopts)
+        if self.fast_update and hasattr(self, 'simulation') and self.fast_update_parameters():
+            return
+        if self.ff_in_memory:
+            self.forcefield = ForceField(BytesIO(etree.tostring(self.FF.get_ffdata(self.FF.openmmxml))))
+        else:
+            self.forcefield = ForceField(*self.ffxml)
+        self.mod, self.system = self.build_system(self.forcefield)
+        if self.fast_update:
+            self.fast_pvals = self.FF.get_pvals()
         self.vsinfo = PrepareVirtualSites(self.system)
         self.nbcharges = np.zeros(self.system.getNumParticles())
 
         for i in self.system.getForces():
             if isinstance(i, NonbondedForce):
                 self.nbcharges = np.array([i.getParticleParameters(j)[0]._value for j in range(i.getNumParticles())])
-                if self.SetPME:
-                    i.setNonbondedMethod(i.PME)
-            if isinstance(i, AmoebaMultipoleForce):
-                if self.SetPME:
-                    i.setNonbondedMethod(i.PME)
 
         #----
         # If the virtual site parameters have changed,
@@ -1080,6 +1145,211 @@ class OpenMM(Engine):
         else:
             self.create_simulation(**self.simkwargs)
 
+    def build_system(self, ff):
+        """
+        Create the Modeller and System objects from an OpenMM ForceField object.
+
+        @param[in] ff OpenMM ForceField object
+        @return mod, system
+        """
+        # OpenMM classes for force generators
+        ismgens = [forcefield.AmoebaGeneralizedKirkwoodGenerator, forcefield.AmoebaWcaDispersionGenerator,
+                     forcefield.CustomGBGenerator, forcefield.GBSAOBCGenerator]
+        if self.ism is not None:
+            if self.ism == False:
+                ff._forces = [f for f in ff._forces if not any([isinstance(f, f_) for f_ in ismgens])]
+            elif self.ism == True:
+                if len([f for f in ff._forces if any([isinstance(f, f_) for f_ in ismgens])]) == 0:
+                    logger.error("There is no implicit solvent model!\n")
+                    raise RuntimeError
+        mod = Modeller(self.pdb.topology, self.pdb.positions)
+        mod.addExtraParticles(ff)
+        # Add bonds for virtual sites. (Experimental)
+        if self.vbonds: AddVirtualSiteBonds(mod, ff)
+        #printcool_dictionary(self.mmopts, title="Creating/updating simulation in engine %s with system settings:" % (self.name))
+        # for b in list(mod.topology.bonds()):
+        #     print b[0].index, b[1].index
+        try:
+            system = ff.createSystem(mod.topology, **self.mmopts)
+        # This try/except block catches a failure case introduced by the release of openmm 7.7
+        # where a ValueError would be raised if createSystem was given an unused kwarg.
+        # Now, when that error occurs, we remove the unused kwargs from mmopts.
+        # More info at https://github.com/leeping/forcebalance/issues/246
+        except ValueError as e:
+            if 'useSwitchingFunction' not in str(e):
+                raise e
+            self.mmopts.pop('useSwitchingFunction')
+            self.mmopts.pop('switchingDistance')
+            system = ff.createSystem(mod.topology, **self.mmopts)
+        for i in system.getForces():
+            if isinstance(i, (NonbondedForce, AmoebaMultipoleForce)):
+                if self.SetPME:
+                    i.setNonbondedMethod(i.PME)
+        return mod, system
+
+    def displaced_system(self, FF, pvals):
+        """
+        Build the OpenMM System from a working copy of the force field
+        at the provided physical parameters.
+
+        @param[in] FF Copy of the force field object, which is modified
+        @param[in] pvals Physical parameters
+        @return system
+        """
+        FF.make_incremental(list(pvals), write=False)
+        return self.build_system(ForceField(BytesIO(etree.tostring(FF.get_ffdata(FF.openmmxml)))))[1]
+
+    def dependence_key(self):
+        """
+        Identify the system by its serialized OpenMM System at the initial
+        parameters, so that targets containing the same system share the
+        parameter dependency index.
+        """
+        if not hasattr(self, 'FF') or not hasattr(self.FF, 'openmmxml'): return None
+        system = self.displaced_system(deepcopy(self.FF), self.FF.pvals0)
+        return (self.__class__.__name__, hashlib.sha1(XmlSerializer.serialize(system).encode('utf-8')).hexdigest())
+
+    def build_dependence(self):
+        """
+        Find the parameters that change the OpenMM System, by displacing
+        each one and comparing the serialized forces and the particle
+        masses, constraints and virtual sites with the undisplaced System.
+        The index records the names of the forces that each parameter
+        changes ('System' for the masses, constraints and virtual sites).
+        """
+        FF = deepcopy(self.FF)
+        pvals0 = np.array(FF.pvals0)
+        S0 = self.displaced_system(FF, pvals0)
+        sig0 = GetSystemSignature(S0)
+        xml0 = [XmlSerializer.serialize(f) for f in S0.getForces()]
+        phys = OrderedDict()
+        for i in range(FF.np):
+            dp = np.zeros(FF.np)
+            dp[i] = 0.01*abs(pvals0[i]) if pvals0[i] != 0.0 else 0.01*FF.rs[i]
+            S = self.displaced_system(FF, pvals0+dp)
+            terms = ['System'] if GetSystemSignature(S) != sig0 else []
+            terms += [force_name(S.getForce(f)) for f in range(S.getNumForces()) if XmlSerializer.serialize(S.getForce(f)) != xml0[f]]
+            if len(terms) > 0:
+                phys[i] = terms
+        return FF.mathematical_dependence(phys)
+
+    def build_parameter_map(self):
+        """
+        Find the terms in the OpenMM System that depend on each physical
+        parameter, for updating the parameters in an existing Context
+        without rebuilding the System (the openmm_fast_update option).
+
+        Each parameter is displaced in both directions and the resulting
+        Systems are compared to the undisplaced one.  A parameter is entered
+        into the map if all of the changes are in per-term parameters
+        of the forces in ParameterTerms, they are linear in the parameter,
+        and none of these values depend on any other parameter.  Parameters
+        that fail these checks (e.g. a charge that also enters the 1-4 pair
+        charge products, or anything that changes virtual sites or Drude
+        particles) are handled by rebuilding the System as usual.
+
+        @return param_map, pvals0 (the physical parameters that the map refers to)
+        """
+        # A copy of the force field is used to print the displaced parameters.
+        FF = deepcopy(self.FF)
+        pvals0 = np.array(FF.pvals0)
+        def displaced(pvals):
+            system = self.displaced_system(FF, pvals)
+            return system, GetSystemSignature(system), [XmlSerializer.serialize(f) for f in system.getForces()]
+        S0, sig0, xml0 = displaced(pvals0)
+        param_map = OrderedDict()
+        owners = defaultdict(set)
+        for p in range(FF.np):
+            h = 0.01*abs(pvals0[p]) if pvals0[p] != 0.0 else 0.01*FF.rs[p]
+            dp = np.zeros(FF.np)
+            dp[p] = h
+            Sp, sigp, xmlp = displaced(pvals0+dp)
+            Sm, sigm, xmlm = displaced(pvals0-dp)
+            terms = OrderedDict()
+            linear = (sigp == sig0 and sigm == sig0)
+            for f in range(S0.getNumForces()):
+                if xmlp[f] == xml0[f] and xmlm[f] == xml0[f]: continue
+                nm = S0.getForce(f).__class__.__name__
+                if nm not in ParameterTerms:
+                    linear = False
+                    continue
+                # Copies of the undisplaced force, which should become identical to the
+                # displaced forces after setting the changed term parameters.
+                fp = XmlSerializer.deserialize(xml0[f])
+                fm = XmlSerializer.deserialize(xml0[f])
+                for k, (num, get, set_) in enumerate(ParameterTerms[nm]):
+                    for i in range(getattr(S0.getForce(f), num)()):
+                        v0 = np.array(ParameterLeaves(GetTermParameters(S0.getForce(f), k, i)))
+                        vp = np.array(ParameterLeaves(GetTermParameters(Sp.getForce(f), k, i)))
+                        vm = np.array(ParameterLeaves(GetTermParameters(Sm.getForce(f), k, i)))
+                        if len(vp) != len(v0) or len(vm) != len(v0):
+                            linear = False
+                            continue
+                        if (vp == v0).all() and (vm == v0).all(): continue
+                        SetTermParameters(fp, k, i, GetTermParameters(Sp.getForce(f), k, i))
+                        SetTermParameters(fm, k, i, GetTermParameters(Sm.getForce(f), k, i))
+                        idx = np.nonzero((vp != v0) | (vm != v0))[0]
+                        # Every parameter that changes a value is recorded, including
+                        # the ones that cannot be mapped themselves.
+                        for j in idx:
+                            owners[(f, k, i, j)].add(p)
+                        # The second difference should vanish up to the precision of the printed force field.
+                        if np.any(np.abs(vp[idx] - 2*v0[idx] + vm[idx]) > 1e-6*np.abs(vp[idx] - vm[idx]) + 1e-10*np.abs(v0[idx])):
+                            linear = False
+                        terms[(f, k, i)] = (idx, v0[idx], (vp[idx] - vm[idx]) / (2*h))
+                if XmlSerializer.serialize(fp) != xmlp[f] or XmlSerializer.serialize(fm) != xmlm[f]:
+                    linear = False
+            if linear:
+                param_map[p] = terms
+        # Remove parameters that share any value with another parameter.
+        for p in list(param_map.keys()):
+            if any([len(owners[key+(j,)]) > 1 for key, (idx, v0, slope) in param_map[p].items() for j in idx]):
+                del param_map[p]
+        logger.info("%i out of %i parameters can be updated in the OpenMM Context without rebuilding the System\n" % (len(param_map), FF.np))
+        return param_map, pvals0
+
+    def fast_update_parameters(self):
+        """
+        Set the changed parameters directly in the existing Simulation,
+        if all of the physical parameters that changed since the last
+        update are in the parameter map (see build_parameter_map).
+
+        @return False if the System needs to be rebuilt instead.
+        """
+        pvals = self.FF.get_pvals()
+        if self.fast_pvals is None or len(pvals) != len(self.fast_pvals):
+            return False
+        changed = np.nonzero(pvals != self.fast_pvals)[0]
+        if any([p not in self.param_map for p in changed]):
+            return False
+        system = self.simulation.system
+        forces = set()
+        for p in changed:
+            for (f, k, i), (idx, v0, slope) in self.param_map[p].items():
+                frc = system.getForce(f)
+                params = GetTermParameters(frc, k, i)
+                leaves = np.array(ParameterLeaves(params))
+                leaves[idx] = v0 + slope * (pvals[p] - self.param_map_pvals[p])
+                SetTermParameters(frc, k, i, ReplaceLeaves(params, iter(leaves)))
+                forces.add(f)
+        for f in sorted(forces):
+            frc = system.getForce(f)
+            frc.updateParametersInContext(self.simulation.context)
+            if isinstance(frc, NonbondedForce):
+                self.nbcharges = np.array([frc.getParticleParameters(j)[0]._value for j in range(frc.getNumParticles())])
+        self.system = system
+        self.fast_pvals = pvals
+        return True
+
+    def worker_init(self):
+        """ Drop the Simulation inherited from the parent process; the worker creates its own Context. """
+        if hasattr(self, 'simulation'):
+            # Hold on to the parent's Simulation so its Context is never destroyed inside the worker.
+            self.parent_simulation = self.simulation
+            delattr(self, 'simulation')
+        self.parent_contexts = getattr(self, 'contexts', None)
+        self.contexts = None
+
     def set_restraint_positions(self, shot):
         """
         Set reference positions for energy restraints.  This may be a different set of positions
@@ -1118,9 +1388,51 @@ class OpenMM(Engine):
             self.simulation.context.setPeriodicBoxVectors(*self.xyz_omms[shot][1])
         # self.simulation.context.setPositions(ResetVirtualSites(self.xyz_omms[shot][0], self.system))
         # self.simulation.context.setPositions(ResetVirtualSites_fast(self.xyz_omms[shot][0], self.vsinfo))
-        self.simulation.context.setPositions(self.xyz_omms[shot][0])
+        # Positions are taken from the NumPy array, which is much faster than a list of Vec3.
+        self.simulation.context.setPositions(self.get_xyz_array()[shot])
         self.simulation.context.computeVirtualSites()
 
+    def get_xyz_array(self):
+        """
+        Return the stored coordinates (self.xyz_omms) as one NumPy array
+        with shape (number of snapshots, number of particles, 3) in nanometers.
+
+        The array is cached; code that replaces snapshots in self.xyz_omms
+        in place (rather than assigning a new list) must set self.xyz_array to None.
+        """
+        if getattr(self, 'xyz_array', None) is None or self.xyz_array_src is not self.xyz_omms \
+                or len(self.xyz_array) != len(self.xyz_omms):
+            natoms = len(self.xyz_omms[0][0]) if len(self.xyz_omms) > 0 else 0
+            self.xyz_array = np.empty((len(self.xyz_omms), natoms, 3))
+            for I, (pos, box) in enumerate(self.xyz_omms):
+                self.xyz_array[I] = pos.value_in_unit(nanometer)
+            self.xyz_array_src = self.xyz_omms
+        return self.xyz_array
+
+    def get_contexts(self):
+        """
+        Return the list of Contexts used for evaluating the snapshots.
+        The first one belongs to self.simulation; the others (if the
+        openmm_batch_contexts option is larger than one) are made from
+        the same System and brought up to date with its parameters.
+        """
+        if self.batch_contexts <= 1:
+            return [self.simulation.context]
+        if getattr(self, 'contexts', None) is None or self.contexts_system is not self.simulation.system:
+            # These Contexts are only used for single points, so the integrator doesn't matter.
+            self.contexts = [Context(self.simulation.system, VerletIntegrator(1.0*femtoseconds), self.platform)
+                             for i in range(self.batch_contexts-1)]
+            self.contexts_system = self.simulation.system
+        else:
+            for context in self.contexts:
+                for i in range(self.simulation.system.getNumForces()):
+                    force = self.simulation.system.getForce(i)
+                    if hasattr(force, 'updateParametersInContext'):
+                        force.updateParametersInContext(context)
+                for name, value in self.simulation.context.getParameters().items():
+                    context.setParameter(name, value)
+        return [self.simulation.context] + self.contexts
+
     def get_charges(self):
         logger.error('OpenMM engine does not have get_charges (should be trivial to implement however.)')
         raise NotImplementedError
@@ -1172,32 +1484,68 @@ class OpenMM(Engine):
         self.update_simulation()
 
         # If trajectory flag set to False, perform a single-point calculation.
-        if not traj: return evaluate_one_(force, dipole)
-        Energies = []
-        Forces = []
-        Dipoles = []
-        for I in range(len(self.xyz_omms)):
-            self.set_positions(I)
-            R1 = self.evaluate_one_(force, dipole)
-            Energies.append(R1["Energy"])
-            if force: Forces.append(R1["Force"])
-            if dipole: Dipoles.append(R1["Dipole"])
-        # Compile it all into the dictionary object
-        Result = OrderedDict()
+        if not traj: return self.evaluate_one_(force, dipole)
+        return self.evaluate_frames(force, dipole)
+
+    def evaluate_frames(self, force=False, dipole=False):
+
+        """
+        Compute the energies, and (optionally) forces and dipoles of
+        all of the stored snapshots into preallocated arrays.  The
+        snapshots are divided into contiguous chunks, one for each
+        Context from get_contexts(), which are evaluated in separate threads.
 
-        Result["Energy"] = np.array(Energies)
-        if force: Result["Force"] = np.array(Forces)
-        if dipole: Result["Dipole"] = np.array(Dipoles)
+        Outputs:
+        Result: Dictionary containing energies, forces and/or dipoles.
+        """
+
+        xyz = self.get_xyz_array()
+        nframes = xyz.shape[0]
+        Result = OrderedDict()
+        Result["Energy"] = np.zeros(nframes)
+        if force: Result["Force"] = np.zeros((nframes, 3*len(self.realAtomIdxs)))
+        if dipole: Result["Dipole"] = np.zeros((nframes, 3))
+        contexts = self.get_contexts()
+        chunks = np.array_split(np.arange(nframes), len(contexts))
+        # get_dipole needs the System and the Context that the snapshot was evaluated in.
+        simulations = [self.simulation] + [SimpleNamespace(system=self.simulation.system, context=c) for c in contexts[1:]]
+        def evaluate_chunk(k):
+            context = contexts[k]
+            for I in chunks[k]:
+                # NOTE: Periodic box vectors must be set FIRST
+                if self.pbc:
+                    context.setPeriodicBoxVectors(*self.xyz_omms[I][1])
+                context.setPositions(xyz[I])
+                context.computeVirtualSites()
+                state = context.getState(getEnergy=True, getForces=force, getPositions=dipole)
+                Result["Energy"][I] = state.getPotentialEnergy().value_in_unit(kilojoules_per_mole)
+                if force:
+                    Result["Force"][I] = state.getForces(asNumpy=True).value_in_unit(kilojoule/(nanometer*mole))[self.realAtomIdxs].flatten()
+                if dipole:
+                    Result["Dipole"][I] = get_dipole(simulations[k], q=self.nbcharges, mass=self.AtomLists['Mass'], positions=state.getPositions())
+        if len(contexts) == 1:
+            evaluate_chunk(0)
+        else:
+            def evaluate_chunk_(k):
+                # Exceptions are returned to the main thread and raised there.
+                try:
+                    evaluate_chunk(k)
+                except Exception as e:
+                    return e
+            for e in concurrent_map(evaluate_chunk_, list(range(len(contexts)))):
+                if e is not None: raise e
         return Result
 
     def energy_one(self, shot):
+        self.update_simulation()
         self.set_positions(shot)
-        return self.evaluate_()["Energy"]
+        return self.evaluate_one_()["Energy"]
 
     def energy_force_one(self, shot):
+        self.update_simulation()
         self.set_positions(shot)
-        Result = self.evaluate_(force=True)
-        return np.hstack((Result["Energy"].reshape(-1,1), Result["Force"]))
+        Result = self.evaluate_one_(force=True)
+        return np.hstack((np.array(Result["Energy"]).reshape(-1,1), Result["Force"].reshape(1,-1)))
 
     def energy(self):
         return self.evaluate_(traj=True)["Energy"]
@@ -1356,7 +1704,7 @@ class OpenMM(Engine):
             mod.addExtraParticles(self.forcefield)
             self.simulation.context.setPositions(ResetVirtualSites_fast(mod.getPositions(), self.vsinfo))
 
-    def optimize(self, shot, crit=1e-4, disable_vsite=False, align=True, include_restraint_energy=False):
+    def optimize(self, shot, crit=1e-4, disable_vsite=False, align=True, include_restraint_energy=False, start=None):
 
         """
         Optimize the geometry and align the optimized
@@ -1372,6 +1720,11 @@ class OpenMM(Engine):
             Disable virtual sites (needed for SMIRNOFF)
         include_restraint_energy : bool
             Include energy component from CustomExternalForce
+        start : np.ndarray, optional
+            Coordinates of the real atoms in Angstrom to start the
+            minimization from, such as the minimized geometry of the same
+            snapshot at nearby parameters.  The RMSD and alignment are
+            still with respect to the snapshot.
 
         Returns
         -------
@@ -1395,9 +1748,14 @@ class OpenMM(Engine):
         # Get the previous geometry.
         X0 = self.simulation.context.getState(getPositions=True).getPositions(asNumpy=True).value_in_unit(angstrom)[self.realAtomIdxs]
         # printcool_dictionary(energy_components(self.simulation), title='Energy component analysis before minimization, shot %i' % shot)
-        # Minimize the energy.  Optimizer works best in "steps".
-        for logc in np.linspace(0, np.log10(crit), steps):
-            self.simulation.minimizeEnergy(tolerance=10**logc, maxIterations=100000)
+        if start is not None:
+            # Starting close to the minimum, so go straight to the final criterion.
+            self._update_positions(np.array(start), disable_vsite)
+            self.simulation.minimizeEnergy(tolerance=crit, maxIterations=100000)
+        else:
+            # Minimize the energy.  Optimizer works best in "steps".
+            for logc in np.linspace(0, np.log10(crit), steps):
+                self.simulation.minimizeEnergy(tolerance=10**logc, maxIterations=100000)
         # check if energy minimization is successful
         # try 1000 times with 10 steps each as openmm minimizer is not very stable at the tolerance
         for _ in range(1000):
@@ -1431,6 +1789,24 @@ class OpenMM(Engine):
 
         return E, M.ref_rmsd(0)[1], M[1]
 
+    def energy_at(self, X, disable_vsite=False, include_restraint_energy=False):
+
+        """
+        Return the potential energy in kcal/mol of the real atom
+        coordinates X in Angstrom, without minimizing.  Used with the
+        geometries returned by optimize() to evaluate the energy at a
+        fixed geometry for other parameters.
+        """
+
+        self.update_simulation()
+        self._update_positions(np.array(X), disable_vsite)
+        groups = set(range(32))
+        if self.restraint_frc_index is not None and not include_restraint_energy:
+            frc = self.simulation.system.getForce(self.restraint_frc_index)
+            groups.remove(frc.getForceGroup())
+        S = self.simulation.context.getState(getEnergy=True, groups=groups)
+        return S.getPotentialEnergy().value_in_unit(kilocalorie_per_mole)
+
     def getContextPosition(self, removeVirtual=False):
         """
         Get current position from simulation context.
@@ -1730,6 +2106,7 @@ class OpenMM(Engine):
             new_pos = (residue_positions + center_pos_shift[:,np.newaxis,:]).reshape(-1,3)
             # update this frame
             self.xyz_omms[i] = [new_pos.astype(np.float32)*nanometer, new_box*nanometer]
+        self.xyz_array = None
 
     def adjust_drude_positions(self):
         """First zero the mass of the system. This is needed because the Drude positions
@@ -1755,6 +2132,7 @@ class OpenMM(Engine):
             pos = self.simulation.context.getState(getPositions=True).getPositions()._value
             pos = [Vec3(i[0],i[1],i[2]) for i in pos]*nanometer
             self.xyz_omms[I] = (pos, box_omm)
+        self.xyz_array = None
         for k in range(self.system.getNumParticles()):
             self.system.setParticleMass(k,mass[k])
         delattr(self, 'simulation')
@@ -1811,6 +2189,8 @@ class AbInitio_OpenMM(AbInitio):
         self.set_option(tgt_opts,'coords',default="all.gro")
         self.set_option(tgt_opts,'openmm_precision','precision',default="double", forceprint=True)
         self.set_option(tgt_opts,'openmm_platform','platname',default="CUDA", forceprint=True)
+        self.set_option(tgt_opts,'openmm_fast_update','fast_update')
+        self.set_option(tgt_opts,'openmm_batch_contexts','batch_contexts')
         self.engine_ = OpenMM
         ## Initialize base class.
         super(AbInitio_OpenMM,self).__init__(options,tgt_opts,forcefield)
@@ -1822,6 +2202,8 @@ class BindingEnergy_OpenMM(BindingEnergy):
         self.engine_ = OpenMM
         self.set_option(tgt_opts,'openmm_precision','precision',default="double", forceprint=True)
         self.set_option(tgt_opts,'openmm_platform','platname',default="Reference", forceprint=True)
+        self.set_option(tgt_opts,'openmm_fast_update','fast_update')
+        self.set_option(tgt_opts,'openmm_batch_contexts','batch_contexts')
         ## Initialize base class.
         super(BindingEnergy_OpenMM,self).__init__(options,tgt_opts,forcefield)
 
@@ -1832,6 +2214,8 @@ class Interaction_OpenMM(Interaction):
         self.set_option(tgt_opts,'coords',default="all.pdb")
         self.set_option(tgt_opts,'openmm_precision','precision',default="double", forceprint=True)
         self.set_option(tgt_opts,'openmm_platform','platname',default="Reference", forceprint=True)
+        self.set_option(tgt_opts,'openmm_fast_update','fast_update')
+        self.set_option(tgt_opts,'openmm_batch_contexts','batch_contexts')
         self.engine_ = OpenMM
         ## Initialize base class.
         super(Interaction_OpenMM,self).__init__(options,tgt_opts,forcefield)
@@ -1843,6 +2227,8 @@ class Moments_OpenMM(Moments):
         self.set_option(tgt_opts,'coords',default="input.pdb")
         self.set_option(tgt_opts,'openmm_precision','precision',default="double", forceprint=True)
         self.set_option(tgt_opts,'openmm_platform','platname',default="Reference", forceprint=True)
+        self.set_option(tgt_opts,'openmm_fast_update','fast_update')
+        self.set_option(tgt_opts,'openmm_batch_contexts','batch_contexts')
         self.engine_ = OpenMM
         ## Initialize base class.
         super(Moments_OpenMM,self).__init__(options,tgt_opts,forcefield)
@@ -1878,6 +2264,8 @@ class Vibration_OpenMM(Vibration):
         self.set_option(tgt_opts,'coords',default="input.pdb")
         self.set_option(tgt_opts,'openmm_precision','precision',default="double", forceprint=True)
         self.set_option(tgt_opts,'openmm_platform','platname',default="Reference", forceprint=True)
+        self.set_option(tgt_opts,'openmm_fast_update','fast_update')
+        self.set_option(tgt_opts,'openmm_batch_contexts','batch_contexts')
         self.engine_ = OpenMM
         ## Initialize base class.
         super(Vibration_OpenMM,self).__init__(options,tgt_opts,forcefield)
@@ -1888,6 +2276,8 @@ class OptGeoTarget_OpenMM(OptGeoTarget):
         self.engine_ = OpenMM
         self.set_option(tgt_opts,'openmm_precision','precision',default="double", forceprint=True)
         self.set_option(tgt_opts,'openmm_platform','platname',default="Reference", forceprint=True)
+        self.set_option(tgt_opts,'openmm_fast_update','fast_update')
+        self.set_option(tgt_opts,'openmm_batch_contexts','batch_contexts')
         ## Initialize base class.
         super(OptGeoTarget_OpenMM,self).__init__(options,tgt_opts,forcefield)
 
@@ -1914,6 +2304,8 @@ class TorsionProfileTarget_OpenMM(TorsionProfileTarget):
         self.set_option(tgt_opts,'coords',default="scan.xyz")
         self.set_option(tgt_opts,'openmm_precision','precision',default="double", forceprint=True)
         self.set_option(tgt_opts,'openmm_platform','platname',default="Reference", forceprint=True)
+        self.set_option(tgt_opts,'openmm_fast_update','fast_update')
+        self.set_option(tgt_opts,'openmm_batch_contexts','batch_contexts')
         self.engine_ = OpenMM
         ## Initialize base class.
         super(TorsionProfileTarget_OpenMM,self).__init__(options,tgt_opts,forcefield)
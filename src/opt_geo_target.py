@@ -77,10 +77,21 @@ class OptGeoTarget(Target):
         engine_args.pop('name', None)
         ## Create engine objects
         self.create_engines(engine_args)
+        ## Skip the systems that a parameter cannot affect when differentiating (see Engine.dependent_parameters).
+        if self.parameter_dependence and not hasattr(self, 'system_mval_masks'):
+            deps = OrderedDict([(sysname, engine.dependent_parameters()) for sysname, engine in self.engines.items()])
+            if all([d is not None for d in deps.values()]):
+                self.system_mval_masks = OrderedDict([(sysname, np.array([p in d for p in range(self.FF.np)])) for sysname, d in deps.items()])
         ## Create internal coordinates
         self._build_internal_coordinates()
         ## Option for how much data to write to disk.
         self.set_option(tgt_opts,'writelevel','writelevel')
+        ## Start the optimizations at displaced parameters from the MM-optimized geometries.
+        self.set_option(tgt_opts,'fd_warm_start','fd_warm_start')
+        ## MM-optimized coordinates of each system at the current parameters.
+        self.mm_opt_xyzs = OrderedDict()
+        ## Starting coordinates of each system that mm_opt_xyzs were optimized from.
+        self.mm_opt_refs = OrderedDict()
 
     def create_engines(self, engine_args):
         raise NotImplementedError("create_engines() should be implemented in subclass")
@@ -204,9 +215,16 @@ class OptGeoTarget(Target):
         engine = self.engines[sysname]
         ic_dict = self.internal_coordinates[sysname]
         if engine.__class__.__name__ in ('OpenMM', 'SMIRNOFF'):
-            # OpenMM.optimize() by default resets geometry to initial geometry before optimization
-            engine.optimize(0)
+            # OpenMM.optimize() by default resets geometry to initial geometry before optimization;
+            # at displaced parameters, start from the optimized geometry at the current parameters instead.
+            start = None
+            if self.fd_warm_start and in_fd() and sysname in self.mm_opt_refs and np.array_equal(self.mm_opt_refs[sysname], engine.mol.xyzs[0]):
+                start = self.mm_opt_xyzs[sysname]
+            engine.optimize(0, start=start)
             pos = engine.getContextPosition()
+            if not in_fd():
+                self.mm_opt_xyzs[sysname] = engine.getContextPosition(removeVirtual=True)
+                self.mm_opt_refs[sysname] = engine.mol.xyzs[0].copy()
             if save_mol is not None:
                 MM_minimized_mol = deepcopy(engine.mol[0])
                 MM_minimized_mol.xyzs[0] = pos
@@ -229,7 +247,6 @@ class OptGeoTarget(Target):
         printcool_dictionary(self.PrintDict,title=title_str + '\n' + column_head_str1 + '\n' + column_head_str2, center=[True,False,False])
 
     def get(self, mvals, AGrad=False, AHess=False):
-        Answer = {'X':0.0, 'G':np.zeros(self.FF.np), 'H':np.zeros((self.FF.np, self.FF.np))}
         self.PrintDict = OrderedDict()
         # enable self.system_mval_masks (supported by OptGeoTarget_SMIRNOFF)
         enable_system_mval_mask = hasattr(self, 'system_mval_masks')
@@ -293,7 +310,6 @@ class OptGeoTarget(Target):
             return np.array(v_obj_list, dtype=float)
 
         V = compute(mvals)
-        Answer['X'] = np.dot(V,V)
         # write objective decomposition if wanted
         if self.writelevel > 0:
             # recover mvals
@@ -322,10 +338,7 @@ class OptGeoTarget(Target):
             for p in self.pgrad:
                 dV[p,:], _ = f12d3p(fdwrap(compute, mvals, p, p_idx = p), h = self.h, f0 = V)
 
-        for p in self.pgrad:
-            Answer['G'][p] = 2*np.dot(V, dV[p,:])
-            for q in self.pgrad:
-                Answer['H'][p,q] = 2*np.dot(dV[p,:], dV[q,:])
+        Answer = self.gauss_newton(V, dV)
         if not in_fd():
             self.objective = Answer['X']
             self.FF.make(mvals)
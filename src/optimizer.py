@@ -22,7 +22,7 @@ from copy import deepcopy
 import forcebalance
 from forcebalance.parser import parse_inputs
 from forcebalance.nifty import col, flat, row, printcool, printcool_dictionary, pvec1d, pmat2d, warn_press_key, invert_svd, wopen, bak, est124, lp_load
-from forcebalance.finite_difference import f1d7p, f1d5p, fdwrap
+from forcebalance.finite_difference import f1d7p, f1d5p, fdwrap, fd_context
 from collections import OrderedDict
 import random
 import time, datetime
@@ -884,7 +884,8 @@ class Optimizer(forcebalance.BaseClass):
             dx, sol = solver(L) # dx is how much the step changes from the previous step.
             # This is our trial step.
             xk_ = dx + xk
-            Result = self.Objective.Full(xk_,0,verbose=False,customdir="micro_%02i" % search_fun.micro)['X'] - data['X']
+            with fd_context(srch=True):
+                Result = self.Objective.Full(xk_,0,verbose=False,customdir="micro_%02i" % search_fun.micro)['X'] - data['X']
 
             if not self.retain_micro_outputs:
                 for Tgt in self.Objective.Targets:
@@ -998,8 +999,7 @@ class Optimizer(forcebalance.BaseClass):
                             logger.info('\n')
                             bar = printcool("Current Mathematical Parameters:",color=5)
                             self.FF.print_map(vals=["% .4e" % i for i in mvals])
-                        for Tgt in self.Objective.Targets:
-                            Tgt.meta_indicate()
+                        self.Objective.Target_Indicate()
                         self.Objective.Indicate()
                         print_heading()
                         print_results(color)
@@ -85,6 +85,8 @@ gen_opts_types = {
     'ints'    : {"maxstep"      : (100, 50, 'Maximum number of steps in an optimization', 'Main Optimizer'),
                  "objective_history"  : (2, 20, 'Number of good optimization steps to average over when checking the objective convergence criterion', 'Main Optimizer (jobtype "newton")'),
                  "wq_port"   : (0, 0, 'The port number to use for Work Queue', 'Targets that use Work Queue (advanced usage)'),
+                 "wq_local"  : (0, 0, 'Number of local processes that run the Work Queue tasks in place of a Work Queue master and workers (when wq_port is not set)', 'Targets that use Work Queue (advanced usage)'),
+                 "target_processes" : (1, 0, 'Number of local processes for evaluating the targets in parallel; each process keeps its own copy of the targets that it evaluates', 'Objective function (all calculations)'),
                  "criteria"   : (1, 160, 'The number of convergence criteria that must be met for main optimizer to converge', 'Main Optimizer'),
                  "rpmd_beads"       : (0, -160, 'Number of beads in ring polymer MD (zero to disable)', 'Condensed phase property targets (advanced usage)', 'liquid_openmm'),
                  "zerograd"         : (-1, 0, 'Set to a nonnegative number to turn on zero gradient skipping at that optimization step.', 'All'),
@@ -109,6 +111,7 @@ gen_opts_types = {
                  "reevaluate"       : (None, 0, 'Re-evaluate the objective function and gradients when the step is rejected (for noisy objective functions).', 'Main Optimizer'),
                  "continue"         : (0, 140, 'Continue the current run from where we left off (supports mid-iteration recovery).', 'Main Optimizer'),
                  "duplicate_pnames" : (0, -150, 'Allow duplicate parameter names (only if you know what you are doing!', 'Force Field Parser'),
+                 "incremental_make" : (0, -150, 'Keep the force field in memory and only update the parameters that changed; files are printed only when needed (OpenMM and SMIRNOFF engines read the force field from memory)', 'Creating the force field; advanced usage'),
                  },
     'floats'  : {"trust0"                 : (1e-1, 100, 'Levenberg-Marquardt trust radius; set to negative for nonlinear search', 'Main Optimizer'),
                  "mintrust"               : (0.0,   10, 'Minimum trust radius (if the trust radius is tiny, then noisy optimizations become really gnarly)', 'Main Optimizer'),
@@ -194,19 +197,32 @@ tgt_opts_types = {
                  "nvt_md_steps"       : (100000, 0, 'Number of time steps for the liquid NVT production run.', 'Condensed phase property targets', 'liquid'),
                  "nvt_eq_steps"       : (10000, 0, 'Number of time steps for the liquid NVT equilibration run.', 'Condensed phase property targets', 'liquid'),
                  "writelevel"         : (0, 0, 'Affects the amount of data being printed to the temp directory.', 'Energy + Force Matching', 'AbInitio'),
+                 "gmx_threads"        : (1, 0, 'Set the number of threads used by mdrun for single point, rerun and minimization calculations', 'Targets that use GROMACS', 'AbInitio_GMX, BindingEnergy_GMX, Interaction_GMX, Moments_GMX, Vibration_GMX'),
                  "md_threads"         : (1, 0, 'Set the number of threads used by Gromacs or TINKER processes in MD simulations', 'Condensed phase properties in GROMACS and TINKER', 'Liquid_GMX, Lipid_GMX, Liquid_TINKER'),
                  "save_traj"          : (0, -10, 'Whether to save trajectories.  0 = Never save; 1 = Delete if optimization step is good; 2 = Always save', 'Condensed phase properties', 'Liquid, Lipid'),
                  "eq_steps"           : (20000, 0, 'Number of time steps for the equilibration run.', 'Thermodynamic property targets', 'thermo'),
                  "md_steps"           : (50000, 0, 'Number of time steps for the production run.', 'Thermodynamic property targets', 'thermo'),
                  "n_sim_chain"        : (1, 0, 'Number of simulations required to calculate quantities.', 'Thermodynamic property targets', 'thermo'),
                  "n_molecules"        : (-1, 0, 'Provide the number of molecules in the structure (defaults to auto-detect).', 'Condensed phase properties', 'Liquid'),
+                 "liquid_max_md_steps": (0, -150, 'Largest number of liquid production steps that liquid_error_target may choose for one phase point (0 = eight times liquid_md_steps)', 'Condensed phase property targets (advanced usage)', 'Liquid'),
+                 "liquid_reweight"    : (0, -150, 'Keep the snapshots of this many previous sets of liquid simulations and, when they have enough effective samples, estimate the properties at new parameters by reweighting them with MBAR instead of running new simulations.', 'Condensed phase property targets (advanced usage)', 'Liquid'),
                  "hess_normalize_type": (0, -150, 'Specify an hessian target objective function normalization method.', 'Hessian targets', 'Hessian'),
+                 "fd_processes"       : (1, -50, 'Number of local processes for evaluating finite-difference parameter displacements in parallel (requires all_at_once for AbInitio); the condensed phase scripts use it for the energy derivatives after the MD, except on a GPU platform', 'Targets with finite-difference gradients'),
+                 "snapshot_chunk"     : (0, -50, 'Number of snapshots in each block when adding up the energy and force objective function and its derivatives (0 = automatic)', 'Energy + Force Matching', 'AbInitio'),
+                 "max_dm_memory"      : (4096, -50, 'Largest size (in MB) of the array of finite-difference derivatives to keep in memory; a larger one is stored in a memory-mapped file in the temp directory', 'Energy + Force Matching', 'AbInitio'),
+                 "openmm_batch_contexts" : (1, -50, 'Number of OpenMM Contexts over which the snapshots are divided (one thread each) when evaluating energies and forces', 'Targets that use OpenMM', 'OpenMM'),
                  },
     'bools'   : {"fdgrad"           : (0, -100, 'Finite difference gradient of objective function w/r.t. specified parameters', 'Use together with fd_ptypes (advanced usage)'),
                  "fdhess"           : (0, -100, 'Finite difference Hessian of objective function w/r.t. specified parameters', 'Use together with fd_ptypes (advanced usage)'),
                  "fdhessdiag"       : (0, -100, 'Finite difference Hessian diagonals w/r.t. specified parameters (costs 2np times a objective calculation)', 'Use together with fd_ptypes (advanced usage)'),
                  "all_at_once"      : (1, -50, 'Compute all energies and forces in one fell swoop where possible(as opposed to calling the simulation code once per snapshot)', 'Various QM targets and MD codes', 'AbInitio'),
+                 "fd_warm_start"    : (0, -100, 'Start the geometry optimizations at displaced parameters from the MM-optimized geometries at the current parameters; faster, but the finite-difference gradients differ slightly from those of optimizations from the reference geometries', 'Torsion profile and optimized geometry targets', 'torsionprofile, OptGeoTarget'),
+                 "fd_frozen_geometry" : (0, -150, 'Differentiate the MM energies at the MM-optimized geometries of the current parameters without optimizing them again; approximate when there are restraints', 'Torsion profile target', 'torsionprofile'),
+                 "parameter_dependence" : (0, -100, 'Skip the derivatives of parameters that cannot affect any system in the target, using a dependency index built from the force field and the topology of each engine; the skipped parameters are printed, check them if the force field uses mixing rules or virtual sites', 'All targets (advanced usage)'),
+                 "invdist_float32"  : (0, -150, 'Store the inverse distance matrix for ESP fitting in single precision to halve its memory', 'Ab initio targets with RESP'),
+                 "qdata_cache"      : (0, -50, 'Save the numbers in qdata.txt to a binary cache (qdata.txt.cache) next to it, which is memory-mapped instead of parsing the text file again; off by default because it writes to the target directory', 'Energy + Force Matching', 'AbInitio'),
                  "run_internal"     : (1, -50, 'For OpenMM or other codes with Python interface: Compute energies and forces internally', 'OpenMM interface', 'OpenMM'),
+                 "openmm_fast_update" : (0, -50, 'Set changed parameters directly in the OpenMM Context instead of rebuilding the System, where possible (requires incremental_make)', 'Targets that use OpenMM', 'OpenMM'),
                  "energy"           : (1, 0, 'Enable the energy objective function', 'All ab initio targets', 'AbInitio'),
                  "force"            : (1, 0, 'Enable the force objective function', 'All ab initio targets', 'AbInitio'),
                  "resp"             : (0, -150, 'Enable the RESP objective function', 'Ab initio targets with RESP; experimental (remember to set espweight)'),
@@ -221,6 +237,7 @@ tgt_opts_types = {
                  "hvap_subaverage"  : (0, -150, 'Don\'t target the average enthalpy of vaporization and allow it to freely float (experimental)', 'Condensed phase property targets (advanced usage)', 'liquid'),
                  "force_cuda"       : (0, -150, 'Force the external npt.py script to crash if CUDA Platform not available', 'Condensed phase property targets (advanced usage)', 'liquid_openmm'),
                  "anisotropic_box"  : (0, -150, 'Enable anisotropic box scaling (e.g. for crystals or two-phase simulations) in external npt.py script', 'Condensed phase property targets (advanced usage)', 'liquid_openmm, liquid_tinker'),
+                 "block_bootstrap"  : (0, -150, 'Estimate condensed phase property uncertainties by resampling blocks of consecutive frames as long as the statistical inefficiency, instead of single frames', 'Condensed phase property targets (advanced usage)', 'liquid, lipid'),
                  "mts_integrator"   : (0, -150, 'Enable multiple-timestep integrator in external npt.py script', 'Condensed phase property targets (advanced usage)', 'liquid_openmm'),
                  "minimize_energy"  : (1, 0, 'Minimize the energy of the system prior to running dynamics', 'Condensed phase property targets (advanced usage)', 'liquid_openmm', 'liquid_tinker'),
                  "remote"           : (0, 50, 'Evaluate target as a remote work_queue task', 'All targets (optional)'),
@@ -272,6 +289,9 @@ tgt_opts_types = {
                  "energy_asymmetry": (1.0, -150, 'Snapshots with (E_MM - E_QM) < 0.0 will have their weights increased by this factor. Only valid if energy_mode is set to "qm_minimum".', 'Ab initio targets'),
                  "nonbonded_cutoff"  : (None, -1, 'Cutoff for nonbonded interactions (passed to engines).', 'Condensed phase property targets', 'liquid'),
                  "vdw_cutoff"        : (None, -2, 'Cutoff for vdW interactions if different from other nonbonded interactions', 'Condensed phase property targets', 'liquid'),
+                 "liquid_error_target" : (0.0, -150, 'Choose the length of the next liquid simulation at each phase point from the statistical errors of the last one, so that the error of every fitted property is about this fraction of its denominator (0 = use liquid_md_steps everywhere); cannot be combined with adapt_errors', 'Condensed phase property targets (advanced usage)', 'liquid'),
+                 "reweight_max_step" : (0.1, -150, 'Largest change of the mathematical parameters (Euclidean norm) from a stored liquid simulation for it to be used by liquid_reweight; beyond this the first-order estimate of the snapshot energies is not trusted', 'Condensed phase property targets (advanced usage)', 'liquid'),
+                 "reweight_neff"  : (0.5, -150, 'Minimum number of effective samples at every phase point, as a fraction of the snapshots in one simulation, for liquid_reweight to be used instead of new simulations', 'Condensed phase property targets (advanced usage)', 'liquid'),
                  "liquid_fdiff_h" : (1e-2, 0, 'Step size for finite difference derivatives for liquid targets in pure_num_grad', 'Condensed phase property targets', 'liquid'),
                  "restrain_k"     : (1.0, 0, 'Force constant for harmonic positional energy restraints', 'Torsion profile with MM relaxation target', 'torsionprofile'),
                  },
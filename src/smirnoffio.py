@@ -373,6 +373,8 @@ class SMIRNOFF(OpenMM):
         if hasattr(self, 'FF'):
             self.offxml = [self.FF.offxml]
             self.forcefield = self.FF.openff_forcefield
+            ## The OpenFF ForceField object is updated by FF.make(), so the files are not needed with incremental_make.
+            self.ff_in_memory = self.FF.incremental_make
         else:
             self.offxml = listfiles(kwargs.get('offxml'), 'offxml', err=True)
             self.forcefield = OpenFF_ForceField(*self.offxml, load_plugins=True)
@@ -590,6 +592,10 @@ class SMIRNOFF(OpenMM):
 
         return smirks_counter
 
+    def dependence_key(self):
+        """ SMIRNOFF targets skip parameters by their SMIRKS (see smirnoff_update_pgrads) instead. """
+        return None
+
 class Liquid_SMIRNOFF(Liquid):
     """ Condensed phase property matching using OpenMM. """
     def __init__(self,options,tgt_opts,forcefield):
@@ -5,6 +5,7 @@ from builtins import str
 from builtins import range
 import abc
 import os
+import multiprocessing
 import subprocess
 import shutil
 import numpy as np
@@ -13,7 +14,8 @@ from collections import OrderedDict
 import tarfile
 import forcebalance
 from forcebalance.nifty import row, col, printcool_dictionary, link_dir_contents, createWorkQueue, getWorkQueue, wq_wait1, getWQIds, wopen, warn_press_key, _exec, lp_load, LinkFile
-from forcebalance.finite_difference import fdwrap_G, fdwrap_H, f1d2p, f12d3p, in_fd
+from forcebalance.finite_difference import fdwrap, fdwrap_G, fdwrap_H, f1d2p, f12d3p, in_fd, fd_context
+from forcebalance.engine import batch_map
 from forcebalance.optimizer import Counter
 from forcebalance.output import getLogger
 from future.utils import with_metaclass
@@ -127,6 +129,13 @@ class Target(with_metaclass(abc.ABCMeta, forcebalance.BaseClass)):
         self.set_option(options, 'zerograd')
         ## Gradient norm below which we skip.
         self.set_option(tgt_opts, 'epsgrad')
+        ## Whether to skip the parameters that cannot affect any system in this target.
+        self.set_option(tgt_opts, 'parameter_dependence')
+        ## Number of local processes for the finite-difference parameter displacements.
+        self.set_option(tgt_opts, 'fd_processes')
+        if self.fd_processes > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+            warn_press_key("fd_processes requires forked processes, which are not available on this platform")
+            self.fd_processes = 1
         ## Dictionary of whether to call the derivatives.
         self.pgrad = list(range(forcefield.np))
         self.OptionDict['pgrad'] = self.pgrad
@@ -243,6 +252,45 @@ class Target(with_metaclass(abc.ABCMeta, forcebalance.BaseClass)):
         # Set pgrad in the OptionDict so remote targets may use it.
         self.OptionDict['pgrad'] = self.pgrad
 
+    def get_engines(self):
+        """ Return a list of the engine objects of this target. """
+        engines = list(getattr(self, 'engines', OrderedDict()).values())
+        if hasattr(self, 'engine'):
+            engines.append(self.engine)
+        return engines
+
+    def dependent_parameters(self):
+        """ Return the set of parameters that can affect any of the
+        systems in this target, from the dependency index of each engine
+        (see Engine.dependent_parameters), or None if this is not known
+        for all of them. """
+        engines = self.get_engines()
+        if len(engines) == 0: return None
+        answer = set()
+        for engine in engines:
+            deps = engine.dependent_parameters()
+            if deps is None: return None
+            answer.update(deps.keys())
+        return answer
+
+    def apply_parameter_dependence(self):
+        """ Remove the parameters that cannot affect any of the systems
+        in this target from pgrad, so their derivatives are not computed.
+        Unlike zerograd.txt, this does not depend on the gradient being
+        small in an earlier iteration. """
+        if not self.parameter_dependence: return
+        if not hasattr(self, 'dependent_pgrad'):
+            self.dependent_pgrad = self.dependent_parameters()
+            if self.dependent_pgrad is not None and len(self.dependent_pgrad) < self.FF.np:
+                logger.info("%i out of %i parameters cannot affect %s and will not be differentiated:\n" % (self.FF.np - len(self.dependent_pgrad), self.FF.np, self.name))
+                for i in range(self.FF.np):
+                    if i not in self.dependent_pgrad:
+                        logger.info("    %i %s\n" % (i, self.FF.plist[i]))
+        if self.dependent_pgrad is None: return
+        self.pgrad = [i for i in self.pgrad if i in self.dependent_pgrad]
+        # Set pgrad in the OptionDict so remote targets may use it.
+        self.OptionDict['pgrad'] = self.pgrad
+
     def write_0grads(self, Ans):
 
         """ Write a file to the target directory containing names of
@@ -391,6 +439,90 @@ class Target(with_metaclass(abc.ABCMeta, forcebalance.BaseClass)):
         logger.error('The get method is not implemented in the Target base class\n')
         raise NotImplementedError
 
+    def fd_batch(self, func, mvals, **kwargs):
+
+        """
+        Evaluate func at the parameter sets where each parameter in pgrad
+        is displaced by -h and +h, as one batch.  With fd_processes > 1
+        the displaced parameter sets are evaluated concurrently by a pool
+        of local processes, each with its own copy of the force field files
+        and engine state (see engine.batch_map).
+
+        @param[in] func Function of the mathematical parameters to be differentiated
+        @param[in] mvals Mathematical parameter values
+        @param[in] kwargs Passed to fdwrap
+        @return Generator of ((p, dx), func(mvals + dx in parameter p)) in the order of pgrad
+
+        """
+
+        Tasks = [(p, i*self.h) for p in self.pgrad for i in [-1, 1]]
+        def displaced(task):
+            p, dx = task
+            with fd_context():
+                return fdwrap(func, mvals, p, **kwargs)(dx)
+        for task, result in zip(Tasks, batch_map(displaced, Tasks, self.get_engines(), self.fd_processes)):
+            yield task, result
+
+    def fd_derivatives(self, func, mvals, f0, **kwargs):
+
+        """
+        Central finite-difference derivatives of func with respect to
+        the parameters in pgrad (see fd_batch).
+
+        @param[in] func Function of the mathematical parameters returning an array
+        @param[in] mvals Mathematical parameter values
+        @param[in] f0 Value of func at mvals
+        @param[in] kwargs Passed to fdwrap
+        @return dV Array of derivatives with shape (FF.np, len(f0)); zero for parameters not in pgrad
+
+        """
+
+        dV = np.zeros((self.FF.np, len(f0)))
+        Displaced = {}
+        for (p, dx), V in self.fd_batch(func, mvals, **kwargs):
+            Displaced[dx] = V
+            if len(Displaced) == 2:
+                dV[p,:], _ = f12d3p(lambda dx: Displaced[dx], h = self.h, f0 = f0)
+                Displaced = {}
+        return dV
+
+    def gauss_newton(self, V, dV, weights=None, scale=1.0, AGrad=True, AHess=True):
+
+        """
+        Objective function, gradient and Gauss-Newton Hessian of a
+        weighted sum of squared residuals, for targets whose objective
+        function has the form
+
+        X = scale * sum_i w_i V_i^2
+
+        G_p = 2 * scale * sum_i w_i V_i dV_pi
+        H_pq = 2 * scale * sum_i w_i dV_pi dV_qi
+
+        The derivatives are only computed for the parameters in pgrad,
+        all at once with matrix products instead of a loop over pairs
+        of parameters.
+
+        @param[in] V Array of residuals
+        @param[in] dV Array of residual derivatives, with shape (FF.np, len(V))
+        @param[in] weights Array of weights for each residual (None for all ones)
+        @param[in] scale Overall prefactor of the objective function
+        @return Answer Dictionary with the objective function 'X', gradient 'G' and Hessian 'H'
+
+        """
+
+        Answer = {'X':0.0, 'G':np.zeros(self.FF.np), 'H':np.zeros((self.FF.np, self.FF.np))}
+        V = np.asarray(V, dtype=float)
+        wV = V if weights is None else weights*V
+        Answer['X'] = scale*np.dot(wV, V)
+        pgrad = list(self.pgrad)
+        if len(pgrad) == 0 or not (AGrad or AHess): return Answer
+        dVp = np.asarray(dV, dtype=float)[pgrad]
+        Answer['G'][pgrad] = 2*scale*np.dot(dVp, wV)
+        if AHess:
+            wdVp = dVp if weights is None else dVp*weights
+            Answer['H'][np.ix_(pgrad, pgrad)] = 2*scale*np.dot(wdVp, dVp.T)
+        return Answer
+
     def check_files(self, there):
 
         """ Check this directory for the presence of readable files when the 'read' option is set. """
@@ -647,6 +779,7 @@ class Target(with_metaclass(abc.ABCMeta, forcebalance.BaseClass)):
         ## Read in file that specifies which derivatives may be skipped.
         if Counter() >= self.zerograd and self.zerograd >= 0:
             self.read_0grads()
+        self.apply_parameter_dependence()
         self.rundir = absgetdir.replace(self.root+'/','')
         ## Submit jobs to the Work Queue.
         if self.rd is None or (not firstIteration):
@@ -788,8 +921,8 @@ class RemoteTarget(Target):
 
         self.remote_indicate = ""
 
-        if options['wq_port'] == 0:
-            logger.error("Please set the Work Queue port to use Remote Targets.\n")
+        if options['wq_port'] == 0 and options['wq_local'] == 0:
+            logger.error("Please set the Work Queue port (or wq_local) to use Remote Targets.\n")
             raise RuntimeError
 
         # Remote target will read objective.p and indicate.log at the same time,
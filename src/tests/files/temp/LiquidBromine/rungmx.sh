@@ -0,0 +1 @@
+/tmp/fbpath/forcebalance/data/rungmx.sh
\ No newline at end of file
@@ -0,0 +1,77 @@
+from __future__ import absolute_import
+from builtins import range
+from .__init__ import ForceBalanceTestCase
+import numpy as np
+from forcebalance.abinitio import energy_force_sums, esp_inverse_distances, resp_normal_equations
+from forcebalance.nifty import bohr2ang
+
+class TestEnergyForceSums(ForceBalanceTestCase):
+    def test_energy_force_sums(self):
+        """Check the vectorized objective function sums against a loop over snapshots"""
+        rng = np.random.RandomState(0)
+        ns, npr, ncp1 = 7, 4, 10
+        P = rng.rand(ns)
+        X = rng.randn(ns, ncp1)
+        dM = rng.randn(ns, npr, ncp1)
+        boost = np.where(X[:,0] < 0.0, 3.0, 1.0)
+        SPX = np.zeros(ncp1)
+        SPX_p = np.zeros((npr, ncp1))
+        M0_p = np.zeros(npr)
+        SPX_pq = np.zeros((npr, npr, ncp1))
+        for i in range(ns):
+            Xi = X[i]**2
+            Xi[0] *= boost[i]
+            SPX += P[i]*Xi
+            for p in range(npr):
+                M0_p[p] += P[i]*dM[i,p,0]
+                Xi_p = 2*X[i]*dM[i,p]
+                Xi_p[0] *= boost[i]
+                SPX_p[p] += P[i]*Xi_p
+                for q in range(npr):
+                    Xi_pq = 2*dM[i,p]*dM[i,q]
+                    Xi_pq[0] *= boost[i]
+                    SPX_pq[p,q] += P[i]*Xi_pq
+        sums = energy_force_sums(P, boost, X, dM, hess=True)
+        for a, b in zip(sums, [SPX, SPX_p, M0_p, SPX_pq]):
+            np.testing.assert_allclose(a, b, rtol=1e-12)
+        # Sums over blocks of snapshots add up to the sum over all of them.
+        blocks = [energy_force_sums(P[i:i+3], boost[i:i+3], X[i:i+3], dM[i:i+3], hess=True) for i in range(0, ns, 3)]
+        for k in range(4):
+            np.testing.assert_allclose(sum([b[k] for b in blocks]), sums[k], rtol=1e-12)
+        SPX1, SPX_p1, M0_p1, SPX_pq1 = energy_force_sums(P, boost, X)
+        np.testing.assert_allclose(SPX1, SPX, rtol=1e-12)
+        assert SPX_p1 is None and SPX_pq1 is None
+
+class TestESPInverseDistances(ForceBalanceTestCase):
+    def test_esp_inverse_distances(self):
+        """Check the vectorized ESP inverse distance matrix against a loop over grid points and atoms"""
+        rng = np.random.RandomState(0)
+        espxyz = rng.randn(20, 3) * 5
+        xyz = rng.randn(6, 3)
+        DistMat = np.array([[np.linalg.norm(i - j) for j in xyz] for i in espxyz])
+        np.testing.assert_allclose(esp_inverse_distances(espxyz, xyz), 1. / (DistMat / bohr2ang), rtol=1e-12)
+
+class TestRESPNormalEquations(ForceBalanceTestCase):
+    def test_resp_normal_equations(self):
+        """Check the RESP objective function from the normal equations against a loop over snapshots"""
+        rng = np.random.RandomState(0)
+        ns, nesp, na, npr = 5, 30, 6, 3
+        P = rng.rand(ns)
+        V = rng.rand(ns, nesp, na)
+        espvals = rng.randn(ns, nesp)
+        q = rng.randn(na)
+        J = rng.randn(na, npr)
+        X, G, H, D = 0.0, np.zeros(npr), np.zeros((npr, npr)), 0.0
+        for i in range(ns):
+            desp = np.dot(V[i], q) - espvals[i]
+            dVdqM = np.dot(V[i], J).T
+            X += P[i] * np.dot(desp, desp) / nesp
+            G += P[i] * 2 * np.dot(dVdqM, desp) / nesp
+            H += P[i] * 2 * np.dot(dVdqM, dVdqM.T) / nesp
+            D += P[i] * (np.dot(espvals[i], espvals[i]) / nesp - (np.sum(espvals[i]) / nesp)**2)
+        Z, A, b, c, D1 = resp_normal_equations(P, V, espvals)
+        np.testing.assert_allclose(Z, np.sum(P), rtol=1e-12)
+        np.testing.assert_allclose(D1, D, rtol=1e-12)
+        np.testing.assert_allclose((np.dot(q, np.dot(A, q)) - 2 * np.dot(b, q) + c) / nesp, X, rtol=1e-10)
+        np.testing.assert_allclose(2 * np.dot(J.T, np.dot(A, q) - b) / nesp, G, rtol=1e-10)
+        np.testing.assert_allclose(2 * np.dot(J.T, np.dot(A, J)) / nesp, H, rtol=1e-10)
@@ -6,6 +6,7 @@ from forcebalance.nifty import *
 from forcebalance.gmxio import GMX
 from forcebalance.tinkerio import TINKER
 from forcebalance.openmmio import OpenMM
+from forcebalance.engine import batch_map, fd_energy_derivatives
 from collections import OrderedDict
 from .__init__ import ForceBalanceTestCase, check_for_openmm
 
@@ -326,6 +327,24 @@ class TestAmber99SB(ForceBalanceTestCase):
                         np.testing.assert_allclose(m[a], -1.0*mr[a], rtol=0, atol=delta,
                                                    err_msg="%s normal modes do not match the reference" % Name)
 
+    def test_openmm_warm_start(self):
+        """ Test OpenMM optimizations started from a minimized geometry and energies at fixed geometries """
+        printcool("Test OpenMM optimizations started from a minimized geometry and energies at fixed geometries")
+        if 'OpenMM' not in self.engines:
+            pytest.skip("Missing packages: OpenMM")
+        eng = self.engines['OpenMM']
+        E, rmsd, M = eng.optimize(5)
+        # The energy at the optimized geometry is the optimized energy.
+        np.testing.assert_allclose(eng.energy_at(M.xyzs[0]), E, rtol=0, atol=1e-6,
+                                   err_msg="OpenMM energy at the optimized geometry does not match the optimized energy")
+        # Starting from a perturbed minimum reaches the same minimum as starting from the snapshot.
+        start = M.xyzs[0] + 0.01*np.random.RandomState(0).randn(*M.xyzs[0].shape)
+        E1, rmsd1, M1 = eng.optimize(5, start=start)
+        np.testing.assert_allclose(E1, E, rtol=0, atol=0.001,
+                                   err_msg="OpenMM warm-started optimized energy does not match the reference")
+        np.testing.assert_allclose(rmsd1, rmsd, rtol=0, atol=0.001,
+                                   err_msg="OpenMM warm-started RMSD from the starting structure does not match the reference")
+
 
 class TestAmoebaWater6(ForceBalanceTestCase):
     """ AMOEBA unit test consisting of a water hexamer.  The test
@@ -515,3 +534,66 @@ class TestAmoebaWater6(ForceBalanceTestCase):
         np.testing.assert_allclose(QT1, QR1, rtol=0, atol=0.01,
                                    err_msg="TINKER quadrupoles do not match the reference when geometries are optimized")
 
+
+class TestBatchMap(ForceBalanceTestCase):
+    def test_batch_map(self, tmpdir):
+        """Check that batch_map returns the same results in order with several processes"""
+        cwd = os.getcwd()
+        os.chdir(str(tmpdir))
+        try:
+            offset = 0.5
+            def func(x):
+                # Each worker writes its own copy of the same file name.
+                with open('scratch.txt', 'w') as f: f.write('%f\n' % x)
+                return (x**2 + offset, float(open('scratch.txt').read()))
+            args = list(range(7))
+            serial = list(batch_map(func, args))
+            parallel = list(batch_map(func, args, processes=3))
+            assert serial == parallel == [(x**2 + offset, float(x)) for x in args]
+            # The scratch directories of the workers are removed.
+            assert [i for i in os.listdir('.') if i.startswith('batch_worker.')] == []
+        finally:
+            os.chdir(cwd)
+
+    def test_fd_energy_derivatives(self, tmpdir):
+        """Check the batched finite-difference energy derivatives and the skipping of independent parameters"""
+        cwd = os.getcwd()
+        os.chdir(str(tmpdir))
+        try:
+            x = np.linspace(-1, 1, 20)
+            class FakeFF(object):
+                np = 3
+                plist = ['A', 'B', 'C']
+                def make(self, mvals):
+                    self.mvals = np.array(mvals, dtype=float)
+            class FakeEngine(object):
+                name = 'fake'
+                def __init__(self, deps):
+                    self.deps = deps
+                def worker_init(self):
+                    pass
+                def dependent_parameters(self):
+                    return self.deps
+                def energy(self):
+                    m = FF.mvals
+                    return m[0]**2*x + np.sin(m[1])*x**2 + m[2]**3
+                def energy_dipole(self):
+                    return np.vstack((self.energy(), FF.mvals[0]*x, FF.mvals[1]*x, FF.mvals[2]*x)).T
+            FF = FakeFF()
+            mvals = np.array([0.3, 0.2, 0.5])
+            exact = np.array([2*mvals[0]*x, np.cos(mvals[1])*x**2, 3*mvals[2]**2*np.ones_like(x)])
+            E0, G = fd_energy_derivatives(FakeEngine(None), FF, mvals, 1e-4, [0, 1, 2])
+            np.testing.assert_allclose(E0, mvals[0]**2*x + np.sin(mvals[1])*x**2 + mvals[2]**3, rtol=1e-14)
+            np.testing.assert_allclose(G, exact, atol=1e-6)
+            _, G2 = fd_energy_derivatives(FakeEngine(None), FF, mvals, 1e-4, [0, 1, 2], processes=3)
+            np.testing.assert_array_equal(G, G2)
+            # Parameters that cannot affect the system are skipped.
+            _, G3 = fd_energy_derivatives(FakeEngine({0: [], 2: []}), FF, mvals, 1e-4, [0, 1, 2], processes=2)
+            np.testing.assert_array_equal(G3[[0, 2]], G[[0, 2]])
+            assert np.all(G3[1] == 0)
+            _, GD = fd_energy_derivatives(FakeEngine(None), FF, mvals, 1e-4, [0, 2], dipole=True, processes=2)
+            assert GD.shape == (3, len(x), 4)
+            np.testing.assert_array_equal(GD[:,:,0][[0, 2]], G[[0, 2]])
+            np.testing.assert_allclose(GD[0,:,1], x, atol=1e-8)
+        finally:
+            os.chdir(cwd)
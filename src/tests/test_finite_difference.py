@@ -59,3 +59,21 @@ class TestFiniteDifference(ForceBalanceTestCase):
                             assert abs(result[1]-func[2](input,p)) < 1e-3
                         else:
                             assert abs(result-func[1](input,p)) < 1e-3
+
+    def test_in_fd(self):
+        """Check that in_fd() is only True while a finite difference stencil is being evaluated"""
+        fd = forcebalance.finite_difference
+        inside = []
+        def func(x):
+            inside.append((fd.in_fd(), fd.in_fd_srch()))
+            return x[0]**2
+        assert not fd.in_fd()
+        fd.f12d3p(fd.fdwrap(func, [1.0], 0), 1e-4)
+        assert all([i == (True, True) for i in inside])
+        assert not fd.in_fd()
+        with fd.fd_context(srch=True):
+            assert not fd.in_fd() and fd.in_fd_srch()
+            with fd.fd_context():
+                assert fd.in_fd()
+            assert not fd.in_fd()
+        assert not fd.in_fd_srch()
@@ -68,6 +68,33 @@ class FFTests(object):
         os.remove(self.options['ffdir']+'/test_ones.' + self.filetype)
 
 
+    def test_incremental_make(self):
+        """Check that make() with incremental_make prints the same force field files"""
+        options = self.options.copy()
+        options['incremental_make'] = True
+        ff_inc = forcefield.FF(options)
+        np.random.seed(0)
+        mvals = np.random.uniform(-1, 1, self.ff.np)
+        mvals_1 = mvals.copy()
+        mvals_1[0] += 0.1
+        fnm = os.path.join(self.options['root'], self.ff.fnms[0])
+        for vals in [np.zeros(self.ff.np), mvals, mvals_1, mvals_1, np.zeros(self.ff.np)]:
+            self.ff.make(vals)
+            with open(fnm, 'rb') as f: ref = f.read()
+            os.remove(fnm)
+            ff_inc.make(vals)
+            with open(fnm, 'rb') as f: out = f.read()
+            assert ref == out, "make() with incremental_make produced a different output force field"
+            # The in-memory copy should reflect the most recent call to make(), even if no file was printed.
+            ff_inc.make(mvals, write=False)
+            ff_inc.make(vals, write=False)
+            data = ff_inc.get_ffdata(self.ff.fnms[0])
+            if ff_inc.ffdata_isxml[self.ff.fnms[0]]:
+                assert forcefield.etree.tostring(data) in out
+            else:
+                assert ''.join(data).encode() == out
+        os.remove(fnm)
+
 class TestWaterFF(ForceBalanceTestCase, FFTests):
     """Test FF class using water options and forcefield (text forcefield input)
     This test case also acts as a base class for other forcefield test cases.
@@ -91,6 +118,15 @@ class TestWaterFF(ForceBalanceTestCase, FFTests):
         self.filetype = self.options['forcefield'][0][-3:]
         self.logger.debug("ok\n")
 
+    def test_match_patoms(self):
+        """Check the parameters that can affect a system from its molecules and atom types"""
+        # The bonded and van der Waals parameters are matched by atom type,
+        # and the charges and virtual sites by molecule.
+        assert list(self.ff.match_patoms(set(), set(['OW', 'HW'])).keys()) == [0, 1, 2, 3, 4, 5]
+        assert list(self.ff.match_patoms(set(['SOL']), set()).keys()) == [6, 7, 8]
+        assert list(self.ff.match_patoms(set(['SOL']), set(['OW'])).keys()) == [0, 1, 6, 7, 8]
+        assert len(self.ff.match_patoms(set(), set())) == 0
+
 class TestXmlFF(ForceBalanceTestCase, FFTests):
     """Test FF class using dms.xml forcefield input"""
     def setup_method(self, method):
@@ -143,6 +179,18 @@ class TestXmlScriptFF(ForceBalanceTestCase):
         ff_out = forcefield.FF.fromfile('TIP3G2w.xml')
         assert self.ff_ref == ff_out, "make() produced a different output force field"
 
+    def test_incremental_make_output(self):
+        """Check make() with incremental_make creates the same force field file containing XML Script"""
+        os.chdir(os.path.join(self.cwd, 'files', 'XmlScript_out'))
+        self.ff.make(self.mvals)
+        with open('TIP3G2w.xml', 'rb') as f: ref = f.read()
+        os.remove('TIP3G2w.xml')
+        self.ff.incremental_make = True
+        self.ff.make(np.zeros(self.ff.np))
+        self.ff.make(self.mvals)
+        with open('TIP3G2w.xml', 'rb') as f: out = f.read()
+        assert ref == out, "make() with incremental_make produced a different output force field"
+
 class TestGbsFF(ForceBalanceTestCase, FFTests):
     """Test FF class using gbs forcefield input"""
     def setup_method(self, method):
@@ -1,6 +1,12 @@
 from __future__ import absolute_import
 import forcebalance
+import os
 import shutil
+import struct
+import numpy as np
+from forcebalance.gmxio import read_trr, read_edr
+from forcebalance.molecule import Molecule
+from .__init__ import ForceBalanceTestCase
 from .test_target import TargetTests # general targets tests defined in test_target.py
 """
 The testing functions for this class are located in test_target.py.
@@ -29,3 +35,39 @@ class TestAbInitio_GMX(TargetTests):
         shutil.rmtree('temp')
         super(TestAbInitio_GMX, self).teardown_method()
 
+
+class TestGMXBinaryReaders(ForceBalanceTestCase):
+    def setup_method(self, method):
+        super(TestGMXBinaryReaders, self).setup_method(method)
+        os.chdir(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'files', 'gmx_io'))
+
+    def test_read_edr(self):
+        """Check the energies read from a .edr file against g_energy"""
+        names, energies = read_edr('ener.edr')
+        assert energies.shape == (5, len(names))
+        # Potential energies printed by g_energy for the same file.
+        ref = np.array([-50.551373, -53.656227, -49.019321, -36.335785, -13.305370])
+        np.testing.assert_allclose(energies[:, names.index('Potential')], ref, atol=1e-5)
+
+    def test_read_trr(self):
+        """Check the coordinates and forces read from .trr files"""
+        trr = read_trr('traj.trr')
+        assert len(trr['x']) == 5 and len(trr['v']) == 1 and len(trr['f']) == 0
+        np.testing.assert_array_equal(trr['step'], np.arange(5))
+        M = Molecule('all.gro')
+        np.testing.assert_allclose(trr['x'][0] * 10, M.xyzs[0], atol=1e-4)
+        np.testing.assert_allclose(trr['box'][0], np.eye(3) * 0.3, atol=1e-7)
+        # A double precision frame with only forces.
+        natoms = 4
+        frc = np.arange(natoms * 3, dtype=float).reshape(natoms, 3) - 5.5
+        header = struct.pack('>2i', 1993, 13) + struct.pack('>i12s', 12, b'GMX_trn_file')
+        header += struct.pack('>13i', 0, 0, 0, 0, 0, 0, 0, 0, 0, natoms * 3 * 8, natoms, 7, 0)
+        header += struct.pack('>2d', 0.5, 0.0)
+        with open('forces.trr', 'wb') as f:
+            f.write(header + frc.astype('>f8').tobytes())
+            f.write(header + (2 * frc).astype('>f8').tobytes())
+        trr = read_trr('forces.trr')
+        os.remove('forces.trr')
+        assert len(trr['f']) == 2 and len(trr['x']) == 0
+        np.testing.assert_array_equal(trr['f'][1], 2 * frc)
+        np.testing.assert_array_equal(trr['time'], [0.5, 0.5])
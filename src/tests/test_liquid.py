@@ -60,3 +60,150 @@ class TestWaterTutorial(ForceBalanceTestCase):
         liquid_obj_value = optimizer.Objective.ObjDict['Liquid']['x']
         assert liquid_obj_value < 20, "Liquid objective function should give < 20 (about 17.23) total value."
 
+
+class TestMBARWeights(ForceBalanceTestCase):
+    def test_mbar_weights(self):
+        """Check MBAR weights at sampled states against pymbar and at a new state against direct reweighting"""
+        import numpy as np
+        from pymbar import pymbar
+        from forcebalance.liquid import mbar_weights
+        rng = np.random.RandomState(0)
+        # Harmonic oscillators with different force constants, sampled exactly.
+        ks = np.array([1.0, 1.5, 2.0])
+        N_k = np.array([400, 300, 500])
+        x = np.concatenate([rng.randn(n) / np.sqrt(k) for k, n in zip(ks, N_k)])
+        u_kn = 0.5 * ks[:, np.newaxis] * x**2
+        W = mbar_weights(u_kn, N_k, u_kn)
+        np.testing.assert_allclose(W, pymbar.MBAR(u_kn, N_k, relative_tolerance=5.0e-8).getWeights(), atol=1e-10)
+        # An unsampled state in between gives <x^2> = 1/k.
+        W = mbar_weights(u_kn, N_k, 0.5 * 1.25 * x[np.newaxis, :]**2)
+        assert W.shape == (len(x), 1)
+        assert abs(np.sum(W[:,0]) - 1.0) < 1e-12
+        assert abs(np.dot(W[:,0], x**2) * 1.25 - 1.0) < 0.1
+        # With a single sampled state, the weights are the Boltzmann factors of the energy differences.
+        W = mbar_weights(u_kn[:1, :400], N_k[:1], u_kn[1:2, :400])
+        w = np.exp(-(u_kn[1, :400] - u_kn[0, :400]))
+        np.testing.assert_allclose(W[:,0], w / np.sum(w), rtol=1e-12)
+
+    def test_mbar_free_energies(self):
+        """Check that warm-started and cached MBAR solutions match a cold solve"""
+        import numpy as np
+        from pymbar import pymbar
+        from forcebalance import liquid
+        rng = np.random.RandomState(1)
+        ks = np.array([1.0, 1.3, 1.8, 2.5])
+        N_k = np.array([300, 300, 300, 300])
+        x = np.concatenate([rng.randn(n) / np.sqrt(k) for k, n in zip(ks, N_k)])
+        u_kn = 0.5 * ks[:, np.newaxis] * x**2
+        U_kln = np.array([[u_kn[l, k*300:(k+1)*300] for l in range(len(ks))] for k in range(len(ks))])
+        np.testing.assert_array_equal(liquid.kln_to_kn(U_kln), u_kn)
+        ref = pymbar.MBAR(u_kn, N_k, relative_tolerance=5.0e-8).f_k
+        liquid.MBAR_CACHE.clear()
+        np.testing.assert_allclose(liquid.mbar_free_energies(u_kn, N_k), ref, atol=1e-6)
+        assert len(liquid.MBAR_CACHE) == 1
+        # A warm start from slightly different free energies converges to the same answer.
+        liquid.MBAR_CACHE.clear()
+        np.testing.assert_allclose(liquid.mbar_free_energies(u_kn, N_k, ref + 0.1*rng.randn(4)), ref, atol=1e-6)
+        # The same data gives the cached solution, whatever the guess.
+        f_k = liquid.mbar_free_energies(u_kn, N_k, np.zeros(4))
+        np.testing.assert_array_equal(f_k, liquid.MBAR_CACHE[list(liquid.MBAR_CACHE.keys())[0]])
+        f_k[:] = 0.0
+        assert np.all(liquid.mbar_free_energies(u_kn, N_k) == liquid.MBAR_CACHE[list(liquid.MBAR_CACHE.keys())[0]])
+        liquid.MBAR_CACHE.clear()
+
+    def test_adapt_md_steps(self):
+        """Check that the simulation length at each phase point follows the errors of the fitted properties"""
+        import numpy as np
+        from types import SimpleNamespace
+        from collections import OrderedDict
+        from forcebalance.liquid import Liquid
+        Points = [(298.15, 1.0, 'atm'), (318.15, 1.0, 'atm'), (338.15, 1.0, 'atm')]
+        target = SimpleNamespace(name='liquid', liquid_error_target=0.5, liquid_max_md_steps=0, md_steps=OrderedDict(),
+                                 liquid_md_steps=10000, liquid_timestep=1.0, liquid_interval=0.1,
+                                 gas_md_steps=20000, gas_timestep=1.0, gas_interval=0.1,
+                                 w_rho=1.0, w_hvap=1.0, w_alpha=0.0, w_kappa=1.0, w_cp=1.0, w_eps0=1.0,
+                                 rho_denom=1.0, eps0_denom=1.0, kappa_denom=1.0,
+                                 RefData={'rho' : dict.fromkeys(Points, 1.0), 'eps0' : {Points[1] : 1.0},
+                                          'kappa' : {Points[2] : 1.0}, 'alpha' : dict.fromkeys(Points, 1.0)})
+        errs = {'rho' : [0.1, 0.1, 0.1], 'eps0' : [0.0, 2.0, 0.0], 'kappa' : [0.0, 0.0, 0.6], 'alpha' : [100.0, 100.0, 100.0]}
+        property_results = {key : (None, dict(zip(Points, val)), None) for key, val in errs.items()}
+        Liquid.adapt_md_steps(target, Points, [], np.array([100, 100, 100]), property_results)
+        # Shortened to the lower limit, lengthened to the upper limit, and lengthened by (0.6/0.5)**2.
+        assert target.md_steps == OrderedDict([(Points[0], (1300, 2600)), (Points[1], (80000, 160000)), (Points[2], (14400, 28800))])
+        # Nothing is chosen if the option is off.
+        target.md_steps.clear()
+        target.liquid_error_target = 0.0
+        Liquid.adapt_md_steps(target, Points, [], np.array([100, 100, 100]), property_results)
+        assert len(target.md_steps) == 0
+
+    def test_reweight(self, tmpdir):
+        """Check that stored simulations are reweighted to nearby parameters, also after a restart"""
+        import numpy as np
+        from types import SimpleNamespace
+        from collections import defaultdict, OrderedDict
+        import forcebalance.optimizer
+        from forcebalance.nifty import save_result, lp_dump, kb
+        from forcebalance.liquid import Liquid
+        rng = np.random.RandomState(2)
+        PT = (298.15, 1.0, 'atm')
+        N = 500
+        m0 = np.array([0.1, -0.2])
+        # The energies are linear in the parameters, so the first-order estimate is exact.
+        Energies = -9000.0 + 10.0*rng.randn(N)
+        G = 2.0*rng.randn(2, N)
+        Rhos = 1000.0 + 20.0*rng.randn(N) + 5.0*G[0]
+        fields = dict(Rhos=Rhos, Volumes=6.5 + 0.1*rng.randn(N), Potentials=Energies, Energies=Energies, Dips=rng.randn(N, 3),
+                      G=G, GDips=0.1*rng.randn(3, 2, N), mPotentials=np.zeros(N), mEnergies=np.zeros(N), mG=np.zeros((2, N)),
+                      Rho_err=1.0, Hvap_err=0.0, Alpha_err=0.0, Kappa_err=0.0, Cp_err=0.0, Eps0_err=0.0, NMol=216)
+        os.makedirs(os.path.join(str(tmpdir), 'iter_0000', '298.15K-1.0atm'))
+        os.makedirs(os.path.join(str(tmpdir), 'iter_0001'))
+        os.chdir(os.path.join(str(tmpdir), 'iter_0000'))
+        save_result(os.path.join('298.15K-1.0atm', 'npt_result'), 'npt', **fields)
+        np.savetxt('mvals.txt', m0)
+        lp_dump((None, m0), 'forcebalance.p')
+
+        def make_target():
+            target = Liquid.__new__(Liquid)
+            target.__dict__.update(dict(name='liquid', FF=SimpleNamespace(np=2, plist=['a', 'b']), PhasePoints=[PT], Labels=['298.15K-1.0atm'],
+                                        RefData={'rho' : {PT : 1000.0}, 'rho_wt' : {PT : 1.0}}, rho_denom=30.0,
+                                        w_rho=1.0, w_hvap=0.0, w_alpha=0.0, w_kappa=0.0, w_cp=0.0, w_eps0=0.0, w_surf_ten=0.0,
+                                        w_normalize=False, hvap_subaverage=False, do_self_pol=False, pure_num_grad=False, adapt_errors=0,
+                                        liquid_error_target=0.0, liquid_md_steps=10000, liquid_reweight=2, reweight_neff=0.1,
+                                        reweight_max_step=0.1, Snapshots=[], Reweighted=None, mbar_f_k={},
+                                        AllResults=defaultdict(lambda:defaultdict(list)),
+                                        absrd=lambda inum=None: os.path.join(str(tmpdir), 'iter_%04i' % inum)))
+            return target
+
+        def expected_rho(m):
+            w = np.exp(-np.dot(m - m0, G) / (kb*PT[0]))
+            return np.dot(w, Rhos) / np.sum(w)
+
+        # The simulations are stored when they are read in.
+        target = make_target()
+        rho = target.get_normal(m0)['rho'][0][PT]
+        assert len(target.Snapshots) == 1
+        assert abs(rho - np.mean(Rhos)) < 1e-8
+        # At the same parameters the reweighted properties are those of the simulation.
+        assert target.reweight(m0)
+        assert abs(target.get_normal(m0)['rho'][0][PT] - rho) < 1e-8
+        # Nearby parameters give the Boltzmann-reweighted average.
+        m1 = m0 + np.array([0.03, 0.04])
+        assert target.reweight(m1)
+        assert abs(target.get_normal(m1)['rho'][0][PT] - expected_rho(m1)) < 1e-6
+        # Simulations farther away than reweight_max_step are not used.
+        assert not target.reweight(m0 + np.array([0.09, 0.08]))
+        assert target.Reweighted is None
+
+        # After a restart, the simulations of the previous iterations are read in again and reweighted.
+        os.chdir(os.path.join(str(tmpdir), 'iter_0001'))
+        lp_dump((None, m1), 'forcebalance.p')
+        iteration = forcebalance.optimizer.ITERATION
+        forcebalance.optimizer.ITERATION = 1
+        try:
+            target = make_target()
+            Answer = target.read(m1)
+        finally:
+            forcebalance.optimizer.ITERATION = iteration
+        assert target.Reweighted is not None
+        assert len(target.Snapshots) == 1
+        assert abs(Answer['X'] - ((expected_rho(m1) - 1000.0) / 30.0)**2) < 1e-8
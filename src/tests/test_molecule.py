@@ -218,3 +218,45 @@ class TestGalbPNPMol2(ForceBalanceTestCase):
                                       'O', 'C', 'H', 'C', 'H', 'H', 'O', 'H', 'C', 'H', 'O', 'H', 'C', 'H', 'O', 'H',
                                       'C', 'H', 'O', 'H'], "Incorrect atomic symbols"
         assert len(self.molecule.bonds) == 37, "Incorrect number of bonds for pNP-0LB structure"
+
+class TestQData(ForceBalanceTestCase):
+    def setup_method(self, method):
+        super(TestQData, self).setup_method(method)
+        os.chdir('files')
+        self.source = 'qdata_cache_test.txt'
+        with open(os.path.join('targets', 'cluster-02', 'qdata.txt')) as f:
+            self.text = f.read()
+        with open(self.source, 'w') as f:
+            f.write(self.text)
+
+    def teardown_method(self):
+        os.system('rm -rf {name} {name}.cache'.format(name=self.source))
+        super(TestQData, self).teardown_method()
+
+    def test_qdata_cache(self):
+        """Check that the binary cache of qdata.txt gives the same data and is replaced when the file changes"""
+        lines = [l.split() for l in self.text.split('\n') if len(l.split()) > 0]
+        xyzs = [np.array(l[1:], dtype=float).reshape(-1,3) for l in lines if l[0] == 'COORDS']
+        energies = [float(l[1]) for l in lines if l[0] == 'ENERGY']
+        M = forcebalance.molecule.Molecule(self.source)
+        assert len(M) == len(xyzs)
+        np.testing.assert_array_equal(np.array(M.xyzs), np.array(xyzs))
+        assert M.qm_energies == energies
+        uncached = forcebalance.molecule.load_qdata(self.source)
+        assert not os.path.exists(self.source + '.cache')
+        written = forcebalance.molecule.load_qdata(self.source, cache=True)
+        assert os.path.exists(os.path.join(self.source + '.cache', 'index.txt'))
+        cached = forcebalance.molecule.load_qdata(self.source, cache=True)
+        assert isinstance(cached['qm_grads'].base, np.memmap)
+        for Q in [written, cached]:
+            assert list(Q.keys()) == list(uncached.keys())
+            for key in uncached:
+                np.testing.assert_array_equal(Q[key], uncached[key])
+        # Editing the file invalidates the cache; lines of different lengths come back as a list.
+        with open(self.source, 'a') as f:
+            f.write('ESPXYZ 0.0 0.0 1.0\nESPVAL 0.5\nESPXYZ 0.0 0.0 1.0 0.0 1.0 0.0\nESPVAL 0.5 0.25\n')
+        changed = forcebalance.molecule.load_qdata(self.source, cache=True)
+        for Q in [changed, forcebalance.molecule.load_qdata(self.source, cache=True)]:
+            np.testing.assert_array_equal(Q['qm_energies'], energies)
+            assert len(Q['qm_espvals']) == 2
+            np.testing.assert_array_equal(Q['qm_espvals'][1], [0.5, 0.25])
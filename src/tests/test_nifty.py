@@ -92,6 +92,148 @@ class TestNifty(ForceBalanceTestCase):
         with pytest.raises(Exception) as excinfo:
             _exec("exit 255")
 
+    def test_exec_streams(self, tmpdir):
+        """Check that _exec splits the output streams into lines and writes the output and log files"""
+        script = ("import sys; o = sys.stdout.buffer; "
+                  "o.write(u'h\\u00e9llo\\r\\nstep 1\\rstep 2\\n'.encode('utf-8')); o.flush(); "
+                  "sys.stderr.write('error\\n'); sys.stderr.flush(); "
+                  "o.write(b''.join(b'line %i\\n' % i for i in range(5000)) + b'end')")
+        outfnm = os.path.join(str(tmpdir), 'out.txt')
+        logfnm = os.path.join(str(tmpdir), 'log.txt')
+        with open(logfnm, 'w') as f: f.write('previous\n')
+        command = [sys.executable, '-c', script]
+        out = _exec(command, outfnm=outfnm, logfnm=logfnm, print_command=False, rbytes=100)
+        assert out[:2] == [u'h\u00e9llo\r', 'step 1\rstep 2']
+        assert out[2:-1] == ['line %i' % i for i in range(5000)] and out[-1] == 'end'
+        assert open(outfnm, 'rb').read() == (u'\n'.join(out) + '\n').encode('utf-8')
+        assert open(logfnm, 'rb').read() == b'previous\n' + open(outfnm, 'rb').read()
+        out = _exec(command, print_command=False, expand_cr=True)
+        assert out[:3] == [u'h\u00e9llo', 'step 1', 'step 2']
+        out = _exec(command, print_command=False, copy_stderr=True)
+        assert len(out) == 5004 and 'error' in out
+
+    def test_statistical_inefficiency(self):
+        """Check the statistical inefficiencies from FFTs against the direct sum over time lags"""
+        def direct(A_n, B_n, fast):
+            dA_n = A_n - A_n.mean()
+            dB_n = B_n - B_n.mean()
+            N = len(A_n)
+            sigma2_AB = (dA_n * dB_n).mean()
+            g, t, increment = 1.0, 1, 1
+            while t < N-1:
+                C = np.sum(dA_n[0:(N-t)]*dB_n[t:N] + dB_n[0:(N-t)]*dA_n[t:N]) / (2.0 * float(N-t) * sigma2_AB)
+                if (C <= 0.0) and (t > 3): break
+                g += 2.0 * C * (1.0 - float(t)/float(N)) * float(increment)
+                t += increment
+                if fast: increment += 1
+            return max(g, 1.0)
+        rng = np.random.RandomState(0)
+        N, K = 2000, 4
+        A = np.zeros((N, K))
+        for n in range(1, N):
+            A[n] = np.array([0.0, 0.5, 0.9, 0.99]) * A[n-1] + rng.randn(K)
+        B = A + rng.randn(N, K)
+        for fast in [False, True]:
+            gA = statisticalInefficiencies(A, fast=fast)
+            gAB = statisticalInefficiencies(A, B, fast=fast)
+            for k in range(K):
+                assert abs(gA[k] - direct(A[:,k], A[:,k], fast)) < 1e-10 * gA[k]
+                assert abs(gAB[k] - direct(A[:,k], B[:,k], fast)) < 1e-10 * gAB[k]
+                assert abs(statisticalInefficiency(A[:,k], fast=fast) - gA[k]) < 1e-12 * gA[k]
+        assert gA[0] < 1.5 and gA[3] > 50
+        assert statisticalInefficiency(np.ones(10), warn=False) == 1.0
+        np.testing.assert_array_equal(multiD_statisticalInefficiency(A), np.tile(statisticalInefficiencies(A), (N, 1)))
+
+    def test_bootstrap(self):
+        """Check that the bootstrap from frame weights matches resampling the frames"""
+        rng = np.random.RandomState(0)
+        L = 500
+        x = rng.randn(L)
+        y = np.exp(rng.randn(L))
+        def calc(b):
+            return (np.dot(b, x*y) / np.sum(b, axis=-1)) / (np.dot(b, y) / np.sum(b, axis=-1))
+        np.random.seed(1)
+        W = np.vstack(list(bootstrap_weights(L, 100, maxsize=7*L)))
+        assert W.shape == (100, L) and np.all(W.sum(axis=1) == L)
+        np.random.seed(1)
+        boots = bootstrap(calc, L, 100)
+        ref = []
+        for w in W:
+            boot = np.repeat(np.arange(L), w.astype(int))
+            ref.append(np.mean(x[boot]*y[boot]) / np.mean(y[boot]))
+        np.testing.assert_allclose(boots, ref, rtol=1e-12)
+        # Block resamples consist of runs of consecutive frames.
+        np.random.seed(2)
+        for w in bootstrap_weights(L, 10, block=50):
+            assert np.all(w.sum(axis=1) == L)
+        # The block bootstrap picks up the correlation of a correlated timeseries.
+        z = np.zeros(20000)
+        for n in range(1, len(z)):
+            z[n] = 0.95*z[n-1] + rng.randn()
+        g = statisticalInefficiency(z)
+        err = bootstrap_stderr(lambda b: np.dot(b, z)/np.sum(b, axis=1), len(z), g, 200)
+        err_block = bootstrap_stderr(lambda b: np.dot(b, z)/np.sum(b, axis=1), len(z), g, 200, block=True)
+        assert 0.7 < err_block/err < 1.3
+
+    def test_result_files(self, tmpdir):
+        """Check that the result files of the condensed phase scripts keep all fields, also when memory-mapped"""
+        src = os.path.join(os.path.dirname(__file__), 'files', 'test_liquid', 'single.tmp', 'Liquid', 'iter_0000', '298.15K-1.0atm')
+        old = load_result(os.path.join(src, 'npt_result'), 'npt')
+        assert old.fnm.endswith('.p') and old.keys() == list(RESULT_SCHEMAS['npt'].keys())
+        fnm = os.path.join(str(tmpdir), 'npt_result')
+        save_result(fnm, 'npt', **dict([(k, old[k]) for k in old.keys()]))
+        assert result_path(fnm) == fnm + '.npz'
+        for mmap in [False, True]:
+            new = load_result(fnm, 'npt', mmap=mmap)
+            for k in old.keys():
+                np.testing.assert_array_equal(new[k], old[k])
+            assert isinstance(new['NMol'], int)
+            assert isinstance(new['Energies'], np.memmap) == mmap
+        # Fields of a result read by a relative path may be used from another directory.
+        os.chdir(str(tmpdir))
+        new = load_result('npt_result', 'npt', mmap=True)
+        os.chdir(src)
+        np.testing.assert_array_equal(new['G'], old['G'])
+        # The snapshots of several results are joined along the right axes.
+        both = new.concatenate([old])
+        assert both['G'].shape == (old['G'].shape[0], 2*len(old['Energies']))
+        assert both['GDips'].shape[2] == both['Dips'].shape[0] == 2*len(old['Energies'])
+        assert both['NMol'] == old['NMol']
+        st = load_result(os.path.join(src, 'nvt_result'), 'nvt')
+        save_result(os.path.join(str(tmpdir), 'nvt_result'), 'nvt', **dict([(k, st[k]) for k in st.keys()]))
+        assert load_result(os.path.join(str(tmpdir), 'nvt_result'), 'nvt')['surf_ten'] == st['surf_ten']
+        # Files of the wrong kind or with missing fields are refused.
+        with pytest.raises(RuntimeError):
+            load_result(fnm, 'nvt')
+        with pytest.raises(RuntimeError):
+            save_result(fnm, 'nvt', surf_ten=1.0)
+        assert load_result(os.path.join(str(tmpdir), 'none'), 'npt') is None
+
+    def test_local_wq(self, tmpdir):
+        """Check that the LocalWorkQueue runs queued tasks in their own directories and returns the outputs"""
+        cwd = os.getcwd()
+        os.chdir(str(tmpdir))
+        try:
+            createLocalWorkQueue(2)
+            wq = getWorkQueue()
+            for i in range(4):
+                with open('in%i.txt' % i, 'w') as f: f.write('%i\n' % i)
+                # Every task writes the same file names in its own directory.
+                queue_up_src_dest(wq, 'cat input.txt input.txt > output.txt; pwd > where.txt',
+                                  input_files=[(os.path.abspath('in%i.txt' % i), 'input.txt')],
+                                  output_files=[(os.path.abspath('out%i.txt' % i), 'output.txt'), (os.path.abspath('where%i.txt' % i), 'where.txt')],
+                                  verbose=False)
+            assert len(getWQIds()['None']) == 4
+            wq_wait(wq, wait_time=1, wait_intvl=1)
+            assert wq.empty() and len(getWQIds()['None']) == 0
+            for i in range(4):
+                assert open('out%i.txt' % i).read() == '%i\n%i\n' % (i, i)
+            assert len(set([open('where%i.txt' % i).read() for i in range(4)])) == 4
+            assert wq.stats.tasks_done == 4
+        finally:
+            destroyWorkQueue()
+            os.chdir(cwd)
+
     def test_work_queue_functions(self):
         """Check work_queue functions behave as expected"""
         
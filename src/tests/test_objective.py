@@ -167,3 +167,50 @@ class TestBromineObjective(ForceBalanceTestCase, ObjectiveTests):
         self.ff = forcebalance.forcefield.FF(self.options)
 
         self.objective = forcebalance.objective.Objective(self.options, self.tgt_opts,self.ff)
+
+class FakeTarget(object):
+    """ Minimal stand-in for a target, whose objective function depends on how often it was evaluated. """
+    def __init__(self, name, np):
+        self.name = name
+        self.np = np
+        self.h = 1e-3
+        self.goodstep = False
+        self.evaluated = False
+        self.ncalls = 0
+    def get_engines(self):
+        return []
+    def stage(self, mvals, AGrad=False, AHess=False, customdir=None):
+        return
+    def get_X(self, mvals, customdir=None):
+        self.ncalls += 1
+        forcebalance.objective.logger.info("%s call %i\n" % (self.name, self.ncalls))
+        return {'X' : float(self.ncalls) + numpy.sum(mvals), 'G' : numpy.zeros(self.np), 'H' : numpy.zeros((self.np, self.np))}
+    get_G = get_H = get_X
+    def meta_indicate(self, customdir=None):
+        forcebalance.objective.logger.info("%s evaluated %i times\n" % (self.name, self.ncalls))
+
+class TestTargetPool(ForceBalanceTestCase):
+    def test_target_pool(self, caplog):
+        """Check that TargetPool workers keep their own targets between evaluations and print in order"""
+        Targets = [FakeTarget('fake%i' % i, 3) for i in range(5)]
+        Times = dict([('fake%i' % i, float(i)) for i in range(5)])
+        pool = forcebalance.objective.TargetPool(Targets, 2, Times)
+        try:
+            # Longest-first, each to the worker with the least work so far.
+            assert list(pool.owner.items()) == [('fake4', 0), ('fake3', 1), ('fake2', 1), ('fake1', 0), ('fake0', 0)]
+            for n in range(1, 3):
+                Results, RunTimes = pool.run(Targets, 'get', (numpy.ones(3), 0, True, None))
+                assert list(Results.keys()) != [] and set(Results.keys()) == set(Times.keys())
+                for name, Ans in Results.items():
+                    assert Ans['X'] == n + 3.0
+            out = caplog.text
+            assert out.index('fake0 call 2') < out.index('fake1 call 2') < out.index('fake4 call 2')
+            assert 'fake2 evaluated 2 times' in out
+            # The targets in this process were not touched.
+            assert all([Tgt.ncalls == 0 for Tgt in Targets])
+            # The run times of the last evaluation reorder the targets of each worker.
+            assert set(pool.Times.keys()) == set(Times.keys()) and pool.Times != Times
+            pool.Times.update(dict([('fake%i' % i, 10.0 - i) for i in range(5)]))
+            assert pool.queues(list(Times.keys())) == [['fake0', 'fake1', 'fake4'], ['fake2', 'fake3']]
+        finally:
+            pool.close()
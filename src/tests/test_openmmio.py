@@ -80,6 +80,39 @@ class TestInteraction_OpenMM(TargetTests):
 
         self.target = forcebalance.openmmio.Interaction_OpenMM(self.options, self.tgt_opt, self.ff)
 
+    def test_fast_update(self):
+        """Check that updating the parameters in the OpenMM Context gives the same objective function"""
+        os.chdir(os.path.join('temp', self.tgt_opt['name']))
+        objective = self.target.get(self.mvals, AGrad=True, AHess=True)
+        os.chdir(self.options['root'])
+        self.options['incremental_make'] = True
+        self.tgt_opt['openmm_fast_update'] = True
+        ff = forcebalance.forcefield.FF(self.options)
+        target = forcebalance.openmmio.Interaction_OpenMM(self.options, self.tgt_opt, ff)
+        # The Lennard-Jones parameters of the sulfur enter only the sulfur atoms;
+        # the other parameters also change the 1-4 pairs or the hydrogen charges.
+        assert sorted(target.fast_update_maps['openmm'][0].keys()) == [1, 2]
+        os.chdir(os.path.join('temp', self.tgt_opt['name']))
+        objective_fast = target.get(self.mvals, AGrad=True, AHess=True)
+        np.testing.assert_allclose(objective_fast['X'], objective['X'], rtol=1e-8)
+        np.testing.assert_allclose(objective_fast['G'], objective['G'], rtol=1e-8)
+        np.testing.assert_allclose(objective_fast['H'], objective['H'], rtol=1e-8)
+        os.chdir(self.options['root'])
+
+    def test_batch_contexts(self):
+        """Check that dividing the snapshots over several OpenMM Contexts gives the same energies and forces"""
+        os.chdir(os.path.join('temp', self.tgt_opt['name']))
+        engine = self.target.engine
+        for mvals in [np.zeros(self.ff.np), np.array(self.mvals)]:
+            self.ff.make(mvals)
+            engine.batch_contexts = 1
+            EF1 = engine.energy_force()
+            engine.batch_contexts = 3
+            EF3 = engine.energy_force()
+            assert len(engine.contexts) == 2
+            np.testing.assert_allclose(EF3, EF1, rtol=1e-10)
+        os.chdir(self.options['root'])
+
     def teardown_method(self):
         shutil.rmtree('temp')
         super(TestInteraction_OpenMM, self).teardown_method()
@@ -90,3 +90,32 @@ class TargetTests(ForceBalanceTestCase):
                 assert abs(g[p]-G[p]) < X*.01 +1e-7
     
         os.chdir('../..')
+
+class TestGaussNewton(ForceBalanceTestCase):
+    def test_gauss_newton(self):
+        """Check the Gauss-Newton objective function against a loop over pairs of parameters"""
+        class FakeFF(object):
+            np = 5
+        class FakeTarget(object):
+            FF = FakeFF()
+            pgrad = [0, 2, 3]
+            gauss_newton = forcebalance.target.Target.gauss_newton
+        target = FakeTarget()
+        rng = numpy.random.RandomState(0)
+        V = rng.randn(8)
+        dV = rng.randn(5, 8)
+        W = rng.rand(8)
+        G = numpy.zeros(5)
+        H = numpy.zeros((5, 5))
+        X = 3.0*numpy.dot(W*V, V)
+        for p in target.pgrad:
+            G[p] = 2*3.0*numpy.dot(W*V, dV[p])
+            for q in target.pgrad:
+                H[p,q] = 2*3.0*numpy.dot(W*dV[p], dV[q])
+        Answer = target.gauss_newton(V, dV, weights=W, scale=3.0)
+        numpy.testing.assert_allclose(Answer['X'], X, rtol=1e-12)
+        numpy.testing.assert_allclose(Answer['G'], G, rtol=1e-12)
+        numpy.testing.assert_allclose(Answer['H'], H, rtol=1e-12)
+        Answer = target.gauss_newton(V, dV, AGrad=False, AHess=False)
+        numpy.testing.assert_allclose(Answer['X'], numpy.dot(V, V), rtol=1e-12)
+        assert not Answer['G'].any() and not Answer['H'].any()
@@ -8,9 +8,10 @@ import errno
 import numpy as np
 
 from forcebalance.target import Target
+from forcebalance.engine import fd_energy_derivatives
 from forcebalance.finite_difference import in_fd, f12d3p, fdwrap
 from forcebalance.nifty import flat, col, row
-from forcebalance.nifty import lp_dump, lp_load, wopen, _exec
+from forcebalance.nifty import lp_dump, lp_load, wopen, _exec, getWorkQueue, queue_up
 from forcebalance.nifty import LinkFile, link_dir_contents
 from forcebalance.nifty import printcool, printcool_dictionary
 
@@ -19,14 +20,16 @@ from collections import OrderedDict
 from forcebalance.output import getLogger
 logger = getLogger(__name__)
 
-def energy_derivatives(engine, FF, mvals, h, pgrad, dipole=False):
+def energy_derivatives(engine, FF, mvals, h, pgrad, dipole=False, processes=1, dependence=True):
 
     """
     Compute the first and second derivatives of a set of snapshot
     energies with respect to the force field parameters.
 
     This basically calls the finite difference subroutine on the
-    energy_driver subroutine also in this script.
+    energy_driver subroutine also in this script.  The displaced
+    parameter sets are evaluated as one batch, spread over several
+    processes if requested (see engine.fd_energy_derivatives).
 
     In the future we may need to be more sophisticated with
     controlling the quantities which are differentiated, but for
@@ -38,32 +41,21 @@ def energy_derivatives(engine, FF, mvals, h, pgrad, dipole=False):
     @param[in] h Finite difference step size
     @param[in] pgrad List of active parameters for differentiation
     @param[in] dipole Switch for dipole derivatives.
+    @param[in] processes Number of local processes for the displaced parameter sets
+    @param[in] dependence Skip the parameters that cannot affect the system in the engine
     @return G First derivative of the energies in a N_param x N_coord array
     @return GDx First derivative of the box dipole moment x-component in a N_param x N_coord array
     @return GDy First derivative of the box dipole moment y-component in a N_param x N_coord array
     @return GDz First derivative of the box dipole moment z-component in a N_param x N_coord array
 
     """
-    def single_point(mvals_):
-        FF.make(mvals_)
-        if dipole:
-            return engine.energy_dipole()
-        else:
-            return engine.energy()
-
-    ED0 = single_point(mvals)
+    _, EDG = fd_energy_derivatives(engine, FF, mvals, h, pgrad, dipole, processes, dependence)
     G   = OrderedDict()
-    G['potential'] = np.zeros((FF.np, ED0.shape[0]))
     if dipole:
-        G['dipole'] = np.zeros((FF.np, ED0.shape[0], 3))
-    for i in pgrad:
-        logger.info("%i %s\r" % (i, (FF.plist[i] + " "*30)))
-        edg, _ = f12d3p(fdwrap(single_point,mvals,i),h,f0=ED0)
-        if dipole:
-            G['potential'][i] = edg[:,0]
-            G['dipole'][i]    = edg[:,1:]
-        else:
-            G['potential'][i] = edg[:]
+        G['potential'] = EDG[:,:,0]
+        G['dipole']    = EDG[:,:,1:]
+    else:
+        G['potential'] = EDG
     return G
 
 #
@@ -212,8 +204,9 @@ class Thermo(Target):
             
     def submit_jobs(self, mvals, AGrad=True, AHess=True):
         """This routine is called by Objective.stage() and will run before "get".
-        It submits the jobs and the stage() function will wait for jobs
-        to complete.
+        It submits the jobs to the Work Queue (or to the local stand-in
+        of wq_local), if there is one, and the stage() function will wait
+        for jobs to complete; otherwise they run here one after another.
 
         Parameters
         ----------
@@ -229,6 +222,7 @@ class Thermo(Target):
         Nothing.
         
         """
+        wq = getWorkQueue()
         # Set up and run the simulation chain on all points.
         for pt in self.points:
             # Create subdir
@@ -246,8 +240,9 @@ class Thermo(Target):
                 LinkFile(os.path.join(self.root, self.tempdir, f),
                          os.path.join(os.getcwd(), f))
                 
-            link_dir_contents(os.path.join(self.root, self.tgtdir,
-                                           str(pt.idnr)), os.getcwd())
+            ptdir = os.path.join(self.root, self.tgtdir, str(pt.idnr))
+            link_dir_contents(ptdir, os.getcwd())
+            ptfiles = [f for f in os.listdir(ptdir) if os.path.isfile(os.path.join(ptdir, f))]
             
             # Dump the force field to a pickle file
             lp_dump((self.FF, mvals, self.OptionDict, AGrad), 'forcebalance.p')
@@ -262,7 +257,16 @@ class Thermo(Target):
                       "--pressure %f " % pt.pressure +
                       "--nequil %d " % self.eq_steps +
                       "--nsteps %d " % self.md_steps)
-            _exec(cmdstr, copy_stderr=True, outfnm='md_chain.out')
+            if wq is None:
+                logger.info("Running the simulation chain locally.\n")
+                _exec(cmdstr, copy_stderr=True, outfnm='md_chain.out')
+            else:
+                # The jobs at all of the points run concurrently, and
+                # Objective.stage() waits for them to complete.
+                queue_up(wq, command = cmdstr + ' > md_chain.out 2>&1',
+                         tag='%s:%d' % (self.name, pt.idnr),
+                         input_files = self.scripts + ptfiles + ['forcebalance.p'],
+                         output_files = ['md_result.p', 'md_chain.out'], tgt=self)
         
             os.chdir('..')
 
@@ -165,6 +165,9 @@ class Tinker_Reader(BaseReader):
             # The suffix of the parameter ID is built from the atom    #
             # types/classes involved in the interaction.
             self.suffix = '/'+'.'.join(self.atom)
+            # The atom types/classes are looked up in the whole system (negative
+            # numbers are used for multipole frames).
+            self.molatom = (None, [a.lstrip('-') for a in self.atom])
 
 def write_key(fout, options, fin=None, defaults={}, verbose=False, prmfnm=None, chk=[]):
     """
@@ -684,6 +687,20 @@ class TINKER(Engine):
             Result["Force"] = np.array(F)
         return Result
 
+    def topology_labels(self):
+        """ Return the atom types in the coordinates and their classes from
+        the 'atom' lines of the .prm file; the TINKER parameters are not
+        specific to molecules.  Atom number zero stands for a missing
+        atom in multipole frames. """
+        if not hasattr(self, 'FF') or not hasattr(self.FF, 'tinkerprm'): return None
+        types = set([suf.split()[0] for suf in self.mol.tinkersuf])
+        classes = set()
+        for line in self.FF.ffdata[self.FF.tinkerprm]:
+            s = line.split()
+            if len(s) > 2 and s[0].lower() == 'atom' and s[1] in types:
+                classes.add(s[2])
+        return set(), types | classes | set(['0'])
+
     def get_charges(self):
         logger.error('TINKER engine does not have get_charges (should be easy to implement however.)')
         raise NotImplementedError
@@ -48,6 +48,14 @@ class TorsionProfileTarget(Target):
         self.set_option(tgt_opts,'energy_denom','energy_denom')
         ## Set upper cutoff energy
         self.set_option(tgt_opts,'energy_upper','energy_upper')
+        ## Start the optimizations at displaced parameters from the MM-optimized geometries.
+        self.set_option(tgt_opts,'fd_warm_start','fd_warm_start')
+        ## Evaluate the energies at displaced parameters at the MM-optimized geometries.
+        self.set_option(tgt_opts,'fd_frozen_geometry','fd_frozen_geometry')
+        ## MM-optimized coordinates of each snapshot at the current parameters.
+        self.mm_opt_xyzs = None
+        ## Starting coordinates of the snapshots that mm_opt_xyzs were optimized from.
+        self.mm_opt_refs = None
         ## Read in the reference data.
         self.read_reference_data()
         ## Build keyword dictionaries to pass to engine.
@@ -117,19 +125,31 @@ class TorsionProfileTarget(Target):
         self.PrintDict = OrderedDict()
 
         def compute(mvals_, indicate=False):
-            self.FF.make(mvals_)
+            self.FF.make(mvals_, write=not self.engine.ff_in_memory)
             M_opts = None
             compute.emm = []
             compute.rmsd = []
+            # Geometries at the current parameters are close to those at the displaced parameters.
+            warm = in_fd() and self.mm_opt_refs is not None and len(self.mm_opt_refs) == len(self.engine.mol) and \
+                all([np.array_equal(x0, x1) for x0, x1 in zip(self.mm_opt_refs, self.engine.mol.xyzs)])
+            mm_opt_xyzs = []
             for i in range(self.ns):
-                energy, rmsd, M_opt = self.engine.optimize(shot=i, align=False)
+                if warm and self.fd_frozen_geometry:
+                    energy = self.engine.energy_at(self.mm_opt_xyzs[i])
+                    compute.emm.append(energy)
+                    continue
+                energy, rmsd, M_opt = self.engine.optimize(shot=i, align=False, start=self.mm_opt_xyzs[i] if (warm and self.fd_warm_start) else None)
                 # Create a molecule object to hold the MM-optimized structures
                 compute.emm.append(energy)
                 compute.rmsd.append(rmsd)
+                mm_opt_xyzs.append(M_opt.xyzs[0].copy())
                 if M_opts is None:
                     M_opts = deepcopy(M_opt)
                 else:
                     M_opts += M_opt
+            if not in_fd():
+                self.mm_opt_xyzs = mm_opt_xyzs
+                self.mm_opt_refs = [x.copy() for x in self.engine.mol.xyzs]
             compute.emm = np.array(compute.emm)
             compute.emm -= compute.emm[self.smin]
             compute.rmsd = np.array(compute.rmsd)
@@ -182,13 +202,9 @@ class TorsionProfileTarget(Target):
         # compute gradients and hessian
         dV = np.zeros((self.FF.np,len(V)))
         if AGrad or AHess:
-            for p in self.pgrad:
-                dV[p,:], _ = f12d3p(fdwrap(compute, mvals, p), h = self.h, f0 = V)
+            dV = self.fd_derivatives(compute, mvals, V)
 
-        for p in self.pgrad:
-            Answer['G'][p] = 2*np.dot(V, dV[p,:])
-            for q in self.pgrad:
-                Answer['H'][p,q] = 2*np.dot(dV[p,:], dV[q,:])
+        Answer = self.gauss_newton(V, dV)
         if not in_fd():
             self.objective = Answer['X']
             self.FF.make(mvals)
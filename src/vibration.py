@@ -88,10 +88,9 @@ class Vibration(Target):
 
     def get(self, mvals, AGrad=False, AHess=False):
         """ Evaluate objective function. """
-        Answer = {'X':0.0, 'G':np.zeros(self.FF.np), 'H':np.zeros((self.FF.np, self.FF.np))}
 
         def get_eigvals(mvals_):
-            self.FF.make(mvals_)
+            self.FF.make(mvals_, write=not self.engine.ff_in_memory)
             eigvals, eigvecs = self.vibration_driver()
             # The overlap metric may take into account some frequency differences.
             # Here, an element of dev is equal to 2/3 if (for example) the frequencies differ by 1000.
@@ -131,13 +130,8 @@ class Vibration(Target):
         D = calc_eigvals - self.ref_eigvals
         dV = np.zeros((self.FF.np,len(calc_eigvals)))
         if AGrad or AHess:
-            for p in self.pgrad:
-                dV[p,:], _ = f12d3p(fdwrap(get_eigvals, mvals, p), h = self.h, f0 = calc_eigvals)
-        Answer['X'] = np.dot(D,D) / self.denom**2 / (len(D) if self.normalize else 1)
-        for p in self.pgrad:
-            Answer['G'][p] = 2*np.dot(D, dV[p,:]) / self.denom**2 / (len(D) if self.normalize else 1)
-            for q in self.pgrad:
-                Answer['H'][p,q] = 2*np.dot(dV[p,:], dV[q,:]) / self.denom**2 / (len(D) if self.normalize else 1)
+            dV = self.fd_derivatives(get_eigvals, mvals, calc_eigvals)
+        Answer = self.gauss_newton(D, dV, scale=1.0 / self.denom**2 / (len(D) if self.normalize else 1))
         if not in_fd():
             self.calc_eigvals = calc_eigvals
             self.objective = Answer['X']
@@ -0,0 +1 @@
+/root/package/studies/003_liquid_bromine/optimize.tmp/LiquidBromine/npt.py
\ No newline at end of file
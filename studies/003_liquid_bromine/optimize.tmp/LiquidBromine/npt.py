@@ -0,0 +1 @@
+/tmp/fbpath/forcebalance/data/npt.py
\ No newline at end of file
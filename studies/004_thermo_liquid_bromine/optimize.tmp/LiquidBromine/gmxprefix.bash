@@ -0,0 +1 @@
+/tmp/fbpath/forcebalance/data/gmxprefix.bash
\ No newline at end of file
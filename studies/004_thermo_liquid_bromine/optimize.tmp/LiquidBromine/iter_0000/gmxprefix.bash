@@ -0,0 +1 @@
+/root/package/studies/004_thermo_liquid_bromine/optimize.tmp/LiquidBromine/gmxprefix.bash
\ No newline at end of file
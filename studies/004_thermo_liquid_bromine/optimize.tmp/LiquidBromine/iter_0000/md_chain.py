@@ -0,0 +1 @@
+/root/package/studies/004_thermo_liquid_bromine/optimize.tmp/LiquidBromine/md_chain.py
\ No newline at end of file
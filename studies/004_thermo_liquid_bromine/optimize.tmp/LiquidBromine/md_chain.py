@@ -0,0 +1 @@
+/tmp/fbpath/forcebalance/data/md_chain.py
\ No newline at end of file
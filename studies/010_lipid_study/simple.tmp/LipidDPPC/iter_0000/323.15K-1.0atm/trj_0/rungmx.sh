@@ -0,0 +1 @@
+/root/package/studies/010_lipid_study/simple.tmp/LipidDPPC/iter_0000/rungmx.sh
\ No newline at end of file
@@ -0,0 +1 @@
+/root/package/studies/010_lipid_study/simple.tmp/LipidDPPC/rungmx.sh
\ No newline at end of file
@@ -0,0 +1 @@
+/tmp/fbpath/forcebalance/data/npt_lipid.py
\ No newline at end of file